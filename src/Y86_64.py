@@ -1,12 +1,27 @@
 from system import *
+from memory import Memory, AddressError
+from profiler import Profiler
+from pipeline import PipelineModel, PREDICTORS
+from tracing import Tracer
+from debugger import Debugger, DebuggerShell
+from loops import LoopDetector
+import argparse
 import assembler
+import dump
+import engines
+import json
+import objfile
 import os
 import sys
 
-HELP_MESSAGE = 'Enter nothing: execute the next instruction if program is paused. Otherwise end program.\n' \
-               'Enter s: display flags, program counter, registers, and status.\n' \
-               'Enter m: display all of main memory.\n' \
-               'Enter h: display this message\n'
+# Programs are stopped after this many instructions unless --max-steps says otherwise, in case they never halt. Under
+# --detect-loops there is no default limit, since a program which never halts is then caught by the detector.
+MAX_STEPS = 1000
+# What main exits with for each status a program can finish in, AOK meaning the step budget ran out first. 1 is kept for
+# programs which couldn't be read or assembled, and 2 is what argparse exits with for bad arguments.
+EXIT_CODES = {Status.HLT: 0, Status.ADR: 3, Status.INS: 4, Status.AOK: 5}
+# What main exits with when --detect-loops finds the program repeating a state.
+LOOP_EXIT_CODE = 6
 
 
 def run(sys: System):
@@ -19,79 +34,183 @@ def run(sys: System):
     if sys.status != Status.AOK:
         return False
 
-    next_ins = sys.mem.main[sys.program_counter:sys.program_counter + 10]
-    instruction_function = next_ins[0] & 0xf
-    instruction_specifier = (next_ins[0] & 0xf0) >> 4
-    # Note: Not all instructions actually have register specifiers
-    reg_a = (next_ins[1] & 0xf0) >> 4
-    reg_b = next_ins[1] & 0xf
-    if instruction_specifier == 0:
-        sys.halt()
-    elif instruction_specifier == 1:
-        sys.program_counter += 1
-    elif instruction_specifier == 2:
-        if instruction_function == 0:
-            sys.rrmovq(reg_a, reg_b)
-        else:
-            sys.cmovxx(reg_a, reg_b, instruction_function)
-    elif instruction_specifier == 3:
-        immediate = sys.mem.read(sys.program_counter + 2)
-        sys.irmovq(immediate, reg_b)
-    elif instruction_specifier == 4:
-        displacement = sys.mem.read(sys.program_counter + 2)
-        sys.rmmovq(reg_a, reg_b, displacement)
-    elif instruction_specifier == 5:
-        displacement = sys.mem.read(sys.program_counter + 2)
-        sys.mrmovq(reg_b, reg_a, displacement)
-    elif instruction_specifier == 6:
-        sys.bin_op(reg_a, reg_b, instruction_function)
-    elif instruction_specifier == 7:
-        destination = sys.mem.read(sys.program_counter + 1)
-        sys.jxx(destination, instruction_function)
-    elif instruction_specifier == 8:
-        destination = sys.mem.read(sys.program_counter + 1)
-        sys.call(destination)
-    elif instruction_specifier == 9:
-        sys.ret()
-    elif instruction_specifier == 10:
-        sys.pushq(reg_a)
-    elif instruction_specifier == 11:
-        sys.popq(reg_a)
-    else:
-        sys.status = Status.INS
+    sys.step()
 
     return True if sys.status == Status.AOK else False
 
 
-def query_response(option, sys):
-    if option == "h":
-        print(HELP_MESSAGE)
-    elif option == "s":
-        sys.pprint()
-    elif option == "m":
-        sys.mem.pprint()
+def describe(system, steps):
+    """
+    :param system: A System a program has finished running on
+    :param steps: Number of instructions the program executed
+    :return: A dictionary of the final state of system, with the same keys batch uses for its results
+    """
+    state = {
+        'status': system.status.name,
+        'steps': steps,
+        'program_counter': system.program_counter,
+        'registers': {name: Memory.to_signed(value) for name, value in zip(REGISTER_NAMES, system.registers)},
+        'flags': {'overflow': system.overflow_flag, 'sign': system.sign_flag, 'zero': system.zero_flag},
+        'memory_digest': system.mem.digest(),
+    }
+    if system.status == Status.ADR:
+        state['fault_address'] = system.fault_address
+    return state
 
 
 def main():
-    system = System()
-    assert len(sys.argv) == 2, "Please provide one input file"
+    parser = argparse.ArgumentParser(
+        description='Assemble and run a Y86_64 program.',
+        epilog='The exit status is 0 if the program halted, 3 on an invalid address, 4 on an invalid instruction and 5 '
+               'if the step budget ran out first. It is 6 if --detect-loops found the program stuck in a loop, and 1 '
+               'if the program could not be read or assembled.')
+    parser.add_argument('source', help='Y86_64 source file or object file, or - to read source from stdin')
+    parser.add_argument('--max-steps', metavar='N', type=int,
+                        help=f'stop after N instructions, or never with 0 (default: {MAX_STEPS}, or never with '
+                             '--detect-loops)')
+    parser.add_argument('--format', default='text', choices=('text', 'json'),
+                        help='print the final state as text or as one line of JSON (default: text)')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help="don't print the final state, leaving the exit status to report how the program ended")
+    parser.add_argument('--object', metavar='FILE', help='also write the assembled program to FILE as an object file')
+    # Each of these runs the program its own way, so only one of them can be given.
+    modes = parser.add_mutually_exclusive_group()
+    modes.add_argument('--debug', action='store_true',
+                       help='step through the program at a debugger prompt, then print its final state as usual')
+    modes.add_argument('--profile', action='store_true', help='print a table of the most executed instructions')
+    modes.add_argument('--pipeline', metavar='PREDICTOR', choices=PREDICTORS,
+                       help='print cycle counts for a pipelined processor using the given branch predictor '
+                            f'({", ".join(PREDICTORS)})')
+    modes.add_argument('--trace', metavar='FILE', help='write a binary trace of every instruction to FILE')
+    modes.add_argument('--detect-loops', action='store_true',
+                       help='stop the program if it ever comes back to exactly the same state, and report the loop')
+    parser.add_argument('--profile-json', metavar='FILE',
+                        help='write profiling results to FILE as JSON, on its own or along with --profile')
+    parser.add_argument('--trace-last', metavar='N', type=int,
+                        help='with --trace, only write the last N instructions, kept in memory until the end')
+    parser.add_argument('--engine', choices=sorted(engines.ENGINES),
+                        help='how to execute the program, which can\'t be chosen when it is being profiled, modelled '
+                             f'or traced (default: {engines.DEFAULT_ENGINE})')
+    parser.add_argument('--dump', default='text', choices=dump.FORMATS + ('none',),
+                        help='format of the final memory dump, or none to skip it (default: text)')
+    parser.add_argument('--dump-file', metavar='FILE', default='final_memory_state.txt',
+                        help='where to write the memory dump (default: final_memory_state.txt)')
+    parser.add_argument('--dump-modified', action='store_true',
+                        help='dump only what the program changed rather than everything non zero')
+    args = parser.parse_args()
+    if args.max_steps is None:
+        args.max_steps = 0 if args.detect_loops else MAX_STEPS
+    if args.max_steps < 0:
+        parser.error('--max-steps must not be negative')
+    if args.debug and args.source == '-':
+        parser.error('--debug reads commands from stdin, so the program must come from a file')
+    if args.profile_json and (args.debug or args.pipeline or args.trace or args.detect_loops):
+        parser.error('--profile-json can only be combined with --profile, not with another way of running the program')
+    if args.trace_last is not None and not args.trace:
+        parser.error('--trace-last needs --trace')
+    if args.trace_last is not None and args.trace_last < 1:
+        parser.error('--trace-last must be at least 1')
+    if args.engine is not None and (args.profile or args.profile_json or args.pipeline or args.trace):
+        parser.error('--engine has no effect with --profile, --profile-json, --pipeline or --trace, which run the '
+                     'program themselves')
+    if args.engine is None:
+        args.engine = engines.DEFAULT_ENGINE
+
     try:
-        with open(sys.argv[1], 'r') as file:
-            source_lines = file.readlines()
-            print(source_lines)
+        is_object = args.source != '-' and objfile.is_object_file(args.source)
+        if is_object:
+            # Object files are read by objfile.load.
+            source = None
+        elif args.source == '-':
+            source = sys.stdin
+        else:
+            source = open(args.source, 'r')
     except FileNotFoundError:
-        print('Input file not found')
+        print('Input file not found', file=sys.stderr)
+        return 1
+    max_steps = args.max_steps or None
+    loop = None
 
-    assembler.assemble(source_lines, system)
-    x = 0
-    while run(system) and x < 1000:
-        registers = system.registers
-        x += 1
+    if is_object:
+        try:
+            system, image = objfile.load(args.source)
+        except (ValueError, AddressError) as error:
+            print(error, file=sys.stderr)
+            return 1
+        labels, line_numbers, source_lines = image.symbols, image.lines, None
+    else:
+        system = System()
+        # Source is assembled as it is read, except when profiling, since both profile reports quote it.
+        source_lines = source.readlines() if args.profile or args.profile_json else None
+        try:
+            assembly = assembler.assemble_into(source if source_lines is None else source_lines, system.mem,
+                                               '<stdin>' if source is sys.stdin else args.source)
+        except assembler.AssemblyError as error:
+            print(error, file=sys.stderr)
+            return 1
+        finally:
+            if source is not sys.stdin:
+                source.close()
+        labels, line_numbers = assembly.labels, assembly.line_numbers
+        if args.object:
+            objfile.save(objfile.from_system(system, labels, line_numbers), args.object)
 
-    print(system)
-    with open('final_memory_state.txt', 'w') as file:
-        file.write(repr(system.mem))
-    return
+    # Whatever the program changes from here on is what --dump-modified shows.
+    system.mem.clean()
+    if args.debug:
+        debugger = Debugger(system, labels, line_numbers, args.engine)
+        DebuggerShell(debugger).cmdloop()
+        debugger.close()
+        steps = debugger.steps
+    elif args.profile or args.profile_json:
+        profiler = Profiler(system, line_numbers, source_lines)
+        steps = profiler.run(max_steps=max_steps)
+        if args.profile:
+            print(profiler.report())
+        if args.profile_json:
+            with open(args.profile_json, 'w') as file:
+                file.write(profiler.to_json())
+    elif args.pipeline:
+        model = PipelineModel(system, args.pipeline)
+        steps = model.run(max_steps=max_steps)
+        print(model.report())
+    elif args.trace:
+        with open(args.trace, 'wb') as file:
+            if args.trace_last:
+                tracer = Tracer(system, args.trace_last)
+                steps = tracer.run(max_steps=max_steps)
+                tracer.save(file)
+            else:
+                tracer = Tracer(system, file=file)
+                steps = tracer.run(max_steps=max_steps)
+                tracer.close()
+    elif args.detect_loops:
+        detector = LoopDetector(system, args.engine)
+        steps = detector.run(max_steps=max_steps).steps
+        loop = detector.loop
+        detector.close()
+    else:
+        engine = engines.create(args.engine, system)
+        steps = engine.run(max_steps=max_steps).steps
+        engine.close()
+
+    if not args.quiet:
+        if args.format == 'json':
+            state = dict(source=args.source, **describe(system, steps))
+            if loop is not None:
+                state['loop'] = loop._asdict()
+            print(json.dumps(state))
+        else:
+            print(system)
+            if loop is not None:
+                print(f'Stuck after {steps} instructions in a loop of {loop.length} instructions between '
+                      f'{loop.low_pc:#x} and {loop.high_pc:#x}', file=sys.stderr)
+            elif system.status == Status.AOK:
+                print(f'Stopped after {steps} instructions without halting, see --max-steps', file=sys.stderr)
+    if args.dump != 'none':
+        with open(args.dump_file, 'wb' if args.dump == 'binary' else 'w') as file:
+            dump.dump(system.mem, file, args.dump, args.dump_modified)
+    return LOOP_EXIT_CODE if loop is not None else EXIT_CODES[system.status]
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,158 @@
+"""
+This module keeps assembled programs in a directory on disk, so a program which has been assembled before is loaded
+instead of assembled again.
+
+Entries are object files (see objfile) named after a SHA-256 hash of the assembler version, the memory size and the
+source text, so identical source always finds the same entry and a new assembler version never finds an old one. Entries
+are written to a temporary file and renamed into place, so several processes can share a directory without ever reading
+half an entry. Each hit touches its entry's modification time, and once the directory grows past its size limit the
+least recently used entries are deleted.
+"""
+import hashlib
+import os
+import tempfile
+
+import assembler
+import objfile
+from memory import AddressError, DEFAULT_SIZE
+
+# Where entries are kept when no directory is given, unless the Y86_CACHE_DIR environment variable says otherwise.
+DEFAULT_DIRECTORY = os.path.join(os.path.expanduser('~'), '.cache', 'y86_64')
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+
+class AssemblyCache:
+    """
+    A directory of assembled programs shared by every process using it.
+    """
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        :param directory: Directory to keep entries in, created if it doesn't exist
+        :param max_bytes: Total size of entries to keep. Least recently used entries are deleted beyond it.
+        """
+        self.directory = directory or os.environ.get('Y86_CACHE_DIR') or DEFAULT_DIRECTORY
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def key(lines, memory_size=DEFAULT_SIZE):
+        """
+        :param lines: Lines of Y86_64 source code, with or without line endings
+        :param memory_size: Size of the address space the program is assembled for
+        :return: The hex digest naming the entry for lines
+        """
+        digest = hashlib.sha256(f'y86_64 assembler {assembler.VERSION}\nmemory {memory_size}\n'.encode())
+        for line in lines:
+            digest.update(line.rstrip('\n').encode())
+            digest.update(b'\n')
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + objfile.SUFFIX)
+
+    def load(self, lines, system):
+        """
+        Loads the assembled form of lines into system, assembling it only if no process has cached it yet.
+
+        :param lines: Lines of Y86_64 source code, or an open file to read them from
+        :param system: The System to load the program into
+        :return: An objfile.Image holding the program's labels and line numbers
+        """
+        # Lines are read twice, once for the key and once more to assemble them on a miss.
+        lines = list(lines)
+        path = self.path(self.key(lines, system.mem.size))
+        try:
+            _, image = objfile.load(path, system)
+        except (FileNotFoundError, ValueError, AddressError):
+            # Missing, written by an older version of objfile, or not fitting in memory (which the memory size in the
+            # key should rule out), and about to be replaced.
+            pass
+        else:
+            self.hits += 1
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                # Another process evicted the entry after it was read, which doesn't matter.
+                pass
+            return image
+
+        self.misses += 1
+        image = objfile.assemble(lines, system.mem.size)
+        descriptor, temporary = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(descriptor, 'wb') as file:
+                file.write(objfile.dumps(image))
+            _, image = objfile.load(temporary, system)
+            os.replace(temporary, path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+        self.evict()
+        return image
+
+    def assemble(self, lines, system):
+        """
+        A drop in replacement for assembler.assemble which goes through the cache.
+
+        :return: A dictionary mapping the address of each instruction to the number of the line it came from
+        """
+        return self.load(lines, system).lines
+
+    def _entries(self):
+        """
+        :return: A list of (modification time, size, path) of every entry
+        """
+        entries = []
+        with os.scandir(self.directory) as scan:
+            for entry in scan:
+                if not entry.name.endswith(objfile.SUFFIX):
+                    continue
+                try:
+                    info = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((info.st_mtime, info.st_size, entry.path))
+        return entries
+
+    def evict(self):
+        """
+        Deletes the least recently used entries until the rest fit in max_bytes.
+
+        :return: The number of entries deleted
+        """
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        deleted = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+                deleted += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+        return deleted
+
+    def clear(self):
+        for _, _, path in self._entries():
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        """
+        :return: A dictionary of this object's hits and misses along with the size of the shared directory.
+        """
+        entries = self._entries()
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': len(entries),
+            'bytes': sum(size for _, size, _ in entries),
+        }
@@ -1,5 +1,12 @@
-from memory import Memory
+from collections import namedtuple
+import re
+import struct
+import sys
 
+from memory import Memory, WORD
+
+# Changes whenever the machine code produced for some source changes, so that cached assemblies are thrown away.
+VERSION = 2
 INS_SIZE = {
     "halt": 1, "nop": 1, "rrmovq": 2, "irmovq": 10, "rmmovq": 10, "mrmovq": 10, "addq": 2, "subq": 2, "andq": 2,
     "xorq": 2, "jmp": 9, "jle": 9, "jl": 9, "je": 9, "jne": 9, "jge": 9, "jg": 9, "cmovle": 2, "cmovl": 2,
@@ -13,36 +20,47 @@ INS_OP_FUNCTION = {
 REGISTER_INDEX = {
     "%rax": 0, "%rcx": 1, "%rdx": 2, "%rbx": 3, "%rsp": 4, "%rbp": 5, "%rsi": 6, "%rdi": 7, "%r8": 8, "%r9": 9,
     "%r10": 10, "%r11": 11, "%r12": 12, "%r13": 13, "%r14": 14}
+# The first byte of each instruction.
+INS_CODE = {name: icode << 4 | ifun for name, (icode, ifun) in INS_OP_FUNCTION.items()}
+# Instructions whose constant operand may be a label.
+LABEL_OPERAND_INSTRUCTIONS = frozenset(('irmovq', 'jmp', 'jle', 'jl', 'je', 'jne', 'jge', 'jg', 'call'))
+DIRECTIVES = ('.align', '.quad', '.pos')
+# Tokens are runs of anything but whitespace and commas.
+TOKEN = re.compile(r'[^\s,]+')
+# Streamed machine code is handed on in chunks of about this many bytes.
+CHUNK_SIZE = 4096
+# A memory operand such as 8(%rsp), giving the displacement and the base register.
+MEMORY_OPERAND = re.compile(r'([^(]*)\((%\w+)\)$')
+
+# segments is a list of (address, bytearray) pairs to copy into memory in order. labels maps each label to its
+# address, and line_numbers maps the address of each instruction to the number of the line it came from.
+Assembly = namedtuple('Assembly', ['segments', 'labels', 'line_numbers'])
 
 
 # TODO: more input validation
 # TODO: more tests
 # TODO: consider making labels behave 'correctly'
-# TODO: negative inputs with mrmovq and rmmovq
 
 def string_to_int(dig_string):
     """
     Given a string of digits, returns the int those digits represent. If the digit string begins with 0x, it is
     assumed base 16. Otherwise, it is assumed base 10. Also ignores leading $ that demarcates int literals.
-    Should probably raise an exception if the input is not a valid int but i'm just trying to get this finished now
 
     :param dig_string: String of digits
     :returns: Int represented by the string of digits 
+    :raises ValueError: If dig_string isn't an int
     """
     original_digit_string = dig_string
-    if dig_string[0] == '$':
+    if dig_string[:1] == '$':
         dig_string = dig_string[1:]
-    # short-circut to avoid index error
-    if len(dig_string) >= 3 and dig_string[0:2] == '0x':
-        dig_string = dig_string[2:]
-        return int(dig_string, 16)
-
     try:
+        # short-circut to avoid index error
+        if len(dig_string) >= 3 and dig_string[0:2] == '0x':
+            return int(dig_string[2:], 16)
         return int(dig_string)
     except ValueError:
-        print(f"Invalid digit format or label {original_digit_string}. Remember labels can only use alphebetical "
-              f"characters")
-        raise Exception
+        raise ValueError(f"Invalid digit format or label {original_digit_string}. Remember labels can only use "
+                         f"alphebetical characters") from None
 
 
 def tokenize(lines):
@@ -52,24 +70,32 @@ def tokenize(lines):
     :param lines: A list of Y86_64 source code code strings
     :return: A list of tokenized lines
     """
-    tokens = []
-    for line in lines:
+    return [token_list for _, token_list in numbered_tokens(lines)]
+
+
+def numbered_tokens(lines):
+    """
+    Tokenizes a y86-64 assembly file, keeping track of where each list of tokens came from.
+
+    :param lines: A list of Y86_64 source code code strings
+    :return: A list of 2-tuples of a line number, counting from 1, and a tokenized line
+    """
+    return list(StreamAssembler().tokens(lines))
+
+
+def line_tokens(line):
+    """
+    :param line: One line of Y86_64 source code
+    :return: A list of the tokenized lines in line. A label followed by an instruction on the same line gives two.
+    """
+    if '#' in line:
         line = line[:line.find('#')]
-        # The replacement needs to happen for  comma seperated operands
-        line = line.replace('#', '')
-        line = line.replace(',', ' ')
-        # NOTE: Consider changing how colons (and relatedly, labels) are handled.
-        if ':' in line:
-            line = line.replace(':', '\n')
-            colon_seperated = line.split('\n')
-            if not colon_seperated[0].isspace() and colon_seperated[0]:
-                tokens.append(colon_seperated[0].split())
-            if not colon_seperated[1].isspace() and colon_seperated[1]:
-                tokens.append(colon_seperated[1].split())
-        else:
-            if not line.isspace() and line:
-                tokens.append(line.split())
-    return tokens
+    # NOTE: Consider changing how colons (and relatedly, labels) are handled.
+    if ':' not in line:
+        token_list = TOKEN.findall(line)
+        return [token_list] if token_list else []
+    # Anything after a second colon is ignored.
+    return [token_list for token_list in map(TOKEN.findall, line.split(':')[:2]) if token_list]
 
 # FIXME: defining labels doesn't require a comma
 def mem_map(tokens):
@@ -78,6 +104,8 @@ def mem_map(tokens):
 
     :param tokens: tokenized lines, i.e output from the "tokenized" function
     :return: A list containing the starting address of memory for each line and the tokens in the line
+    :raises AssemblyError: If a label is defined wrongly or an operand names one that isn't defined. Lines are counted
+                           among the tokenized lines, from 1.
 
     :Example: mem_map(['irmovq', '5', '%rbx']) -> [[0, ['irmovq', '5', '%rbx']]]
     """
@@ -85,37 +113,126 @@ def mem_map(tokens):
     m_map = []
     for token_list in tokens:
         m_map.append([place, token_list])
-        first_token = token_list[0]
-        if first_token in INS_SIZE.keys():
-            place += INS_SIZE[first_token]
-        elif first_token == ".align":
-            alignment = string_to_int(token_list[1])
-            place -= place % alignment
-            place += alignment
-        elif first_token == ".quad":
-            place += 8
-        elif first_token == ".pos":
-            place = string_to_int(token_list[1])
+        place = next_place(place, token_list)
 
     # the rest of the logic in this function just deals with labels. 
-    directives = ('.align', '.quad', '.pos')
-    instructions = tuple(INS_SIZE.keys())
+    label_dict = {label: str(place) for label, place in labels(m_map).items()}
+    diagnostics = []
+    for number, (_, token_list) in enumerate(m_map, 1):
+        # test if token_list[1] if a representation of an int
+        if (token_list[0] in LABEL_OPERAND_INSTRUCTIONS or token_list[0] == '.quad') and len(token_list) > 1 \
+                and token_list[1].isalpha():
+            if token_list[1] in label_dict:
+                token_list[1] = label_dict[token_list[1]]
+            else:
+                diagnostics.append(Diagnostic('<input>', number, f'Undefined label {token_list[1]}'))
+    if diagnostics:
+        raise AssemblyError(diagnostics)
+
+    return m_map
+
+
+def next_place(place, token_list):
+    """
+    :param place: Address the line given by token_list starts at
+    :param token_list: A tokenized line
+    :return: Address the following line starts at
+    """
+    first_token = token_list[0]
+    size = INS_SIZE.get(first_token)
+    if size is not None:
+        return place + size
+    if first_token == ".align":
+        # Note that this moves on by a whole alignment even when place is already aligned.
+        alignment = string_to_int(token_list[1])
+        return place - place % alignment + alignment
+    if first_token == ".quad":
+        return place + 8
+    if first_token == ".pos":
+        return string_to_int(token_list[1])
+    return place
+
+
+def labels(m_map):
+    """
+    :param m_map: Output from mem_map, or its first half before labels are replaced
+    :return: A dictionary mapping each label to the address it marks
+    :raises AssemblyError: If a line starts with something that is neither an instruction, a directive nor a label
+    """
     label_dict = {}
-    for place, token_list in m_map:
-        if token_list[0] not in instructions and token_list[0] not in directives:
+    diagnostics = []
+    for number, (place, token_list) in enumerate(m_map, 1):
+        if token_list[0] not in INS_SIZE and token_list[0] not in DIRECTIVES:
             if len(token_list) > 1:
-                raise Exception
+                diagnostics.append(Diagnostic('<input>', number, f'Unknown instruction {token_list[0]}'))
             else:
-                label_dict[token_list[0]] = str(place)
+                label_dict[token_list[0]] = place
+    if diagnostics:
+        raise AssemblyError(diagnostics)
+    return label_dict
 
-    for _, token_list in m_map:
-        label_operand_instructions = ('irmovq', 'jmp', 'jle', 'jl', 'je', 'jne', 'jge', 'jg', 'call')
-        if token_list[0] in label_operand_instructions:
-            # test if token_list[1] if a representation of an int
-            if token_list[1].isalpha():
-                token_list[1] = label_dict[token_list[1]]
 
-    return m_map
+def _constant(operand, buffer, offset):
+    """
+    Writes a constant operand into buffer as a little endian word.
+
+    :return: operand if it is a label, which is left for the caller to fill in, otherwise None
+    """
+    if operand.isalpha():
+        return operand
+    WORD.pack_into(buffer, offset, Memory.to_unsigned(string_to_int(operand)))
+    return None
+
+
+def _memory_operand(operand):
+    """
+    :param operand: A memory operand such as 8(%rsp) or (%rax)
+    :return: A 2-tuple of the displacement as an unsigned int and the index of the base register
+    """
+    match = MEMORY_OPERAND.match(operand)
+    if match is None:
+        raise ValueError(f'Invalid memory operand {operand}')
+    displacement, base = match.groups()
+    return Memory.to_unsigned(string_to_int(displacement) if displacement else 0), REGISTER_INDEX[base]
+
+
+def encode_into(token_list, buffer, offset):
+    """
+    Writes the machine code for one instruction or .quad directive into buffer.
+
+    :param token_list: A tokenized line holding an instruction or .quad directive
+    :param buffer: A bytearray with room for the encoding at offset
+    :param offset: Where in buffer the encoding starts
+    :return: None, or if the constant operand is a label, a 2-tuple of where in buffer its address belongs and the label
+    """
+    name = token_list[0]
+    if name == '.quad':
+        label = _constant(token_list[1], buffer, offset)
+        return None if label is None else (offset, label)
+    buffer[offset] = INS_CODE[name]
+    size = INS_SIZE[name]
+    if size == 1:
+        return None
+    if size == 9:
+        label = _constant(token_list[1], buffer, offset + 1)
+        return None if label is None else (offset + 1, label)
+    if name == 'irmovq':
+        buffer[offset + 1] = 0xf0 | REGISTER_INDEX[token_list[2]]
+        label = _constant(token_list[1], buffer, offset + 2)
+        return None if label is None else (offset + 2, label)
+    if name == 'rmmovq':
+        displacement, reg_b = _memory_operand(token_list[2])
+        buffer[offset + 1] = REGISTER_INDEX[token_list[1]] << 4 | reg_b
+        WORD.pack_into(buffer, offset + 2, displacement)
+    elif name == 'mrmovq':
+        displacement, reg_b = _memory_operand(token_list[1])
+        buffer[offset + 1] = REGISTER_INDEX[token_list[2]] << 4 | reg_b
+        WORD.pack_into(buffer, offset + 2, displacement)
+    elif name in ('pushq', 'popq'):
+        buffer[offset + 1] = REGISTER_INDEX[token_list[1]] << 4 | 0xf
+    else:
+        buffer[offset + 1] = REGISTER_INDEX[token_list[1]] << 4 | REGISTER_INDEX[token_list[2]]
+    return None
 
 
 def encode_ins(instruction_tokens):
@@ -123,103 +240,12 @@ def encode_ins(instruction_tokens):
     Translates a single instruction from y86_64 assembly to machine code
 
     :instruction_tokens: List of tokens from the source code of a single Y86_64 instruction 
-    :return: The bit encoding the same instruction 
-    """
-    instruction = instruction_tokens[0]
-
-    if instruction == "halt":
-        return "00"
-
-    if instruction == "nop":
-        return "10"
-
-    if instruction == "rrmovq":
-        reg_a = REGISTER_INDEX[instruction_tokens[1]]
-        reg_a = f'{reg_a:x}'
-        reg_b = REGISTER_INDEX[instruction_tokens[2]]
-        reg_b = f'{reg_b:x}'
-        return f'20{reg_a}{reg_b}'
-
-    if instruction == "irmovq":
-        immediate = string_to_int(instruction_tokens[1])
-        if immediate < 0:
-            immediate = Memory.to_unsigned(immediate)
-        immediate = f'{immediate:x}'
-        immediate = f'{immediate:0>16}'
-        immediate = Memory.endian_conversion(immediate)
-        reg_b = REGISTER_INDEX[instruction_tokens[2]]
-        reg_b = f'{reg_b:x}'
-        return f'30f{reg_b}{immediate}'
-
-    if instruction == "rmmovq":
-        reg_a = REGISTER_INDEX[instruction_tokens[1]]
-        reg_a = f'{reg_a:x}'
-        tok_two = instruction_tokens[2].replace(')', '')
-        dest, reg_b = tok_two.split('(')
-        reg_b = REGISTER_INDEX[reg_b]
-        reg_b = f'{reg_b:x}'
-        dest = int(dest) if dest else 0
-        if dest < 0:
-            dest = Memory.to_unsigned(dest)
-        dest = f'{dest:x}'
-        dest = f'{dest:0>16}'
-        dest = Memory.endian_conversion(dest)
-        return f'40{reg_a}{reg_b}{dest}'
-
-    if instruction == "mrmovq":
-        tok_one = instruction_tokens[1].replace(')', '')
-        dest, reg_a = tok_one.split('(')
-        reg_a = REGISTER_INDEX[reg_a]
-        reg_a = f'{reg_a:x}'
-        dest = int(dest) if dest else 0
-        if dest < 0:
-            dest = Memory.to_unsigned(dest)
-        dest = Memory.endian_conversion(f'{dest:x}')
-        reg_b = REGISTER_INDEX[instruction_tokens[2]]
-        reg_b = f'{reg_b:x}'
-        return f'50{reg_b}{reg_a}{dest:0<16}'
-
-    op_functions = {'addq': 0, 'subq': 1, 'andq': 2, 'xorq': 3}
-    if instruction in op_functions.keys():
-        reg_a = REGISTER_INDEX[instruction_tokens[1]]
-        reg_a = f'{reg_a:x}'
-        reg_b = REGISTER_INDEX[instruction_tokens[2]]
-        reg_b = f'{reg_b:x}'
-        return f'6{op_functions[instruction]}{reg_a}{reg_b}'
-
-    jmp_functions = {'jmp': 0, 'jle': 1, 'jl': 2, 'je': 3, 'jne': 4, 'jge': 5, 'jg': 6}
-    if instruction in jmp_functions.keys():
-        dest = string_to_int(instruction_tokens[1])
-        dest = f'{dest:x}'
-        dest = Memory.endian_conversion(dest)
-        return f'7{jmp_functions[instruction]}{dest:0<16}'
-
-    cmov_functions = {'cmovle': 1, 'cmovl': 2, 'cmove': 3, 'cmovne': 4, 'cmovge': 5, 'cmovg': 6}
-    if instruction in cmov_functions.keys():
-        reg_a = REGISTER_INDEX[instruction_tokens[1]]
-        reg_a = f'{reg_a:x}'
-        reg_b = REGISTER_INDEX[instruction_tokens[2]]
-        reg_b = f'{reg_b:x}'
-        return f'2{cmov_functions[instruction]}{reg_a}{reg_b}'
-
-    if instruction == 'call':
-        dest = int(instruction_tokens[1])
-        dest = f'{dest:x}'
-        dest = Memory.endian_conversion(dest)
-        return f'80{dest:0<16}'
-
-    if instruction == 'ret':
-        return '90'
-
-    if instruction == 'pushq':
-        reg_a = REGISTER_INDEX[instruction_tokens[1]]
-        reg_a = f'{reg_a:x}'
-        return f'a0{reg_a}f'
-
-    if instruction == 'popq':
-        reg_a = REGISTER_INDEX[instruction_tokens[1]]
-        reg_a = f'{reg_a:x}'
-        return f'b0{reg_a}f'
+    :return: The bit encoding the same instruction as a string of hex digits
+    """
+    buffer = bytearray(INS_SIZE[instruction_tokens[0]])
+    if encode_into(instruction_tokens, buffer, 0) is not None:
+        raise KeyError(instruction_tokens[1])
+    return buffer.hex()
 
 
 def encode(mapped_tokens, system):
@@ -228,29 +254,229 @@ def encode(mapped_tokens, system):
 
     :param mapped_tokens: List of instructions and their place in memory, i.e output from mem_map
     :param system: A y86_64 system object to load the instructions into
+    :raises AssemblyError: If an operand names a label, which mem_map should have replaced with its address
+    """
+    for number, (place, token_list) in enumerate(mapped_tokens, 1):
+        size = 8 if token_list[0] == '.quad' else INS_SIZE.get(token_list[0])
+        if size is not None:
+            buffer = bytearray(size)
+            if encode_into(token_list, buffer, 0) is not None:
+                raise AssemblyError([Diagnostic('<input>', number, f'Undefined label {token_list[1]}')])
+            system.mem.store(place, buffer)
+
+
+class Diagnostic(namedtuple('Diagnostic', ['filename', 'line', 'message'])):
+    """
+    A problem with one line of source code.
     """
-    for place, token_list in mapped_tokens:
-        if token_list[0] in INS_SIZE.keys():
-            encoded_instruction = encode_ins(token_list)
-            encoded_bytes = [int(encoded_instruction[i:i + 2], 16) for i in range(0, len(encoded_instruction), 2)]
-            for i, byte in enumerate(encoded_bytes):
-                system.mem.main[place + i] = byte
-
-#todo: fix quad words
-        if token_list[0] == '.quad':
-            value = token_list[1]
-            value = "{0:x}".format(string_to_int(value))
-            byte_list = [int(value[i:i + 2], 16) for i in range(0, len(value), 2)]
-            byte_list.reverse()
-            for i, a_byte in enumerate(byte_list):
-                system.mem.main[place + i] = a_byte
+    def __str__(self):
+        return f'{self.filename}:{self.line}: {self.message}'
+
+
+class AssemblyError(Exception):
+    """
+    Raised once the whole of a source has been read if any line of it couldn't be assembled.
+    """
+    def __init__(self, diagnostics):
+        super().__init__('\n'.join(map(str, diagnostics)))
+        self.diagnostics = diagnostics
+
+
+class StreamAssembler:
+    """
+    Assembles source code as a pipeline of generators, so that lines are read, tokenized, placed and encoded one at a
+    time as the machine code is consumed:
+
+        lines -> tokens -> layout -> encode -> (address, bytearray) chunks
+
+    Label operands are encoded as zeroes and remembered as fix ups, which resolved produces once the chunks have all been
+    consumed. Problems are recorded as Diagnostics and the offending line skipped, so a single pass finds every error.
+    """
+    def __init__(self, filename='<input>', chunk_size=CHUNK_SIZE, memory_size=None):
+        """
+        :param filename: Name of the source, used in diagnostics
+        :param chunk_size: Chunks are cut once they reach this many bytes
+        :param memory_size: Size of the memory the program is to be loaded into, or None to not check that it fits
+        """
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.memory_size = memory_size
+        self.labels = {}
+        self.line_numbers = {}
+        # (address, label, line number) for every operand naming a label
+        self.fixups = []
+        self.diagnostics = []
+
+    def error(self, line, message):
+        self.diagnostics.append(Diagnostic(self.filename, line, message))
+
+    def tokens(self, lines):
+        """
+        :param lines: Any iterable of lines of source code, such as an open file
+        :return: A generator of (line number, tokenized line) pairs
+        """
+        for number, line in enumerate(lines, 1):
+            for token_list in line_tokens(line):
+                yield number, token_list
+
+    def layout(self, tokens):
+        """
+        Works out where each line goes, recording labels as it finds them.
+
+        :param tokens: Output from tokens
+        :return: A generator of (address, line number, tokenized line, size) for every line that takes up memory
+        """
+        place = 0
+        end = sys.maxsize if self.memory_size is None else self.memory_size
+        # Whether running off the end of memory has been reported since place was last moved back inside it, so that
+        # a .pos past the end is reported once rather than once for every line after it.
+        reported = False
+        for number, token_list in tokens:
+            first_token = token_list[0]
+            size = 8 if first_token == '.quad' else INS_SIZE.get(first_token)
+            if size is None:
+                if first_token in DIRECTIVES:
+                    try:
+                        place = next_place(place, token_list)
+                    except (IndexError, ValueError, ZeroDivisionError):
+                        self.error(number, f'{first_token} needs a positive number')
+                        continue
+                    reported = not 0 <= place <= end
+                    if reported:
+                        self.error(number, f'{first_token} moves to {place:#x}, outside memory')
+                elif len(token_list) > 1:
+                    self.error(number, f'Unknown instruction {first_token}')
+                else:
+                    self.labels[first_token] = place
+                continue
+            if place < 0 or place + size > end:
+                if not reported:
+                    self.error(number, f'{first_token} at {place:#x} runs past the end of memory at {end:#x}')
+                    reported = True
+            else:
+                if first_token != '.quad':
+                    self.line_numbers[place] = number
+                yield place, number, token_list, size
+            place += size
+
+    def encode(self, placed):
+        """
+        :param placed: Output from layout
+        :return: A generator of (address, bytearray) chunks of machine code, in source order. Lines which overwrite
+                 earlier ones must be copied to memory after them.
+        """
+        start, chunk = 0, bytearray()
+        for place, number, token_list, size in placed:
+            if place != start + len(chunk) or len(chunk) >= self.chunk_size:
+                if chunk:
+                    yield start, chunk
+                start, chunk = place, bytearray()
+            offset = len(chunk)
+            chunk += bytes(size)
+            try:
+                fixup = encode_into(token_list, chunk, offset)
+            except KeyError as error:
+                self.error(number, f'Unknown register {error.args[0]}')
+            except IndexError:
+                self.error(number, f'Missing operand for {token_list[0]}')
+            except ValueError as error:
+                self.error(number, str(error))
+            except struct.error:
+                self.error(number, f'Operand of {token_list[0]} does not fit in 64 bits')
+            else:
+                if fixup is not None:
+                    self.fixups.append((start + fixup[0], fixup[1], number))
+        if chunk:
+            yield start, chunk
+
+    def chunks(self, lines):
+        """
+        :param lines: Any iterable of lines of source code
+        :return: A generator of (address, bytearray) chunks of machine code with label operands left as zeroes
+        """
+        return self.encode(self.layout(self.tokens(lines)))
+
+    def resolved(self):
+        """
+        :return: A generator of (address, value) pairs for the words label operands go in
+        """
+        for address, label, number in self.fixups:
+            value = self.labels.get(label)
+            if value is None:
+                self.error(number, f'Undefined label {label}')
+            else:
+                yield address, value
+
+    def check(self):
+        """
+        :raises AssemblyError: If any problems were found
+        """
+        if self.diagnostics:
+            # Undefined labels are only found at the end, so put everything back in source order.
+            raise AssemblyError(sorted(self.diagnostics, key=lambda diagnostic: diagnostic.line))
+
+
+def assemble_segments(lines, filename='<input>', memory_size=None):
+    """
+    Assembles source code into bytearrays without loading it anywhere.
+
+    :param lines: Any iterable of lines of source code, such as an open file
+    :param filename: Name of the source, used in diagnostics
+    :param memory_size: Size of the memory the program is to be loaded into, or None to not check that it fits
+    :return: An Assembly
+    :raises AssemblyError: If any line couldn't be assembled
+    """
+    stream = StreamAssembler(filename, memory_size=memory_size)
+    segments = []
+    for start, chunk in stream.chunks(lines):
+        if segments and segments[-1][0] + len(segments[-1][1]) == start:
+            segments[-1][1].extend(chunk)
+        else:
+            segments.append((start, chunk))
+    for address, value in stream.resolved():
+        # Later segments overwrite earlier ones, so the word belongs to the last segment holding it.
+        for start, segment in reversed(segments):
+            if start <= address < start + len(segment):
+                WORD.pack_into(segment, address - start, value)
+                break
+    stream.check()
+    return Assembly(segments, stream.labels, stream.line_numbers)
+
+
+def assemble_into(lines, mem, filename='<input>'):
+    """
+    Assembles source code straight into memory, a chunk at a time. Only label fix ups and the returned maps are held
+    on to, so any length of source can be streamed through.
+
+    :param lines: Any iterable of lines of source code, such as an open file or sys.stdin
+    :param mem: The Memory to load the program into
+    :param filename: Name of the source, used in diagnostics
+    :return: An Assembly whose segments are (address, length) pairs
+    :raises AssemblyError: If any line couldn't be assembled, including lines which don't fit in mem, in which case
+                           memory holds the lines that could be
+    """
+    stream = StreamAssembler(filename, memory_size=mem.size)
+    segments = []
+    for start, chunk in stream.chunks(lines):
+        mem.store(start, chunk)
+        if segments and sum(segments[-1]) == start:
+            segments[-1] = (segments[-1][0], segments[-1][1] + len(chunk))
+        else:
+            segments.append((start, len(chunk)))
+    for address, value in stream.resolved():
+        mem.store(address, WORD.pack(value))
+    stream.check()
+    return Assembly(segments, stream.labels, stream.line_numbers)
+
 
 def assemble(lines, y_system):
     """
     Takes source code defined by lines, assembles it, and loads it into the y_system.
 
-    :param lines: lines of source code
+    :param lines: lines of source code, or an open file to read them from
     :param y_system: Y86_64 system simulation to load assembled program into
+    :return: A dictionary mapping the address of each instruction to the number of the line it came from, counting
+             from 1
+    :raises AssemblyError: If any line couldn't be assembled
     """
-    m_map = mem_map(tokenize(lines))
-    encode(m_map, y_system)
\ No newline at end of file
+    return assemble_into(lines, y_system.mem, getattr(lines, 'name', '<input>')).line_numbers
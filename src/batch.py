@@ -0,0 +1,181 @@
+"""
+This module runs many Y86_64 programs at once over a pool of worker processes and reports the results as JSON lines.
+
+Jobs come either from a directory, in which case every .ys file in it is run, or from a manifest file holding one JSON
+object per line such as:
+
+    {"source": "tests/sum.ys", "registers": {"%rdi": 5}, "memory": {"0x400": 7}, "max_steps": 100000}
+
+Relative source paths in a manifest are relative to the manifest. "registers" and "memory" are optional and are applied
+after the program is loaded. Memory overrides write whole words.
+"""
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import time
+
+import assembler
+from asmcache import AssemblyCache
+from memory import Memory, DEFAULT_SIZE
+from system import System, Status, StopReason
+
+# Instructions a job may execute when neither the job nor the command line gives a budget.
+DEFAULT_MAX_STEPS = 1000000
+# Jobs check their wall clock timeout after every this many instructions.
+TIMEOUT_CHECK_STEPS = 10000
+REGISTER_NAME = {index: name for name, index in assembler.REGISTER_INDEX.items()}
+
+
+def find_jobs(path):
+    """
+    :param path: A directory of .ys files or a manifest file
+    :return: A list of job dictionaries with at least a 'source' key
+    """
+    if os.path.isdir(path):
+        return [{'source': os.path.join(path, name)} for name in sorted(os.listdir(path)) if name.endswith('.ys')]
+    jobs = []
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path, 'r') as manifest:
+        for line in manifest:
+            if not line.strip():
+                continue
+            job = json.loads(line)
+            job['source'] = os.path.join(base, job['source'])
+            jobs.append(job)
+    return jobs
+
+
+def parse_int(value):
+    """
+    :param value: A python int or a string of decimal or 0x prefixed hex digits, possibly negative
+    :return: The value as an unsigned 64 bit int
+    """
+    if isinstance(value, str):
+        value = int(value, 0)
+    return Memory.to_unsigned(value)
+
+
+def apply_overrides(system, job):
+    """
+    Sets the initial registers and memory words a job asks for.
+
+    :param system: A System the job's program has been loaded into
+    :param job: A job dictionary
+    """
+    for register, value in job.get('registers', {}).items():
+        index = assembler.REGISTER_INDEX[register] if isinstance(register, str) and register.startswith('%') \
+            else int(register)
+        system.registers[index] = parse_int(value)
+    for address, value in job.get('memory', {}).items():
+        system.mem.write(parse_int(value), parse_int(address))
+
+
+def run_job(job, max_steps=DEFAULT_MAX_STEPS, timeout=None, cache_directory=None):
+    """
+    Assembles and runs a single job. Runs in a worker process, so it never raises for problems with the job itself.
+
+    :param job: A job dictionary
+    :param max_steps: Instruction budget used when the job doesn't give one
+    :param timeout: Seconds of wall clock time the job may run for, or None for no limit. Time spent reading and
+                    assembling the source counts, but the limit is only checked while instructions are executed.
+    :param cache_directory: Directory of an AssemblyCache to load programs through, or None to always assemble
+    :return: A dictionary describing the final state of the job's system, ready to be written as JSON
+    """
+    result = {'source': job['source']}
+    started = time.monotonic()
+    try:
+        system = System(job.get('memory_size', DEFAULT_SIZE))
+        with open(job['source'], 'r') as file:
+            if cache_directory is None:
+                assembler.assemble(file.readlines(), system)
+            else:
+                cache = AssemblyCache(cache_directory)
+                cache.load(file.readlines(), system)
+                result['assembly_cached'] = bool(cache.hits)
+        apply_overrides(system, job)
+        result['assembly_seconds'] = time.monotonic() - started
+
+        budget = job.get('max_steps', max_steps)
+        steps = 0
+        while True:
+            chunk = budget - steps if timeout is None else min(budget - steps, TIMEOUT_CHECK_STEPS)
+            outcome = system.run_until(max_steps=chunk)
+            steps += outcome.steps
+            reason = outcome.reason.name.lower()
+            if outcome.reason != StopReason.BUDGET or steps >= budget:
+                break
+            if time.monotonic() - started > timeout:
+                reason = 'timeout'
+                break
+    except Exception as error:
+        result['error'] = f'{type(error).__name__}: {error}'
+        return result
+
+    result.update({
+        'status': system.status.name,
+        'reason': reason,
+        'steps': steps,
+        'program_counter': system.program_counter,
+        'registers': {REGISTER_NAME[i]: Memory.to_signed(value) for i, value in enumerate(system.registers)},
+        'flags': {'overflow': system.overflow_flag, 'sign': system.sign_flag, 'zero': system.zero_flag},
+        'memory_digest': system.mem.digest(),
+        'seconds': time.monotonic() - started,
+    })
+    if system.status == Status.ADR:
+        result['fault_address'] = system.fault_address
+    return result
+
+
+def run_batch(jobs, output, workers=None, max_steps=DEFAULT_MAX_STEPS, timeout=None, cache_directory=None):
+    """
+    Runs jobs over a process pool, writing one line of JSON to output for each as soon as it finishes.
+
+    :param jobs: A list of job dictionaries, as returned by find_jobs
+    :param output: A text file to write results to
+    :param workers: Number of worker processes, or None for one per core
+    :param max_steps: Instruction budget for jobs which don't give their own
+    :param timeout: Seconds of wall clock time each job may run for, or None for no limit
+    :param cache_directory: Directory of an AssemblyCache shared by the workers, or None to always assemble
+    :return: The number of jobs which finished without an error and with status HLT
+    """
+    halted = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        futures = {pool.submit(run_job, job, max_steps, timeout, cache_directory): job for job in jobs}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as error:
+                # The worker died, as when it is killed for using too much memory, or the result couldn't be sent
+                # back. The job is reported like one which failed, and the jobs still pending carry on.
+                result = {'source': futures[future]['source'], 'error': f'{type(error).__name__}: {error}'}
+            halted += result.get('status') == Status.HLT.name
+            output.write(json.dumps(result) + '\n')
+            output.flush()
+    return halted
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run many Y86_64 programs and print their results as JSON lines.')
+    parser.add_argument('path', help='a directory of .ys files or a manifest of JSON lines')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='worker processes (default: one per core)')
+    parser.add_argument('--max-steps', type=int, default=DEFAULT_MAX_STEPS, help='default instruction budget per job')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='seconds each job may run for, counting from when it starts but only checked while it '
+                             'executes instructions, so a job stuck reading or assembling its source is not stopped')
+    parser.add_argument('--cache', metavar='DIR', default=None, help='load previously assembled programs from DIR')
+    parser.add_argument('-o', '--output', default=None, help='file to write results to (default: stdout)')
+    args = parser.parse_args()
+
+    jobs = find_jobs(args.path)
+    if args.output is None:
+        halted = run_batch(jobs, sys.stdout, args.jobs, args.max_steps, args.timeout, args.cache)
+    else:
+        with open(args.output, 'w') as output:
+            halted = run_batch(jobs, output, args.jobs, args.max_steps, args.timeout, args.cache)
+    return 0 if halted == len(jobs) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,175 @@
+"""
+This module times the Y86_64 workloads in the benchmarks directory, so that changes to the simulator can be checked for
+their effect on speed. For example:
+
+    python benchmark.py --save baseline.json
+    python benchmark.py --baseline baseline.json --threshold 0.1
+
+Each workload is assembled and run repeat times, and the fastest of each is kept, along with the instructions it
+executed and the most memory python allocated while assembling and running it once more under tracemalloc. Results can
+be saved to a JSON file and later runs compared against it, with any workload which has become slower or hungrier by
+more than the threshold reported as a regression.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import assembler
+import engines
+from system import System
+
+WORKLOAD_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks')
+DEFAULT_REPEAT = 5
+# Fraction by which a measurement may be worse than the baseline before it is reported.
+DEFAULT_THRESHOLD = 0.10
+# Workloads which haven't halted by then are stopped and reported with their status.
+MAX_STEPS = 10000000
+# Measurements compared against a baseline, and whether a larger value is better.
+METRICS = (('ips', True), ('assemble_seconds', False), ('peak_bytes', False))
+
+
+def find_workloads(directory=WORKLOAD_DIRECTORY):
+    """
+    :return: A sorted list of the paths of the .ys files in directory
+    """
+    return [os.path.join(directory, name) for name in sorted(os.listdir(directory)) if name.endswith('.ys')]
+
+
+def run_workload(path, engine=engines.DEFAULT_ENGINE, repeat=DEFAULT_REPEAT, max_steps=MAX_STEPS):
+    """
+    :param path: Path to a Y86_64 source file
+    :param engine: Name of the engine to run it with
+    :param repeat: Times to assemble and run it. The fastest time of each is reported.
+    :param max_steps: Most instructions to execute per run
+    :return: A dictionary of measurements
+    """
+    if repeat < 1:
+        raise ValueError('repeat must be at least 1')
+    with open(path, 'r') as file:
+        lines = file.readlines()
+
+    assemble_seconds = run_seconds = float('inf')
+    for _ in range(repeat):
+        system = System()
+        start = time.perf_counter()
+        assembler.assemble_into(lines, system.mem, path)
+        assemble_seconds = min(assemble_seconds, time.perf_counter() - start)
+        runner = engines.create(engine, system)
+        start = time.perf_counter()
+        result = runner.run(max_steps=max_steps)
+        run_seconds = min(run_seconds, time.perf_counter() - start)
+
+    # tracemalloc slows everything down, so memory is measured on a run of its own.
+    tracemalloc.start()
+    try:
+        system = System()
+        assembler.assemble_into(lines, system.mem, path)
+        engines.create(engine, system).run(max_steps=max_steps)
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'workload': os.path.splitext(os.path.basename(path))[0],
+        'status': result.status.name,
+        'instructions': result.steps,
+        'assemble_seconds': assemble_seconds,
+        'run_seconds': run_seconds,
+        'ips': result.steps / run_seconds if run_seconds else 0.0,
+        'peak_bytes': peak_bytes,
+    }
+
+
+def run_suite(paths, engine=engines.DEFAULT_ENGINE, repeat=DEFAULT_REPEAT):
+    """
+    :param paths: Paths to Y86_64 source files
+    :return: A dictionary describing the run, with 'results' mapping workload names to run_workload measurements
+    """
+    results = {}
+    for path in paths:
+        result = run_workload(path, engine, repeat)
+        results[result['workload']] = result
+    return {'engine': engine, 'repeat': repeat, 'python': platform.python_version(), 'results': results}
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    :param results: The 'results' of run_suite
+    :param baseline: The 'results' of an earlier run_suite
+    :param threshold: Fraction by which a measurement may be worse than its baseline
+    :return: A list of (workload, metric, baseline value, new value) for every measurement worse than threshold allows.
+             Workloads missing from either side are skipped.
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        before = baseline.get(name)
+        if before is None:
+            continue
+        for metric, higher_is_better in METRICS:
+            old, new = before[metric], result[metric]
+            if higher_is_better and new < old * (1 - threshold) or not higher_is_better and new > old * (1 + threshold):
+                regressions.append((name, metric, old, new))
+    return regressions
+
+
+def report(suite, regressions=()):
+    """
+    :param suite: The result of run_suite
+    :param regressions: The result of compare
+    :return: A printable table of the measurements followed by any regressions.
+    """
+    lines = [f'{suite["engine"]} engine, best of {suite["repeat"]}, python {suite["python"]}',
+             f'{"workload":<14} {"status":>6} {"instructions":>12} {"ips":>12} {"assemble ms":>12} {"peak KiB":>10}']
+    for name, result in sorted(suite['results'].items()):
+        lines.append(f'{name:<14} {result["status"]:>6} {result["instructions"]:>12} {result["ips"]:>12,.0f} '
+                     f'{1000 * result["assemble_seconds"]:>12.3f} {result["peak_bytes"] / 1024:>10.1f}')
+    if regressions:
+        lines.append('')
+        lines.append('regressions:')
+        for name, metric, old, new in regressions:
+            lines.append(f'  {name} {metric}: {old:,.6g} -> {new:,.6g} ({100 * (new - old) / old:+.1f}%)')
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the Y86_64 benchmark workloads.')
+    parser.add_argument('workloads', nargs='*',
+                        help='.ys files or directories of them to run (default: the benchmarks directory)')
+    parser.add_argument('--engine', default=engines.DEFAULT_ENGINE, choices=sorted(engines.ENGINES),
+                        help=f'engine to run the workloads with (default: {engines.DEFAULT_ENGINE})')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                        help=f'times to run each workload, keeping the fastest (default: {DEFAULT_REPEAT})')
+    parser.add_argument('--save', metavar='FILE', help='write the results to FILE as a JSON baseline')
+    parser.add_argument('--baseline', metavar='FILE', help='compare the results against a baseline saved earlier')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='fraction by which a measurement may be worse than the baseline before it is reported '
+                             f'as a regression (default: {DEFAULT_THRESHOLD})')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON instead of a table')
+    args = parser.parse_args()
+
+    paths = []
+    for path in args.workloads or [WORKLOAD_DIRECTORY]:
+        paths.extend(find_workloads(path) if os.path.isdir(path) else [path])
+    suite = run_suite(paths, args.engine, args.repeat)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, 'r') as file:
+            regressions = compare(suite['results'], json.load(file)['results'], args.threshold)
+    if args.json:
+        print(json.dumps(dict(suite, regressions=[{'workload': name, 'metric': metric, 'baseline': old, 'value': new}
+                                                  for name, metric, old, new in regressions]), indent=2))
+    else:
+        print(report(suite, regressions))
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(suite, file, indent=2)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,253 @@
+"""
+This module simulates a set associative data cache in front of main memory.
+
+A DataCache attached to a System sees every word read or written through its Memory by mrmovq, rmmovq, pushq, popq, call
+and ret, and counts hits and misses. It does so by shadowing the read and write methods of that one Memory object, so a
+Memory without a cache attached runs exactly the code it always has. Instruction fetches are not data accesses and go
+around the cache.
+
+Tags are kept in one flat array of line numbers, associativity entries per set, alongside an array of timestamps used by
+LRU and FIFO replacement and a bytearray of dirty bits.
+"""
+from array import array
+import json
+import random
+
+REPLACEMENT_POLICIES = ('lru', 'fifo', 'random')
+# Write back caches allocate a line on a write miss, write through caches send the write straight to memory.
+WRITE_POLICIES = ('back', 'through')
+# Estimated cycles spent going to main memory for a line.
+MISS_PENALTY = 100
+# Marks an empty way in the tag array.
+EMPTY = -1
+
+
+def _is_power_of_two(n):
+    return n > 0 and not n & (n - 1)
+
+
+class DataCache:
+    """
+    Counts the hits and misses a cache of the given shape would see. Data itself always lives in Memory, so the cache
+    only ever affects the statistics.
+    """
+    def __init__(self, size=32 * 1024, line_size=64, associativity=8, replacement='lru', write_policy='back',
+                 miss_penalty=MISS_PENALTY, seed=0):
+        """
+        :param size: Capacity in bytes, a power of two
+        :param line_size: Bytes per line, a power of two
+        :param associativity: Lines per set. Use size // line_size for a fully associative cache.
+        :param replacement: One of REPLACEMENT_POLICIES
+        :param write_policy: One of WRITE_POLICIES
+        :param miss_penalty: Cycles charged for each line fetched from or written back to memory, and for each write
+                             sent through to memory
+        :param seed: Seed for random replacement, so runs can be repeated
+        """
+        if not _is_power_of_two(size) or not _is_power_of_two(line_size) or associativity < 1:
+            raise ValueError('size and line_size must be powers of two and associativity at least 1')
+        lines = size // line_size
+        if lines < associativity or lines % associativity:
+            raise ValueError(f'{size} bytes of {line_size} byte lines cannot be split into {associativity} way sets')
+        if replacement not in REPLACEMENT_POLICIES:
+            raise ValueError(f'Unknown replacement policy {replacement}, expected one of '
+                             f'{", ".join(REPLACEMENT_POLICIES)}')
+        if write_policy not in WRITE_POLICIES:
+            raise ValueError(f'Unknown write policy {write_policy}, expected one of {", ".join(WRITE_POLICIES)}')
+        self.size = size
+        self.line_size = line_size
+        self.line_bits = line_size.bit_length() - 1
+        self.associativity = associativity
+        self.sets = lines // associativity
+        self.replacement = replacement
+        self.write_policy = write_policy
+        self.miss_penalty = miss_penalty
+        self.random = random.Random(seed)
+        # Way w of set s is entry s * associativity + w. Tags are whole line numbers.
+        self.tags = array('q', [EMPTY]) * lines
+        self.stamps = array('Q', bytes(8 * lines))
+        self.dirty = bytearray(lines)
+        self.clock = 0
+        self.reads = 0
+        self.writes = 0
+        # Lines looked up, which is more than reads + writes when words straddle two lines. Misses are counted per line,
+        # so rates are relative to this.
+        self.line_accesses = 0
+        self.read_misses = 0
+        self.write_misses = 0
+        self.writebacks = 0
+        self.write_throughs = 0
+        # Maps program counters to the misses their instructions caused
+        self.misses_at = {}
+        self.system = None
+
+    def access(self, address, pc=None, write=False):
+        """
+        Looks up the 8 byte word at address, filling the cache on a miss. A word which straddles two lines touches both.
+
+        :param address: Address of the word
+        :param pc: Address of the instruction making the access, used to attribute misses
+        :param write: True for a write, False for a read
+        :return: The number of lines which missed
+        """
+        if write:
+            self.writes += 1
+        else:
+            self.reads += 1
+        first = address >> self.line_bits
+        last = (address + 7) >> self.line_bits
+        missed = self._line(first, write)
+        self.line_accesses += 1
+        if last != first:
+            missed += self._line(last, write)
+            self.line_accesses += 1
+        if missed:
+            if write:
+                self.write_misses += missed
+            else:
+                self.read_misses += missed
+            if pc is not None:
+                self.misses_at[pc] = self.misses_at.get(pc, 0) + missed
+        if write and self.write_policy == 'through':
+            self.write_throughs += 1
+        return missed
+
+    def _line(self, line, write):
+        """
+        :return: 1 if line missed, 0 if it hit.
+        """
+        ways = self.associativity
+        base = (line % self.sets) * ways
+        tags = self.tags
+        self.clock += 1
+        try:
+            entry = tags.index(line, base, base + ways)
+        except ValueError:
+            pass
+        else:
+            if self.replacement == 'lru':
+                self.stamps[entry] = self.clock
+            if write and self.write_policy == 'back':
+                self.dirty[entry] = 1
+            return 0
+        if write and self.write_policy == 'through':
+            return 1
+
+        try:
+            entry = tags.index(EMPTY, base, base + ways)
+        except ValueError:
+            if self.replacement == 'random':
+                entry = base + self.random.randrange(ways)
+            else:
+                stamps = self.stamps[base:base + ways]
+                entry = base + stamps.index(min(stamps))
+            if self.dirty[entry]:
+                self.writebacks += 1
+        tags[entry] = line
+        self.stamps[entry] = self.clock
+        self.dirty[entry] = write
+        return 1
+
+    def attach(self, system):
+        """
+        Starts counting the data accesses system makes.
+
+        :param system: A System. Only one cache may be attached to it at a time.
+        """
+        if self.system is not None:
+            raise ValueError('the cache is already attached to a system')
+        mem = system.mem
+        if 'read' in vars(mem) or 'write' in vars(mem):
+            raise ValueError('the memory of that system already has a cache attached')
+        read, write, access = mem.read, mem.write, self.access
+
+        def cached_read(address):
+            value = read(address)
+            access(address, system.program_counter)
+            return value
+
+        def cached_write(src, destination):
+            write(src, destination)
+            access(destination, system.program_counter, True)
+
+        mem.read = cached_read
+        mem.write = cached_write
+        self.system = system
+
+    def detach(self):
+        """
+        Stops counting accesses, leaving the statistics gathered so far.
+        """
+        if self.system is not None:
+            del self.system.mem.read
+            del self.system.mem.write
+            self.system = None
+
+    def flush(self):
+        """
+        Writes back every dirty line and empties the cache.
+        """
+        self.writebacks += sum(self.dirty)
+        self.tags = array('q', [EMPTY]) * len(self.tags)
+        self.dirty = bytearray(len(self.dirty))
+
+    def misses(self):
+        return self.read_misses + self.write_misses
+
+    def stall_cycles(self):
+        """
+        :return: Estimated cycles spent waiting on main memory.
+        """
+        return (self.misses() + self.writebacks + self.write_throughs) * self.miss_penalty
+
+    def summary(self):
+        accesses = self.line_accesses
+        return {
+            'size': self.size,
+            'line_size': self.line_size,
+            'associativity': self.associativity,
+            'replacement': self.replacement,
+            'write_policy': self.write_policy,
+            'reads': self.reads,
+            'writes': self.writes,
+            'read_misses': self.read_misses,
+            'write_misses': self.write_misses,
+            'writebacks': self.writebacks,
+            'line_accesses': self.line_accesses,
+            'hit_rate': (accesses - self.misses()) / accesses if accesses else 0.0,
+            'miss_rate': self.misses() / accesses if accesses else 0.0,
+            'stall_cycles': self.stall_cycles(),
+        }
+
+    def per_pc(self):
+        """
+        Misses are put down to whatever the program counter of the attached System is at the time of the access. Every
+        engine keeps it pointing at the instruction making the access, the compiled engine by running instructions one
+        at a time while a cache is attached, but code which drives a compiler.BlockEngine directly only updates it as
+        each block is left, so misses would be put down to the start of the block.
+
+        :return: A list of (program counter, misses) pairs, most misses first.
+        """
+        return sorted(self.misses_at.items(), key=lambda item: (-item[1], item[0]))
+
+    def to_json(self):
+        return json.dumps(dict(self.summary(), misses_per_pc=[{'pc': pc, 'misses': misses}
+                                                              for pc, misses in self.per_pc()]), indent=2)
+
+    def report(self, limit=20):
+        """
+        :param limit: Most rows of the per program counter table to show
+        :return: A printable summary followed by the instructions which missed most.
+        """
+        summary = self.summary()
+        lines = [f'{self.size} byte {self.associativity} way cache, {self.line_size} byte lines, '
+                 f'{self.replacement} replacement, write {self.write_policy}',
+                 f'{"reads":>14} {summary["reads"]} ({summary["read_misses"]} missed)',
+                 f'{"writes":>14} {summary["writes"]} ({summary["write_misses"]} missed)',
+                 f'{"writebacks":>14} {summary["writebacks"]}',
+                 f'{"hit rate":>14} {100 * summary["hit_rate"]:.2f}%',
+                 f'{"stall cycles":>14} {summary["stall_cycles"]}',
+                 '',
+                 f'{"pc":>8} {"misses":>10}']
+        for pc, misses in self.per_pc()[:limit]:
+            lines.append(f'{pc:#8x} {misses:>10}')
+        return '\n'.join(lines)
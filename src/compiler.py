@@ -0,0 +1,316 @@
+"""
+This module defines an execution engine which translates basic blocks of Y86_64 machine code into python functions the
+first time they are reached, and then runs a whole block per function call instead of one instruction per call to run.
+"""
+import sys
+
+import decoder
+from memory import AddressError
+from system import Status
+
+# Blocks are cut after this many instructions even if no control flow instruction has been reached.
+MAX_BLOCK_LENGTH = 64
+# Size in bytes of the regions of memory used to find which blocks a write lands in.
+CHUNK_SIZE = 64
+
+# Python expressions over the flag locals deciding jxx and cmovxx, indexed by ifun.
+CONDITIONS = ('True', 'zf or sf != of', 'sf != of', 'zf', 'not zf', 'zf or sf == of', 'not zf and sf == of')
+# Python operators for addq, subq, andq and xorq. subq is carried out as addition of the negated source.
+BIN_OPS = ('+', '+', '&', '^')
+MASK = 2 ** 64 - 1
+
+
+def _compilable(ins):
+    """
+    :param ins: A decoder.Decoded instruction
+    :return: True if ins can be translated, False if it must be left to System (invalid codes or registers).
+    """
+    icode, ifun = ins.icode, ins.ifun
+    if icode > 11:
+        return False
+    if icode in (2, 7) and ifun > 6 or icode == 6 and ifun > 3:
+        return False
+    return not decoder.uses_missing_register(ins)
+
+
+def _registers_used(ins):
+    """
+    :return: A 2-tuple of the sets of registers ins reads and writes.
+    """
+    icode, reg_a, reg_b = ins.icode, ins.reg_a, ins.reg_b
+    if icode == 2:
+        return {reg_a, reg_b}, {reg_b}
+    if icode == 3:
+        return set(), {reg_b}
+    if icode == 4:
+        return {reg_a, reg_b}, set()
+    if icode == 5:
+        return {reg_b}, {reg_a}
+    if icode == 6:
+        return {reg_a, reg_b}, {reg_b}
+    if icode in (8, 9):
+        return {4}, {4}
+    if icode == 10:
+        return {4, reg_a}, {4}
+    if icode == 11:
+        return {4}, {4, reg_a}
+    return set(), set()
+
+
+def _reads_flags(ins):
+    return ins.icode in (2, 7) and ins.ifun != 0
+
+
+def _sets_flags(ins):
+    return ins.icode == 6
+
+
+def _accesses_memory(ins):
+    return ins.icode in (4, 5, 8, 9, 10, 11)
+
+
+def find_block(mem, address):
+    """
+    Decodes the basic block starting at address. A block ends after jxx, call, ret or halt, or before an instruction
+    which can't be translated.
+
+    :param mem: Memory holding the program
+    :param address: Address of the first instruction in the block
+    :return: A list of decoder.Decoded instructions, which is empty if the first instruction can't be translated.
+    """
+    instructions = []
+    while len(instructions) < MAX_BLOCK_LENGTH:
+        try:
+            ins = decoder.decode(mem, address)
+        except IndexError:
+            break
+        if not _compilable(ins):
+            break
+        instructions.append(ins)
+        if ins.icode in (0, 7, 8, 9):
+            break
+        address = ins.next_pc
+    return instructions
+
+
+def generate(instructions):
+    """
+    Generates the source of a python function 'block(system, budget)' which carries out instructions on system and
+    returns how many of them it executed. Registers and flags are held in locals for the length of the block. A block
+    which ends by jumping back to its own start loops inside the function for as long as budget allows.
+
+    :param instructions: A list of decoder.Decoded instructions, as returned by find_block
+    :return: The source code of the function
+    """
+    start, end = instructions[0].next_pc - decoder.ICODE_SIZE[instructions[0].icode], instructions[-1].next_pc
+    length = len(instructions)
+    last = instructions[-1]
+    loops = last.icode == 7 and last.value == start
+    used, written = set(), set()
+    for ins in instructions:
+        reads, writes = _registers_used(ins)
+        used |= reads | writes
+        written |= writes
+    uses_flags = any(_reads_flags(ins) or _sets_flags(ins) for ins in instructions)
+    sets_flags = any(_sets_flags(ins) for ins in instructions)
+
+    # Flags computed by an ALU op only matter if something reads them before the next ALU op overwrites them. Every
+    # memory access may exit the block early, so flags are live across those too.
+    live = True
+    flags_needed = [False] * length
+    for i in range(length - 1, -1, -1):
+        ins = instructions[i]
+        if _sets_flags(ins):
+            flags_needed[i] = live
+            live = False
+        elif _reads_flags(ins) or _accesses_memory(ins):
+            live = True
+
+    writeback = [f'regs[{r}] = r{r}' for r in sorted(written)]
+    if sets_flags:
+        writeback.append('system.overflow_flag, system.sign_flag, system.zero_flag = of, sf, zf')
+
+    def exit_to(pc, count, indent=''):
+        # pc may be a constant or a python expression over the block's locals. Looping blocks count instructions run by
+        # earlier iterations in n.
+        executed = f'n + {count}' if loops else count
+        return [indent + line for line in writeback + [f'system.program_counter = {pc}', f'return {executed}']]
+
+    def guarded(statements, pc, count):
+        # An access outside of memory stops the block on the faulting instruction, as System.step does.
+        executed = f'n + {count}' if loops else count
+        handler = writeback + ['system.address_fault(fault.address)', f'system.program_counter = {pc}',
+                               f'return {executed}']
+        return (['try:'] + ['    ' + line for line in statements] + ['except AddressError as fault:'] +
+                ['    ' + line for line in handler])
+
+    body = []
+    for count, ins in enumerate(instructions, 1):
+        icode, ifun, reg_a, reg_b, value, next_pc = ins
+        pc = next_pc - decoder.ICODE_SIZE[icode]
+        if icode == 0:
+            body.append('system.status = Status.HLT')
+            body += exit_to(pc, count)
+        elif icode == 1:
+            pass
+        elif icode == 2:
+            if ifun == 0:
+                body.append(f'r{reg_b} = r{reg_a}')
+            else:
+                body += [f'if {CONDITIONS[ifun]}:', f'    r{reg_b} = r{reg_a}']
+        elif icode == 3:
+            body.append(f'r{reg_b} = {value}')
+        elif icode == 4:
+            body.append(f'address = (r{reg_b} + {value}) & {MASK}')
+            body += guarded([f'mem.write(r{reg_a}, address)'], pc, count)
+            body.append(f'if {start - 8} < address < {end}:')
+            body += exit_to(next_pc, count, '    ')
+        elif icode == 5:
+            body += guarded([f'r{reg_a} = mem.read((r{reg_b} + {value}) & {MASK})'], pc, count)
+        elif icode == 6:
+            if ifun == 1:
+                # Subtraction adds the two's complement negation of the source, as Memory.overflowing_sub does.
+                body.append(f'b = -r{reg_a} & {MASK}')
+            else:
+                body.append(f'b = r{reg_a}')
+            body += [f'a = r{reg_b}', f'r{reg_b} = (a {BIN_OPS[ifun]} b) & {MASK}']
+            if flags_needed[count - 1]:
+                if ifun in (0, 1):
+                    body.append(f'of = ((a ^ r{reg_b}) & (b ^ r{reg_b})) >> 63 == 1')
+                else:
+                    body.append('of = False')
+                body += [f'sf = r{reg_b} >> 63 == 1', f'zf = r{reg_b} == 0']
+        elif icode == 7:
+            if loops:
+                body += [f'n += {length}', f'if {CONDITIONS[ifun]} and n + {length} <= budget:', '    continue']
+                body += exit_to(f'{value} if {CONDITIONS[ifun]} else {next_pc}', 0)
+            elif ifun == 0:
+                body += exit_to(value, count)
+            else:
+                body += exit_to(f'{value} if {CONDITIONS[ifun]} else {next_pc}', count)
+        elif icode == 8:
+            body.append(f'r4 = (r4 - 8) & {MASK}')
+            body += guarded([f'mem.write({next_pc}, r4)'], pc, count)
+            body += exit_to(value, count)
+        elif icode == 9:
+            body += guarded(['address = mem.read(r4)'], pc, count)
+            body.append(f'r4 = (r4 + 8) & {MASK}')
+            body += exit_to('address', count)
+        elif icode == 10:
+            body.append(f'r4 = (r4 - 8) & {MASK}')
+            body += guarded([f'mem.write(r{reg_a}, r4)'], pc, count)
+            body.append(f'if {start - 8} < r4 < {end}:')
+            body += exit_to(next_pc, count, '    ')
+        elif icode == 11:
+            body += guarded([f'r{reg_a} = mem.read(r4)'], pc, count)
+            body.append(f'r4 = (r4 + 8) & {MASK}')
+    if last.icode not in (0, 7, 8, 9):
+        body += exit_to(end, length)
+
+    lines = ['def block(system, budget):', '    regs = system.registers', '    mem = system.mem']
+    lines += [f'    r{r} = regs[{r}]' for r in sorted(used)]
+    if uses_flags:
+        lines.append('    of, sf, zf = system.overflow_flag, system.sign_flag, system.zero_flag')
+    if loops:
+        lines += ['    n = 0', '    while True:']
+        lines += ['        ' + line for line in body]
+    else:
+        lines += ['    ' + line for line in body]
+    return '\n'.join(lines) + '\n'
+
+
+def compile_block(instructions):
+    """
+    :param instructions: A list of decoder.Decoded instructions, as returned by find_block
+    :return: The python function generated for them.
+    """
+    namespace = {'Status': Status, 'AddressError': AddressError}
+    exec(compile(generate(instructions), '<y86 block>', 'exec'), namespace)
+    return namespace['block']
+
+
+class BlockEngine:
+    """
+    Runs a System by compiling each basic block it reaches into a python function. Compiled blocks are kept until a
+    write through Memory.write touches their code, at which point they are thrown away and recompiled when next reached.
+    """
+    def __init__(self, system):
+        self.system = system
+        # Maps a block's start address to a 3-tuple of (function, instruction count, end address), or to None if the
+        # instruction at that address has to be run by System.
+        self.blocks = {}
+        # Maps CHUNK_SIZE aligned regions of memory to the set of block start addresses with code in them.
+        self.chunks = {}
+        # Start addresses mapped to None in blocks, which a write may turn into valid code.
+        self.uncompiled = set()
+        system.mem.write_observers.append(self.invalidate)
+
+    def close(self):
+        """
+        Stops observing writes to memory, so that the blocks can be thrown away. The engine must not be run afterwards.
+        """
+        if self.invalidate in self.system.mem.write_observers:
+            self.system.mem.write_observers.remove(self.invalidate)
+
+    def compile(self, address):
+        instructions = find_block(self.system.mem, address)
+        if not instructions:
+            self.blocks[address] = None
+            self.uncompiled.add(address)
+            return None
+        end = instructions[-1].next_pc
+        block = (compile_block(instructions), len(instructions), end)
+        self.blocks[address] = block
+        for chunk in range(address // CHUNK_SIZE, (end - 1) // CHUNK_SIZE + 1):
+            self.chunks.setdefault(chunk, set()).add(address)
+        return block
+
+    def invalidate(self, address, length):
+        """
+        Throws away every block with code in [address, address + length).
+        """
+        end = address + length
+        chunks = self.chunks
+        for chunk in range(address // CHUNK_SIZE, (end - 1) // CHUNK_SIZE + 1):
+            starts = chunks.get(chunk)
+            if not starts:
+                continue
+            for start in list(starts):
+                block = self.blocks.get(start)
+                if block is None:
+                    starts.discard(start)
+                elif start < end and address < block[2]:
+                    del self.blocks[start]
+                    starts.discard(start)
+        # A write can also turn an address which could not be translated into valid code.
+        if self.uncompiled:
+            for start in range(address - decoder.MAX_INS_SIZE + 1, end):
+                if start in self.uncompiled:
+                    self.uncompiled.discard(start)
+                    del self.blocks[start]
+
+    def run(self, max_steps=None):
+        """
+        Runs the system until its status is no longer AOK or max_steps instructions have been executed.
+
+        :param max_steps: Most instructions to execute, or None for no limit
+        :return: The number of instructions executed
+        """
+        system = self.system
+        blocks = self.blocks
+        budget = sys.maxsize if max_steps is None else max_steps
+        steps = 0
+        while system.status == Status.AOK:
+            if steps >= budget:
+                break
+            pc = system.program_counter
+            try:
+                block = blocks[pc]
+            except KeyError:
+                block = self.compile(pc)
+            if block is None or budget - steps < block[1]:
+                system.step()
+                steps += 1
+            else:
+                steps += block[0](system, budget - steps)
+        return steps
@@ -0,0 +1,391 @@
+"""
+This module is an interactive debugger for Y86_64 programs, which steps and runs a System through an engine and stops it
+at breakpoints and watches.
+
+Between stops a program runs at the speed of its engine. Breakpoints are a set of addresses handed to Engine.run, which
+stops when the program counter reaches one. Memory watches add no work per instruction either: the debugger is told of
+every write to memory, ignores writes outside of the pages it watches, and when a write does land in a watched range it
+adds the address of the instruction following the one writing to the breakpoints of the current run, so the engine stops
+just after it. Registers can only be watched by comparing them after every instruction, so while a register is watched
+runs are as slow as that makes them.
+"""
+import bisect
+import cmd
+from collections import namedtuple
+
+import decoder
+import engines
+from memory import AddressError, Memory
+from profiler import MNEMONIC
+from system import Status, StopReason, REGISTER_NAMES
+
+# Instructions disassemble shows before and after the program counter when not given an address.
+CONTEXT_BEFORE = 3
+CONTEXT_AFTER = 6
+# No instruction can be at this address. Runs with memory watches add it to their breakpoints, so engines take the path
+# which checks breakpoints even when the user has set none.
+NO_ADDRESS = -1
+REGISTER_INDEX = {name: index for index, name in enumerate(REGISTER_NAMES)}
+# Short forms of the shell's commands. s, m and h are kept from the original step and inspect prompt.
+ALIASES = {'n': 'step', 'c': 'continue', 'b': 'break', 'd': 'delete', 'w': 'watch', 'p': 'print', 's': 'print',
+           'x': 'disassemble', 'm': 'memory', 'h': 'help', 'q': 'quit'}
+
+# A watched register or range of memory which changed or was written. watch is a register name or (address, length),
+# old and new are ints for registers and bytes for memory, and pc is the address of the instruction responsible, or None
+# if it isn't known.
+Hit = namedtuple('Hit', ['watch', 'old', 'new', 'pc'])
+
+
+def register_name(index):
+    return REGISTER_NAMES[index] if index < len(REGISTER_NAMES) else f'%r?{index:x}'
+
+
+def format_instruction(ins, names=None):
+    """
+    :param ins: A decoder.Decoded instruction
+    :param names: Optionally, a dictionary mapping addresses to labels, used for jump and call destinations
+    :return: The instruction in the assembler's syntax
+    """
+    name = MNEMONIC.get((ins.icode, ins.ifun))
+    icode = ins.icode
+    if name is None:
+        return f'invalid ({icode:x}{ins.ifun:x})'
+    reg_a, reg_b, value = register_name(ins.reg_a), register_name(ins.reg_b), Memory.to_signed(ins.value)
+    if icode in (2, 6):
+        return f'{name} {reg_a}, {reg_b}'
+    elif icode == 3:
+        return f'{name} {value}, {reg_b}'
+    elif icode == 4:
+        return f'{name} {reg_a}, {value}({reg_b})'
+    elif icode == 5:
+        return f'{name} {value}({reg_b}), {reg_a}'
+    elif icode in (7, 8):
+        return f'{name} {(names or {}).get(ins.value, hex(ins.value))}'
+    elif icode in (10, 11):
+        return f'{name} {reg_a}'
+    return name
+
+
+class Debugger:
+    """
+    Runs a System through an engine, stopping at breakpoints and watches.
+    """
+    def __init__(self, system, labels=None, line_numbers=None, engine=engines.DEFAULT_ENGINE):
+        """
+        :param system: A System with a program loaded
+        :param labels: Optionally, a dictionary mapping labels to addresses
+        :param line_numbers: Optionally, a dictionary whose keys are the addresses of the program's instructions, used
+                             to disassemble backwards from the program counter
+        :param engine: Name of the engine to run the system with
+        """
+        self.system = system
+        self.labels = labels or {}
+        self.names = {address: label for label, address in self.labels.items()}
+        self.instructions = sorted(line_numbers or ())
+        self.engine = engines.create(engine, system)
+        self.breakpoints = set()
+        # Maps (address, length) of each watched range of memory to its contents when last reported.
+        self.memory_watches = {}
+        # Numbers of the pages any watched range of memory touches.
+        self.watched_pages = set()
+        # Maps the index of each watched register to its value when last reported.
+        self.register_watches = {}
+        # Hits since run was last called.
+        self.hits = []
+        # Total instructions executed through the debugger.
+        self.steps = 0
+        # The breakpoints of the run in progress, or None.
+        self.running = None
+        system.mem.write_observers.append(self.written)
+
+    def close(self):
+        """
+        Stops watching the system and closes the engine, so the system can be run on without the debugger.
+        """
+        if self.written in self.system.mem.write_observers:
+            self.system.mem.write_observers.remove(self.written)
+        self.engine.close()
+
+    def address_of(self, location):
+        """
+        :param location: A label, an address in decimal or 0x prefixed hex, or an address as an int
+        :return: The address
+        """
+        if isinstance(location, int):
+            return location
+        if location in self.labels:
+            return self.labels[location]
+        try:
+            return int(location, 0)
+        except ValueError:
+            raise ValueError(f'{location} is neither a label nor an address') from None
+
+    def add_breakpoint(self, location):
+        """
+        :return: The address of the breakpoint
+        """
+        address = self.address_of(location)
+        self.breakpoints.add(address)
+        return address
+
+    def remove_breakpoint(self, location):
+        address = self.address_of(location)
+        if address not in self.breakpoints:
+            raise ValueError(f'There is no breakpoint at {address:#x}')
+        self.breakpoints.discard(address)
+
+    def watch(self, target, length=8):
+        """
+        :param target: A register name such as %rax, or a label or address to watch length bytes of memory from
+        :param length: Bytes of memory to watch
+        :return: The register name, or the (address, length) of the memory watched
+        """
+        if target in REGISTER_INDEX:
+            index = REGISTER_INDEX[target]
+            self.register_watches[index] = self.system.registers[index]
+            return target
+        mem = self.system.mem
+        address = self.address_of(target)
+        if length < 1 or address < 0 or address + length > mem.size:
+            raise ValueError(f'{length} bytes at {address:#x} are not all in memory')
+        self.memory_watches[(address, length)] = bytes(mem.load(address, length))
+        self.watched_pages.update(range(address >> mem.page_bits, ((address + length - 1) >> mem.page_bits) + 1))
+        return address, length
+
+    def unwatch(self, target):
+        if target in REGISTER_INDEX:
+            if self.register_watches.pop(REGISTER_INDEX[target], None) is None:
+                raise ValueError(f'{target} is not being watched')
+            return
+        address = self.address_of(target)
+        ranges = [key for key in self.memory_watches if key[0] == address]
+        if not ranges:
+            raise ValueError(f'No memory is being watched from {address:#x}')
+        for key in ranges:
+            del self.memory_watches[key]
+        bits = self.system.mem.page_bits
+        self.watched_pages = {number for address, length in self.memory_watches
+                              for number in range(address >> bits, ((address + length - 1) >> bits) + 1)}
+
+    def written(self, address, length):
+        """
+        Write observer for the system's memory. Instructions only move the program counter after they write, so it still
+        points at the instruction responsible.
+        """
+        pages = self.watched_pages
+        bits = self.system.mem.page_bits
+        if not pages or address >> bits not in pages and (address + length - 1) >> bits not in pages:
+            return
+        end = address + length
+        for (low, size), old in self.memory_watches.items():
+            if address < low + size and low < end:
+                new = bytes(self.system.mem.load(low, size))
+                self.hits.append(Hit((low, size), old, new, self.system.program_counter))
+                self.memory_watches[(low, size)] = new
+                if self.running is not None:
+                    self.running.add(self.successor())
+
+    def successor(self):
+        """
+        :return: The address of the instruction which runs after the one at the program counter, if that instruction
+                 writes to memory.
+        """
+        ins = decoder.decode(self.system.mem, self.system.program_counter)
+        # call is the only instruction which writes memory and doesn't fall through.
+        return ins.value if ins.icode == 8 else ins.next_pc
+
+    def registers_changed(self, system):
+        """
+        stop_on callable for runs with watched registers.
+        """
+        registers = system.registers
+        changed = False
+        for index, old in self.register_watches.items():
+            if registers[index] != old:
+                self.hits.append(Hit(REGISTER_NAMES[index], old, registers[index], None))
+                self.register_watches[index] = registers[index]
+                changed = True
+        return changed
+
+    def run(self, max_steps=None):
+        """
+        Runs until the program stops, a breakpoint or watch is hit, or max_steps instructions have run.
+
+        :param max_steps: Most instructions to execute, or None for no limit
+        :return: A RunResult, with StopReason.CONDITION if a watch was hit. The watches hit are in hits.
+        """
+        self.hits = []
+        breakpoints = set(self.breakpoints)
+        if self.memory_watches:
+            breakpoints.add(NO_ADDRESS)
+        self.running = breakpoints
+        try:
+            result = self.engine.run(max_steps, breakpoints,
+                                     self.registers_changed if self.register_watches else None)
+        finally:
+            self.running = None
+        self.steps += result.steps
+        if self.hits and result.status is Status.AOK:
+            result = result._replace(reason=StopReason.CONDITION)
+        return result
+
+    def disassemble(self, location=None, count=None):
+        """
+        :param location: Label or address of the first instruction, or None to start a few instructions before the
+                         program counter
+        :param count: Number of instructions to show
+        :return: A list of lines, one per instruction, with the program counter and breakpoints marked
+        """
+        mem, pc = self.system.mem, self.system.program_counter
+        if location is not None:
+            address = self.address_of(location)
+            count = count or CONTEXT_BEFORE + 1 + CONTEXT_AFTER
+        else:
+            # Instructions are variable length, so the ones before the program counter can only be found from the
+            # addresses the assembler placed them at.
+            index = bisect.bisect_left(self.instructions, pc)
+            known = index < len(self.instructions) and self.instructions[index] == pc
+            address = self.instructions[max(0, index - CONTEXT_BEFORE)] if known else pc
+            count = count or (min(index, CONTEXT_BEFORE) if known else 0) + 1 + CONTEXT_AFTER
+        lines = []
+        for _ in range(count):
+            try:
+                ins = decoder.decode(mem, address)
+                raw = mem.load(address, ins.next_pc - address).hex()
+            except AddressError:
+                break
+            label = self.names.get(address)
+            marks = ('=>' if address == pc else '  ') + ('*' if address in self.breakpoints else ' ')
+            lines.append(f'{marks} {address:#06x}  {raw:<20}  {label + ": " if label else ""}'
+                         f'{format_instruction(ins, self.names)}')
+            address = ins.next_pc
+        return lines
+
+
+class DebuggerShell(cmd.Cmd):
+    """
+    The command prompt of a Debugger. Entering nothing executes one instruction.
+    """
+    intro = 'Y86_64 debugger. Enter help for a list of commands, or nothing to execute one instruction.'
+    prompt = '(y86) '
+
+    def __init__(self, debugger, stdin=None, stdout=None):
+        super().__init__(stdin=stdin, stdout=stdout)
+        if stdin is not None:
+            self.use_rawinput = False
+        self.debugger = debugger
+
+    def say(self, text):
+        print(text, file=self.stdout)
+
+    def precmd(self, line):
+        command, _, rest = line.strip().partition(' ')
+        return f'{ALIASES.get(command, command)} {rest}'.strip()
+
+    def onecmd(self, line):
+        try:
+            return super().onecmd(line)
+        except (ValueError, AddressError) as error:
+            self.say(error)
+            return False
+
+    def emptyline(self):
+        return self.do_step('')
+
+    def report(self, result):
+        debugger, system = self.debugger, self.debugger.system
+        for hit in debugger.hits:
+            if isinstance(hit.watch, str):
+                self.say(f'watch {hit.watch}: {hit.old:#x} -> {hit.new:#x}')
+            else:
+                address, length = hit.watch
+                self.say(f'watch {address:#x} ({length} bytes) written by the instruction at {hit.pc:#x}: '
+                         f'{hit.old.hex()} -> {hit.new.hex()}')
+        if result.reason is StopReason.BREAKPOINT:
+            self.say(f'breakpoint at {system.program_counter:#x}')
+        elif result.reason is StopReason.HALT:
+            self.say(f'halted after {debugger.steps} instructions')
+        elif result.reason is StopReason.FAULT:
+            self.say(f'stopped with status {system.status.name}{system.fault_description()}')
+        self.say('\n'.join(debugger.disassemble(system.program_counter, 1)))
+
+    def running(self):
+        status = self.debugger.system.status
+        if status is not Status.AOK:
+            self.say(f'the program has stopped with status {status.name}')
+        return status is Status.AOK
+
+    def do_step(self, arg):
+        """step [N]: execute N instructions, 1 if not given, stopping early at breakpoints and watches."""
+        if self.running():
+            self.report(self.debugger.run(int(arg, 0) if arg else 1))
+
+    def do_continue(self, arg):
+        """continue: run until the program stops or a breakpoint or watch is hit."""
+        if self.running():
+            self.report(self.debugger.run())
+
+    def do_break(self, arg):
+        """break [LOCATION]: stop before the instruction at a label or address. Lists breakpoints if not given one."""
+        if not arg:
+            for address in sorted(self.debugger.breakpoints):
+                label = self.debugger.names.get(address)
+                self.say(f'{address:#x}' + (f' ({label})' if label else ''))
+            return
+        self.say(f'breakpoint at {self.debugger.add_breakpoint(arg):#x}')
+
+    def do_delete(self, arg):
+        """delete LOCATION: remove the breakpoint at a label or address."""
+        self.debugger.remove_breakpoint(arg)
+
+    def do_watch(self, arg):
+        """watch [%REG | LOCATION [LENGTH]]: stop when a register changes or when LENGTH bytes of memory (8 if not
+        given) from a label or address are written. Lists watches if not given anything."""
+        if not arg:
+            for index, value in sorted(self.debugger.register_watches.items()):
+                self.say(f'{REGISTER_NAMES[index]} = {value:#x}')
+            for (address, length), data in sorted(self.debugger.memory_watches.items()):
+                self.say(f'{address:#x} ({length} bytes) = {data.hex()}')
+            return
+        target, *length = arg.split()
+        self.debugger.watch(target, int(length[0], 0) if length else 8)
+
+    def do_unwatch(self, arg):
+        """unwatch %REG | LOCATION: stop watching a register, or the memory watched from a label or address."""
+        self.debugger.unwatch(arg)
+
+    def do_print(self, arg):
+        """print [%REG | LOCATION [LENGTH]]: show a register, or LENGTH bytes of memory (8 if not given) from a label or
+        address. Shows the flags, program counter, registers and status if not given anything."""
+        system = self.debugger.system
+        if not arg:
+            system.pprint(self.stdout)
+        elif arg in REGISTER_INDEX:
+            value = system.registers[REGISTER_INDEX[arg]]
+            self.say(f'{arg} = {value:#x} ({Memory.to_signed(value)})')
+        else:
+            location, *length = arg.split()
+            address = self.debugger.address_of(location)
+            if length:
+                self.say(bytes(system.mem.load(address, int(length[0], 0))).hex(' '))
+            else:
+                value = system.mem.read(address)
+                self.say(f'[{address:#x}] = {value:#x} ({Memory.to_signed(value)})')
+
+    def do_memory(self, arg):
+        """memory: show every row of memory which isn't all zeroes."""
+        self.debugger.system.mem.pprint(self.stdout)
+
+    def do_disassemble(self, arg):
+        """disassemble [LOCATION [COUNT]]: show COUNT instructions from a label or address, or those around the program
+        counter if not given one."""
+        location, *count = arg.split() or [None]
+        self.say('\n'.join(self.debugger.disassemble(location, int(count[0], 0) if count else None)))
+
+    def do_quit(self, arg):
+        """quit: stop debugging."""
+        return True
+
+    def do_EOF(self, arg):
+        self.say('')
+        return True
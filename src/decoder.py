@@ -0,0 +1,137 @@
+"""
+This module decodes Y86_64 machine code into records that can be executed without touching memory again, and provides
+a cache of those records keyed by program counter.
+"""
+from collections import namedtuple
+
+from memory import Memory
+
+# Length in bytes of an instruction, indexed by icode. Invalid icodes are treated as one byte long.
+ICODE_SIZE = (1, 1, 2, 10, 10, 10, 2, 9, 9, 1, 2, 2, 1, 1, 1, 1)
+# The longest instruction in the ISA, which bounds how far back a memory write can reach into a cached instruction.
+MAX_INS_SIZE = 10
+
+# Whether jxx and cmovxx go ahead, indexed by ifun and then by the flags packed by pack_flags.
+CONDITION_TABLE = tuple(
+    tuple(bool(cond(of=bits & 1, sf=bits >> 1 & 1, zf=bits >> 2 & 1)) for bits in range(8))
+    for cond in (lambda of, sf, zf: True,
+                 lambda of, sf, zf: zf or sf != of,
+                 lambda of, sf, zf: sf != of,
+                 lambda of, sf, zf: zf,
+                 lambda of, sf, zf: not zf,
+                 lambda of, sf, zf: zf or sf == of,
+                 lambda of, sf, zf: not zf and sf == of))
+
+Decoded = namedtuple('Decoded', ['icode', 'ifun', 'reg_a', 'reg_b', 'value', 'next_pc'])
+
+
+def pack_flags(overflow_flag, sign_flag, zero_flag):
+    """
+    :return: The three condition codes packed into an int from 0 to 7, for indexing CONDITION_TABLE.
+    """
+    return overflow_flag | sign_flag << 1 | zero_flag << 2
+
+
+def decode(mem, address):
+    """
+    Decodes the instruction starting at address.
+
+    :param mem: A Memory object holding the program
+    :param address: Address of the first byte of the instruction
+    :return: A Decoded record. value holds the immediate, displacement or destination of the instruction, or 0 if it
+             has none. next_pc is the address of the following instruction in memory.
+    """
+    first = mem.main[address]
+    icode = (first & 0xf0) >> 4
+    ifun = first & 0xf
+    size = ICODE_SIZE[icode]
+    reg_a, reg_b, value = 0xf, 0xf, 0
+    if size in (2, 10):
+        registers = mem.main[address + 1]
+        reg_a = (registers & 0xf0) >> 4
+        reg_b = registers & 0xf
+    # Memory.read rather than mem.read, so that a data cache attached to mem doesn't count instruction fetches.
+    if size == 10:
+        value = Memory.read(mem, address + 2)
+    elif size == 9:
+        value = Memory.read(mem, address + 1)
+    return Decoded(icode, ifun, reg_a, reg_b, value, address + size)
+
+
+def uses_missing_register(ins):
+    """
+    :param ins: A Decoded instruction
+    :return: True if ins names register 0xf in an operand it uses, which makes it an invalid instruction since there
+             are only 15 registers.
+    """
+    icode = ins.icode
+    if icode in (2, 4, 5, 6):
+        return ins.reg_a == 0xf or ins.reg_b == 0xf
+    if icode == 3:
+        return ins.reg_b == 0xf
+    if icode in (10, 11):
+        return ins.reg_a == 0xf
+    return False
+
+
+class DecodeCache:
+    """
+    Maps program counters to already decoded instructions. The cache registers itself as a write observer on memory so
+    that any write overlapping a cached instruction throws that instruction away.
+    """
+    def __init__(self, mem=None, reach=MAX_INS_SIZE):
+        """
+        :param mem: Memory to observe writes to, or None
+        :param reach: Size in bytes of the largest record that will be inserted
+        """
+        self.entries = {}
+        self.reach = reach
+        # Every cached instruction lies within [low, high), so writes outside of it can be ignored cheaply.
+        self.low = 0
+        self.high = 0
+        self.mem = mem
+        if mem is not None:
+            mem.write_observers.append(self.invalidate)
+
+    def close(self):
+        """
+        Stops observing writes to memory. The cache must not be used afterwards, since it would no longer be kept up to
+        date.
+        """
+        if self.mem is not None:
+            self.mem.write_observers.remove(self.invalidate)
+            self.mem = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def insert(self, address, size, record):
+        """
+        :param address: Address of the decoded instruction
+        :param size: Length of the instruction in bytes
+        :param record: Whatever the caller wants returned on a later lookup of address
+        """
+        if not self.entries:
+            self.low, self.high = address, address + size
+        else:
+            self.low = min(self.low, address)
+            self.high = max(self.high, address + size)
+        self.entries[address] = record
+
+    def invalidate(self, address, length):
+        """
+        Drops every cached instruction with a byte in [address, address + length).
+
+        :param address: First address written to
+        :param length: Number of bytes written
+        """
+        end = address + length
+        if end <= self.low or address >= self.high:
+            return
+        entries = self.entries
+        for start in range(max(address - self.reach + 1, self.low), min(end, self.high)):
+            entries.pop(start, None)
+
+    def clear(self):
+        self.entries.clear()
+        self.low = self.high = 0
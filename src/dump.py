@@ -0,0 +1,142 @@
+"""
+This module writes the contents of memory to files, leaving out everything uninteresting.
+
+Memory is looked at in 8 byte rows, and a dump holds only the rows which are non zero, or with modified_only, which
+differ from the baseline taken by Memory.clean. Only allocated pages, or only dirty ones, are ever looked at, so the cost
+of a dump follows how much memory a program touched rather than the size of the address space. Dumps are written to the
+file a chunk at a time as rows are found.
+
+Formats are:
+
+    text        rows as python lists, as final_memory_state.txt has always held, under a '# 0x...' line giving the
+                address wherever a run of rows starts
+    hexdump     16 bytes per line with the address, hex bytes and printable characters
+    binary      b'Y86M', the memory size (u64, with 0 meaning 2^64), then for each run its address and length (u64
+                each) followed by its bytes
+    json        {"size": ..., "ranges": [{"address": ..., "hex": "..."}, ...]}
+"""
+import json
+import struct
+
+from memory import WORD_MASK
+
+FORMATS = ('text', 'hexdump', 'binary', 'json')
+ROW = 8
+# Runs of rows are split at this many bytes, and text is written out whenever this many characters have built up.
+CHUNK_SIZE = 1 << 16
+MAGIC = b'Y86M'
+BINARY_HEADER = struct.Struct('<4sQ')
+BINARY_RANGE = struct.Struct('<QQ')
+
+
+def ranges(mem, modified_only=False):
+    """
+    :param mem: A Memory object
+    :param modified_only: If True, only rows which differ from mem's baseline are included, zero or not
+    :return: A generator of (address, bytes) runs of rows, in order of address, none longer than CHUNK_SIZE
+    """
+    numbers = mem.dirty if modified_only else mem.page_numbers()
+    blank = bytes(mem.page_size)
+    start, run = None, bytearray()
+    for number in sorted(numbers):
+        page = mem.lookup(number) or blank
+        base = mem.baseline.get(number, blank) if modified_only else blank
+        if page == base:
+            continue
+        address = number << mem.page_bits
+        for offset in range(0, mem.page_size, ROW):
+            row = page[offset:offset + ROW]
+            if row == base[offset:offset + ROW]:
+                continue
+            if start is not None and (start + len(run) != address + offset or len(run) >= CHUNK_SIZE):
+                yield start, bytes(run)
+                start = None
+            if start is None:
+                start, run = address + offset, bytearray()
+            run += row
+    if start is not None:
+        yield start, bytes(run)
+
+
+class _Buffered:
+    """
+    Collects small strings and writes them to a file in large pieces.
+    """
+    def __init__(self, file):
+        self.file = file
+        self.parts = []
+        self.length = 0
+
+    def write(self, text):
+        self.parts.append(text)
+        self.length += len(text)
+        if self.length >= CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        self.file.write(''.join(self.parts))
+        self.parts = []
+        self.length = 0
+
+
+def write_text(runs, file):
+    out = _Buffered(file)
+    end = None
+    for address, data in runs:
+        if address != end:
+            out.write(f'# {address:#x}\n')
+        for offset in range(0, len(data), ROW):
+            out.write(str(list(data[offset:offset + ROW])) + '\n')
+        end = address + len(data)
+    out.flush()
+
+
+def write_hexdump(runs, file):
+    out = _Buffered(file)
+    for address, data in runs:
+        for offset in range(0, len(data), 16):
+            line = data[offset:offset + 16]
+            hex_bytes = ' '.join(f'{byte:02x}' for byte in line[:8])
+            if len(line) > 8:
+                hex_bytes += '  ' + ' '.join(f'{byte:02x}' for byte in line[8:])
+            text = ''.join(chr(byte) if 32 <= byte < 127 else '.' for byte in line)
+            out.write(f'{address + offset:016x}  {hex_bytes:<48}  |{text}|\n')
+    out.flush()
+
+
+def write_binary(runs, file, size):
+    file.write(BINARY_HEADER.pack(MAGIC, size & WORD_MASK))
+    for address, data in runs:
+        file.write(BINARY_RANGE.pack(address, len(data)))
+        file.write(data)
+
+
+def write_json(runs, file, size):
+    file.write(f'{{"size": {size}, "ranges": [')
+    separator = ''
+    for address, data in runs:
+        file.write(separator + json.dumps({'address': address, 'hex': data.hex()}))
+        separator = ', '
+    file.write(']}\n')
+
+
+def dump(mem, file, format='text', modified_only=False):
+    """
+    Writes the interesting parts of memory to a file.
+
+    :param mem: A Memory object
+    :param file: A file open for writing, in binary mode for the binary format and text mode otherwise
+    :param format: One of FORMATS
+    :param modified_only: If True, dump rows which changed since mem.clean was called rather than non zero rows
+    """
+    runs = ranges(mem, modified_only)
+    if format == 'text':
+        write_text(runs, file)
+    elif format == 'hexdump':
+        write_hexdump(runs, file)
+    elif format == 'binary':
+        write_binary(runs, file, mem.size)
+    elif format == 'json':
+        write_json(runs, file, mem.size)
+    else:
+        raise ValueError(f'Unknown dump format {format}, expected one of {", ".join(FORMATS)}')
@@ -0,0 +1,544 @@
+"""
+This module defines the execution engines a System can be run with, so the way instructions are carried out can be
+chosen without touching the code which loads programs or reports on them.
+
+Every engine is made from a System and offers step() and run(), with run() taking the same limits as System.run_until
+and returning a RunResult. Engines only ever change the state of their System, so a System can be handed from one engine
+to another part way through a program. Engines which cache what they decode watch writes to memory to keep their caches
+up to date, so an engine should be closed once it is done with, or every later write goes on paying for it.
+
+    reference   System.step and System.run_until, the behaviour every other engine has to match
+    table       decoded instructions dispatched through a table of handlers indexed by icode and ifun, with jxx and
+                cmovxx deciding through rows of decoder.CONDITION_TABLE instead of a chain of comparisons
+    fused       the table engine, with common pairs of instructions such as subq followed by jne carried out by a
+                single handler
+    compiled    compiler.BlockEngine, which runs whole basic blocks translated into python functions, falling back to
+                System.run_until when there are breakpoints or a stop condition to check between instructions, or when
+                a cache.DataCache needs to see the program counter of each access
+"""
+import sys
+
+import compiler
+import decoder
+from memory import AddressError, WORD_MASK
+from system import Status, StopReason, RunResult
+
+
+class Engine:
+    """
+    Carries out the instructions of one System.
+    """
+    name = None
+
+    def __init__(self, system):
+        self.system = system
+
+    def step(self):
+        """
+        Executes the instruction pointed to by the program counter.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Stops the engine watching its System, so another engine can take it over. The engine must not be used
+        afterwards.
+        """
+
+    def run(self, max_steps=None, breakpoints=None, stop_on=None):
+        """
+        :param max_steps: Most instructions to execute, or None for no limit
+        :param breakpoints: A set of addresses, as for System.run_until
+        :param stop_on: A callable taking the System, as for System.run_until
+        :return: A RunResult
+        """
+        raise NotImplementedError
+
+
+class ReferenceEngine(Engine):
+    """
+    Runs a System with its own methods.
+    """
+    name = 'reference'
+
+    def step(self):
+        self.system.step()
+
+    def run(self, max_steps=None, breakpoints=None, stop_on=None):
+        return self.system.run_until(max_steps, breakpoints, stop_on)
+
+
+# Handlers for the table engine. Each takes the System and the fields of a decoder.Decoded instruction after icode and
+# ifun, and like the methods of System only moves the program counter once the instruction can no longer fault.
+
+def _halt(system, reg_a, reg_b, value, next_pc):
+    system.status = Status.HLT
+
+
+def _nop(system, reg_a, reg_b, value, next_pc):
+    system.program_counter = next_pc
+
+
+def _invalid(system, reg_a, reg_b, value, next_pc):
+    system.status = Status.INS
+
+
+def _rrmovq(system, reg_a, reg_b, value, next_pc):
+    registers = system.registers
+    registers[reg_b] = registers[reg_a]
+    system.program_counter = next_pc
+
+
+def _cmovxx(condition):
+    """
+    :param condition: A row of decoder.CONDITION_TABLE
+    :return: A handler which moves when condition holds for the flags
+    """
+    def handler(system, reg_a, reg_b, value, next_pc):
+        if system._alu is not None:
+            system._settle()
+        if condition[system._overflow_flag | system._sign_flag << 1 | system._zero_flag << 2]:
+            registers = system.registers
+            registers[reg_b] = registers[reg_a]
+        system.program_counter = next_pc
+    return handler
+
+
+def _irmovq(system, reg_a, reg_b, value, next_pc):
+    system.registers[reg_b] = value
+    system.program_counter = next_pc
+
+
+def _rmmovq(system, reg_a, reg_b, value, next_pc):
+    registers = system.registers
+    system.mem.write(registers[reg_a], (registers[reg_b] + value) & WORD_MASK)
+    system.program_counter = next_pc
+
+
+def _mrmovq(system, reg_a, reg_b, value, next_pc):
+    registers = system.registers
+    registers[reg_a] = system.mem.read((registers[reg_b] + value) & WORD_MASK)
+    system.program_counter = next_pc
+
+
+def _bin_op(op_code):
+    """
+    :param op_code: The ifun of addq, subq, andq or xorq
+    :return: A handler carrying out that operation
+    """
+    def handler(system, reg_a, reg_b, value, next_pc):
+        registers = system.registers
+        src_val, dest_val = registers[reg_a], registers[reg_b]
+        if op_code == 0:
+            result = (dest_val + src_val) & WORD_MASK
+        elif op_code == 1:
+            result = (dest_val - src_val) & WORD_MASK
+        elif op_code == 2:
+            result = src_val & dest_val
+        else:
+            result = src_val ^ dest_val
+        registers[reg_b] = result
+        system._alu = (op_code, dest_val, src_val, result)
+        system.program_counter = next_pc
+    return handler
+
+
+def _jmp(system, reg_a, reg_b, value, next_pc):
+    system.program_counter = value
+
+
+def _jxx(condition):
+    """
+    :param condition: A row of decoder.CONDITION_TABLE
+    :return: A handler which jumps when condition holds for the flags
+    """
+    def handler(system, reg_a, reg_b, value, next_pc):
+        if system._alu is not None:
+            system._settle()
+        if condition[system._overflow_flag | system._sign_flag << 1 | system._zero_flag << 2]:
+            system.program_counter = value
+        else:
+            system.program_counter = next_pc
+    return handler
+
+
+def _call(system, reg_a, reg_b, value, next_pc):
+    registers = system.registers
+    registers[4] = (registers[4] - 8) & WORD_MASK
+    system.mem.write(next_pc, registers[4])
+    system.program_counter = value
+
+
+def _ret(system, reg_a, reg_b, value, next_pc):
+    registers = system.registers
+    address = system.mem.read(registers[4])
+    registers[4] = (registers[4] + 8) & WORD_MASK
+    system.program_counter = address
+
+
+def _pushq(system, reg_a, reg_b, value, next_pc):
+    # As in System.pushq, the stack pointer has already moved if the write faults.
+    registers = system.registers
+    registers[4] = (registers[4] - 8) & WORD_MASK
+    system.mem.write(registers[reg_a], registers[4])
+    system.program_counter = next_pc
+
+
+def _popq(system, reg_a, reg_b, value, next_pc):
+    registers = system.registers
+    registers[reg_a] = system.mem.read(registers[4])
+    registers[4] = (registers[4] + 8) & WORD_MASK
+    system.program_counter = next_pc
+
+
+# Handlers indexed by icode and then by ifun. Codes missing from the table are invalid instructions.
+HANDLERS = ((_halt,), (_nop,), (_rrmovq,) + tuple(_cmovxx(row) for row in decoder.CONDITION_TABLE[1:]), (_irmovq,),
+            (_rmmovq,), (_mrmovq,), tuple(_bin_op(op_code) for op_code in range(4)),
+            (_jmp,) + tuple(_jxx(row) for row in decoder.CONDITION_TABLE[1:]), (_call,), (_ret,), (_pushq,), (_popq,))
+
+
+def handler_for(ins):
+    """
+    :param ins: A decoder.Decoded instruction
+    :return: The handler in HANDLERS for ins, or _invalid if it has an invalid code or names register 0xf
+    """
+    icode, ifun = ins.icode, ins.ifun
+    if icode < len(HANDLERS) and ifun < len(HANDLERS[icode]) and not decoder.uses_missing_register(ins):
+        return HANDLERS[icode][ifun]
+    return _invalid
+
+
+class TableEngine(Engine):
+    """
+    Runs a System by looking up a handler for each instruction in HANDLERS. Decoded instructions are kept in a
+    decoder.DecodeCache of the engine's own, along with their handler.
+    """
+    name = 'table'
+
+    def __init__(self, system):
+        super().__init__(system)
+        self.decode_cache = decoder.DecodeCache(system.mem)
+
+    def close(self):
+        self.decode_cache.close()
+
+    def fetch(self):
+        """
+        :return: A 2-tuple of the handler for the instruction at the program counter and the arguments to call it with
+        """
+        pc = self.system.program_counter
+        try:
+            return self.decode_cache.entries[pc]
+        except KeyError:
+            ins = decoder.decode(self.system.mem, pc)
+            record = (handler_for(ins), (self.system, ins.reg_a, ins.reg_b, ins.value, ins.next_pc))
+            self.decode_cache.insert(pc, ins.next_pc - pc, record)
+            return record
+
+    def step(self):
+        system = self.system
+        try:
+            handler, args = self.fetch()
+            handler(*args)
+        except AddressError as fault:
+            system.address_fault(fault.address)
+
+    def run(self, max_steps=None, breakpoints=None, stop_on=None):
+        system = self.system
+        budget = sys.maxsize if max_steps is None else max_steps
+        steps = 0
+        entries = self.decode_cache.entries
+        fetch = self.fetch
+        aok = Status.AOK
+        reason = None
+        try:
+            if not breakpoints and stop_on is None:
+                while system.status is aok and steps < budget:
+                    steps += 1
+                    try:
+                        handler, args = entries[system.program_counter]
+                    except KeyError:
+                        handler, args = fetch()
+                    handler(*args)
+            else:
+                while system.status is aok and steps < budget:
+                    if steps and breakpoints and system.program_counter in breakpoints:
+                        reason = StopReason.BREAKPOINT
+                        break
+                    steps += 1
+                    handler, args = fetch()
+                    handler(*args)
+                    if stop_on is not None and stop_on(system):
+                        reason = StopReason.CONDITION
+                        break
+        except AddressError as fault:
+            system.address_fault(fault.address)
+
+        if system.status == Status.HLT:
+            reason = StopReason.HALT
+        elif system.status != aok:
+            reason = StopReason.FAULT
+        elif reason is None:
+            reason = StopReason.BUDGET
+        return RunResult(steps, system.status, reason)
+
+
+# Fused handlers for the fused engine. Each carries out a pair of instructions, can only fault in the first of them, and
+# returns how many instructions it executed after the first.
+
+# The result of each of addq, subq, andq and xorq given the destination and source values.
+ALU = (lambda dest_val, src_val: (dest_val + src_val) & WORD_MASK,
+       lambda dest_val, src_val: (dest_val - src_val) & WORD_MASK,
+       lambda dest_val, src_val: src_val & dest_val,
+       lambda dest_val, src_val: src_val ^ dest_val)
+
+
+def _fused_irmovq_op(op_code):
+    """
+    :return: A handler for irmovq followed by the opq with op_code, as in irmovq $8, %r8; addq %r8, %rsp
+    """
+    alu = ALU[op_code]
+
+    def handler(system, reg, value, reg_a, reg_b, next_pc):
+        registers = system.registers
+        registers[reg] = value
+        src_val, dest_val = registers[reg_a], registers[reg_b]
+        result = registers[reg_b] = alu(dest_val, src_val)
+        system._alu = (op_code, dest_val, src_val, result)
+        system.program_counter = next_pc
+        return 1
+    return handler
+
+
+def _fused_mrmovq_op(op_code):
+    """
+    :return: A handler for mrmovq followed by the opq with op_code, as in mrmovq 0(%rdi), %r10; addq %r10, %rax
+    """
+    alu = ALU[op_code]
+
+    def handler(system, reg, base, displacement, reg_a, reg_b, next_pc):
+        registers = system.registers
+        registers[reg] = system.mem.read((registers[base] + displacement) & WORD_MASK)
+        src_val, dest_val = registers[reg_a], registers[reg_b]
+        result = registers[reg_b] = alu(dest_val, src_val)
+        system._alu = (op_code, dest_val, src_val, result)
+        system.program_counter = next_pc
+        return 1
+    return handler
+
+
+def _fused_op_jxx(op_code, ifun):
+    """
+    :return: A handler for the opq with op_code followed by the jxx with ifun, as in subq %rsi, %rcx; jne loop
+    """
+    alu = ALU[op_code]
+    condition = decoder.CONDITION_TABLE[ifun]
+
+    def handler(system, reg_a, reg_b, target, next_pc):
+        registers = system.registers
+        src_val, dest_val = registers[reg_a], registers[reg_b]
+        result = registers[reg_b] = alu(dest_val, src_val)
+        system._alu = (op_code, dest_val, src_val, result)
+        if ifun == 3 or ifun == 4:
+            # je and jne only need the zero flag, which leaves the others to be settled lazily.
+            taken = (result == 0) == (ifun == 3)
+        else:
+            system._settle()
+            taken = condition[system._overflow_flag | system._sign_flag << 1 | system._zero_flag << 2]
+        system.program_counter = target if taken else next_pc
+        return 1
+    return handler
+
+
+def _fused_pushq_popq(system, reg_a, reg_b, start, next_pc):
+    """
+    Carries out pushq followed by popq, as in pushq %rbx; popq %rcx.
+    """
+    registers = system.registers
+    address = registers[4] = (registers[4] - 8) & WORD_MASK
+    system.mem.write(registers[reg_a], address)
+    if address < next_pc and start < address + 8:
+        # The push wrote over the pair, so the popq has to be decoded again from memory.
+        system.program_counter = start + 2
+        return 0
+    registers[reg_b] = system.mem.read(address)
+    registers[4] = (registers[4] + 8) & WORD_MASK
+    system.program_counter = next_pc
+    return 1
+
+
+def _fuse(first, second, start):
+    """
+    :param first: A decoder.Decoded instruction at start
+    :param second: The decoder.Decoded instruction following it
+    :return: A 3-tuple of a fused handler for the pair, the arguments to call it with besides the System, and whether
+             memory is written before the last instruction of the pair, or None if the pair can't be fused
+    """
+    pair = (first.icode, second.icode)
+    if second.icode == 6 and second.ifun < 4 and second.reg_a < 0xf and second.reg_b < 0xf:
+        if pair == (3, 6) and first.ifun == 0 and first.reg_b < 0xf:
+            return _FUSED_IRMOVQ_OP[second.ifun], (first.reg_b, first.value, second.reg_a, second.reg_b,
+                                                   second.next_pc), False
+        if pair == (5, 6) and first.ifun == 0 and first.reg_a < 0xf and first.reg_b < 0xf:
+            return _FUSED_MRMOVQ_OP[second.ifun], (first.reg_a, first.reg_b, first.value, second.reg_a, second.reg_b,
+                                                   second.next_pc), False
+    if pair == (6, 7) and first.ifun < 4 and second.ifun < 7 and first.reg_a < 0xf and first.reg_b < 0xf:
+        return _FUSED_OP_JXX[first.ifun][second.ifun], (first.reg_a, first.reg_b, second.value, second.next_pc), False
+    if pair == (0xa, 0xb) and first.ifun == 0 and second.ifun == 0 and first.reg_a < 0xf and second.reg_a < 0xf:
+        return _fused_pushq_popq, (first.reg_a, second.reg_a, start, second.next_pc), True
+    return None
+
+
+_FUSED_IRMOVQ_OP = tuple(_fused_irmovq_op(op_code) for op_code in range(4))
+_FUSED_MRMOVQ_OP = tuple(_fused_mrmovq_op(op_code) for op_code in range(4))
+_FUSED_OP_JXX = tuple(tuple(_fused_op_jxx(op_code, ifun) for ifun in range(7)) for op_code in range(4))
+# Longest pair fuse can return, in bytes: irmovq or mrmovq followed by an opq.
+MAX_FUSED_SIZE = 12
+
+
+class FusedEngine(TableEngine):
+    """
+    Runs a System like the table engine, except that common pairs of instructions are fused into a single handler:
+    irmovq or mrmovq followed by an opq, an opq followed by a jxx, and pushq followed by popq. Fused pairs are kept in a
+    decoder.DecodeCache of their own, so a write to either instruction of a pair throws the pair away.
+
+    Instructions are executed one at a time instead whenever a pair would cross a breakpoint or run past max_steps, and
+    throughout any run with a stop_on callable, so that nothing observable differs from the table engine.
+    """
+    name = 'fused'
+
+    def __init__(self, system):
+        super().__init__(system)
+        self.fused_cache = decoder.DecodeCache(system.mem, MAX_FUSED_SIZE)
+
+    def close(self):
+        super().close()
+        self.fused_cache.close()
+
+    def fetch_fused(self):
+        """
+        :return: A 5-tuple of a handler for the instruction or pair at the program counter, the arguments to call it
+                 with, how many instructions it executes, the addresses of instructions inside it which a breakpoint
+                 would need to stop at, and whether it writes memory before its last instruction
+        """
+        pc = self.system.program_counter
+        try:
+            return self.fused_cache.entries[pc]
+        except KeyError:
+            pass
+        handler, args = self.fetch()
+        next_pc = args[4]
+        record = (handler, args, 1, frozenset(), False)
+        mem = self.system.mem
+        if 0 <= next_pc < mem.size:
+            first = decoder.decode(mem, pc)
+            try:
+                second = decoder.decode(mem, next_pc)
+            except AddressError:
+                second = None
+            fused = second and _fuse(first, second, pc)
+            if fused is not None:
+                handler, args, writes = fused
+                record = (handler, (self.system,) + args, 2, frozenset((next_pc,)), writes)
+        self.fused_cache.insert(pc, record[1][-1] - pc, record)
+        return record
+
+    def run(self, max_steps=None, breakpoints=None, stop_on=None):
+        if stop_on is not None:
+            # stop_on has to see the System after every instruction.
+            return super().run(max_steps, breakpoints, stop_on)
+        system = self.system
+        budget = sys.maxsize if max_steps is None else max_steps
+        steps = 0
+        entries = self.fused_cache.entries
+        fetch = self.fetch
+        fetch_fused = self.fetch_fused
+        aok = Status.AOK
+        reason = None
+        try:
+            if not breakpoints:
+                while system.status is aok and steps < budget:
+                    try:
+                        handler, args, count, inside, writes = entries[system.program_counter]
+                    except KeyError:
+                        handler, args, count, inside, writes = fetch_fused()
+                    if count > budget - steps:
+                        handler, args = fetch()
+                    # Faults only happen in the first instruction, which has to be counted either way.
+                    steps += 1
+                    executed = handler(*args)
+                    if executed:
+                        steps += executed
+            else:
+                while system.status is aok and steps < budget:
+                    if steps and system.program_counter in breakpoints:
+                        reason = StopReason.BREAKPOINT
+                        break
+                    handler, args, count, inside, writes = fetch_fused()
+                    # A write part way through a pair could add a breakpoint inside it, as Debugger watches do.
+                    if count > budget - steps or writes or not breakpoints.isdisjoint(inside):
+                        handler, args = fetch()
+                    steps += 1
+                    executed = handler(*args)
+                    if executed:
+                        steps += executed
+        except AddressError as fault:
+            system.address_fault(fault.address)
+
+        if system.status == Status.HLT:
+            reason = StopReason.HALT
+        elif system.status != aok:
+            reason = StopReason.FAULT
+        elif reason is None:
+            reason = StopReason.BUDGET
+        return RunResult(steps, system.status, reason)
+
+
+class CompiledEngine(Engine):
+    """
+    Runs a System through a compiler.BlockEngine. Blocks run to their end once started, so single instructions are
+    executed by System whenever run is given breakpoints or stop_on. Blocks also only bring the program counter up to
+    date as they leave, so System executes single instructions too while the methods of the system's Memory are
+    shadowed, as cache.DataCache does to attribute each access to the instruction making it.
+    """
+    name = 'compiled'
+
+    def __init__(self, system):
+        super().__init__(system)
+        self.block_engine = compiler.BlockEngine(system)
+
+    def close(self):
+        self.block_engine.close()
+
+    def step(self):
+        self.system.step()
+
+    def run(self, max_steps=None, breakpoints=None, stop_on=None):
+        system = self.system
+        if breakpoints or stop_on is not None or 'read' in vars(system.mem) or 'write' in vars(system.mem):
+            return system.run_until(max_steps, breakpoints, stop_on)
+        steps = self.block_engine.run(max_steps)
+        if system.status == Status.HLT:
+            reason = StopReason.HALT
+        elif system.status != Status.AOK:
+            reason = StopReason.FAULT
+        else:
+            reason = StopReason.BUDGET
+        return RunResult(steps, system.status, reason)
+
+
+ENGINES = {engine.name: engine for engine in (ReferenceEngine, TableEngine, FusedEngine, CompiledEngine)}
+DEFAULT_ENGINE = 'reference'
+
+
+def create(name, system):
+    """
+    :param name: One of the keys of ENGINES
+    :param system: The System the engine is to run
+    :return: An Engine
+    """
+    try:
+        engine = ENGINES[name]
+    except KeyError:
+        raise ValueError(f'Unknown engine {name}, expected one of {", ".join(ENGINES)}') from None
+    return engine(system)
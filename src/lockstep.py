@@ -0,0 +1,252 @@
+"""
+This module runs many copies of one Y86_64 system side by side with NumPy. Each copy, or lane, has its own registers,
+flags, program counter, status and memory, held as rows of arrays. Every step decodes the instruction at each lane's
+program counter, groups lanes by the kind of instruction they are about to run, and carries out each group with masked
+array operations, so lanes whose program counters diverge keep running together.
+
+NumPy is an optional dependency, only needed by this module.
+"""
+import decoder
+from system import System, Status
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+# Zero bytes past the end of each lane's memory, so that decoding near the end never indexes out of the array.
+PADDING = 16
+STATUS = {status.value: status for status in Status}
+
+
+def _conditions(zf, sf, of):
+    """
+    :return: An array of shape (7, lanes) holding the outcome of each jxx / cmovxx condition, indexed by ifun.
+    """
+    lt = sf != of
+    return np.stack([np.ones_like(zf), zf | lt, lt, zf, ~zf, zf | ~lt, ~zf & ~lt])
+
+
+class LockstepEngine:
+    """
+    Runs lanes copies of a System in lockstep. Registers are an (lanes, 15) uint64 array, memory is a (lanes, size)
+    uint8 array, and flags are boolean vectors. Set per lane registers and memory before calling run.
+
+    Values behave as in System, with registers, addresses and the stack pointer all wrapping around at 2^64.
+    Instructions naming register 0xf where a register is used stop their lane with Status.INS, as they do in System.
+    """
+    def __init__(self, system, lanes):
+        """
+        :param system: A System to copy into every lane, usually one a program has just been loaded into
+        :param lanes: Number of copies to run
+        """
+        if np is None:
+            raise ImportError('LockstepEngine requires numpy')
+        self.lanes = lanes
+        self.size = system.mem.size
+        image = np.frombuffer(bytes(system.mem.load(0, self.size)), dtype=np.uint8)
+        self.memory = np.zeros((lanes, self.size + PADDING), dtype=np.uint8)
+        self.memory[:, :self.size] = image
+        self.registers = np.tile(np.array(system.registers, dtype=np.uint64), (lanes, 1))
+        self.program_counter = np.full(lanes, system.program_counter, dtype=np.uint64)
+        self.status = np.full(lanes, system.status.value, dtype=np.int8)
+        self.overflow_flag = np.full(lanes, system.overflow_flag, dtype=bool)
+        self.sign_flag = np.full(lanes, system.sign_flag, dtype=bool)
+        self.zero_flag = np.full(lanes, system.zero_flag, dtype=bool)
+        # The address which set Status.ADR in each lane, as python ints.
+        self.fault_address = [None] * lanes
+        self.icode_size = np.array(decoder.ICODE_SIZE, dtype=np.uint64)
+        self.byte_offsets = np.arange(decoder.MAX_INS_SIZE, dtype=np.uint64)
+        self.word_offsets = np.arange(8, dtype=np.uint64)
+
+    def lane(self, index):
+        """
+        :param index: A lane number
+        :return: A new System holding the current state of that lane
+        """
+        system = System(self.size)
+        system.mem.store(0, self.memory[index, :self.size].tobytes())
+        system.registers = [int(value) for value in self.registers[index]]
+        system.program_counter = int(self.program_counter[index])
+        system.status = STATUS[int(self.status[index])]
+        system.overflow_flag = bool(self.overflow_flag[index])
+        system.sign_flag = bool(self.sign_flag[index])
+        system.zero_flag = bool(self.zero_flag[index])
+        system.fault_address = self.fault_address[index]
+        return system
+
+    def _fault(self, lanes, addresses):
+        self.status[lanes] = Status.ADR.value
+        for lane, address in zip(lanes.tolist(), addresses):
+            self.fault_address[lane] = int(address)
+
+    def _check(self, lanes, addresses):
+        """
+        Faults the lanes whose 8 byte access at addresses would leave memory.
+
+        :param addresses: Addresses as uint64, already wrapped around at 2^64
+        :return: A boolean mask over lanes of those which may go ahead.
+        """
+        bad = addresses > np.uint64(self.size - 8) if self.size >= 8 else np.ones(len(lanes), dtype=bool)
+        if bad.any():
+            self._fault(lanes[bad], addresses[bad].tolist())
+        return ~bad
+
+    def _read(self, lanes, addresses):
+        index = addresses[:, None] + self.word_offsets
+        return np.ascontiguousarray(self.memory[lanes[:, None], index]).view('<u8')[:, 0]
+
+    def _write(self, lanes, addresses, values):
+        index = addresses[:, None] + self.word_offsets
+        self.memory[lanes[:, None], index] = values.astype('<u8')[:, None].view(np.uint8)
+
+    def step(self):
+        """
+        Executes one instruction in every lane whose status is AOK.
+
+        :return: The number of lanes which attempted an instruction, faulting ones included
+        """
+        active = np.nonzero(self.status == Status.AOK.value)[0]
+        attempted = len(active)
+        if not attempted:
+            return 0
+        pc = self.program_counter[active]
+        size = self.size
+
+        # Lanes whose program counter is outside of memory fault on fetch. Everything else can gather its instruction
+        # bytes from the padded memory array.
+        outside = pc >= np.uint64(size)
+        if outside.any():
+            self._fault(active[outside], pc[outside])
+            active, pc = active[~outside], pc[~outside]
+        raw = self.memory[active[:, None], pc[:, None] + self.byte_offsets]
+        icode = raw[:, 0] >> 4
+        ifun = raw[:, 0] & 0xf
+        reg_a = (raw[:, 1] >> 4).astype(np.intp)
+        reg_b = (raw[:, 1] & 0xf).astype(np.intp)
+        ins_size = self.icode_size[icode]
+
+        # Instructions which run past the end of memory fault on the first byte that is missing, as decoder.decode does.
+        end = pc + ins_size
+        truncated = end > np.uint64(size)
+        if truncated.any():
+            first_missing = np.where(pc + np.uint64(1) >= np.uint64(size), pc + np.uint64(1),
+                                     np.where(ins_size == 9, pc + np.uint64(1), pc + np.uint64(2)))
+            self._fault(active[truncated], first_missing[truncated])
+            keep = ~truncated
+            active, pc, raw, icode, ifun, reg_a, reg_b, ins_size = (
+                active[keep], pc[keep], raw[keep], icode[keep], ifun[keep], reg_a[keep], reg_b[keep], ins_size[keep])
+
+        value = np.where(ins_size == 9, np.ascontiguousarray(raw[:, 1:9]).view('<u8')[:, 0],
+                         np.ascontiguousarray(raw[:, 2:10]).view('<u8')[:, 0])
+        conditions = _conditions(self.zero_flag[active], self.sign_flag[active], self.overflow_flag[active])
+        cond = conditions[np.minimum(ifun, 6), np.arange(len(active))]
+        regs = self.registers
+        next_pc = pc + ins_size
+
+        for code in np.unique(icode).tolist():
+            group = icode == code
+            lanes, ra, rb, val, fun = active[group], reg_a[group], reg_b[group], value[group], ifun[group]
+            npc = next_pc[group]
+            if code == 0:
+                self.status[lanes] = Status.HLT.value
+                continue
+            if code == 1:
+                self.program_counter[lanes] = npc
+                continue
+
+            # Invalid function codes and registers stop their lanes with Status.INS, leaving them untouched.
+            bad = np.zeros(len(lanes), dtype=bool)
+            if code in (2, 7):
+                bad |= fun > 6
+            if code == 6:
+                bad |= fun > 3
+            if code in (2, 4, 5, 6):
+                bad |= (ra > 14) | (rb > 14)
+            if code == 3:
+                bad |= rb > 14
+            if code in (10, 11):
+                bad |= ra > 14
+            if code > 11:
+                bad[:] = True
+            if bad.any():
+                self.status[lanes[bad]] = Status.INS.value
+                keep = ~bad
+                lanes, ra, rb, val, fun, npc = lanes[keep], ra[keep], rb[keep], val[keep], fun[keep], npc[keep]
+                group_cond = cond[group][keep]
+            else:
+                group_cond = cond[group]
+            if not len(lanes):
+                continue
+
+            if code == 2:
+                moving = group_cond
+                regs[lanes[moving], rb[moving]] = regs[lanes[moving], ra[moving]]
+                self.program_counter[lanes] = npc
+            elif code == 3:
+                regs[lanes, rb] = val
+                self.program_counter[lanes] = npc
+            elif code == 4:
+                address = regs[lanes, rb] + val
+                ok = self._check(lanes, address)
+                self._write(lanes[ok], address[ok], regs[lanes[ok], ra[ok]])
+                self.program_counter[lanes[ok]] = npc[ok]
+            elif code == 5:
+                address = regs[lanes, rb] + val
+                ok = self._check(lanes, address)
+                regs[lanes[ok], ra[ok]] = self._read(lanes[ok], address[ok])
+                self.program_counter[lanes[ok]] = npc[ok]
+            elif code == 6:
+                a, b = regs[lanes, rb], regs[lanes, ra]
+                add, sub, and_, xor = fun == 0, fun == 1, fun == 2, fun == 3
+                # Subtraction adds the two's complement negation of the source, as Memory.overflowing_sub does.
+                b = np.where(sub, np.uint64(0) - b, b)
+                result = np.where(add | sub, a + b, np.where(and_, a & b, a ^ b))
+                overflow = ((a ^ result) & (b ^ result)) >> np.uint64(63) == 1
+                regs[lanes, rb] = result
+                self.overflow_flag[lanes] = overflow & (add | sub)
+                self.sign_flag[lanes] = result >> np.uint64(63) == 1
+                self.zero_flag[lanes] = result == 0
+                self.program_counter[lanes] = npc
+            elif code == 7:
+                self.program_counter[lanes] = np.where(group_cond, val, npc)
+            elif code == 8:
+                regs[lanes, 4] -= np.uint64(8)
+                ok = self._check(lanes, regs[lanes, 4])
+                self._write(lanes[ok], regs[lanes[ok], 4], npc[ok])
+                self.program_counter[lanes[ok]] = val[ok]
+            elif code == 9:
+                ok = self._check(lanes, regs[lanes, 4])
+                lanes = lanes[ok]
+                self.program_counter[lanes] = self._read(lanes, regs[lanes, 4])
+                regs[lanes, 4] += np.uint64(8)
+            elif code == 10:
+                regs[lanes, 4] -= np.uint64(8)
+                ok = self._check(lanes, regs[lanes, 4])
+                lanes, ra, npc = lanes[ok], ra[ok], npc[ok]
+                self._write(lanes, regs[lanes, 4], regs[lanes, ra])
+                self.program_counter[lanes] = npc
+            elif code == 11:
+                ok = self._check(lanes, regs[lanes, 4])
+                lanes, ra, npc = lanes[ok], ra[ok], npc[ok]
+                regs[lanes, ra] = self._read(lanes, regs[lanes, 4])
+                regs[lanes, 4] += np.uint64(8)
+                self.program_counter[lanes] = npc
+        return attempted
+
+    def run(self, max_steps=None):
+        """
+        Steps every lane until none has status AOK or max_steps lockstep steps have been taken.
+
+        :param max_steps: Most steps to take, or None for no limit
+        :return: The total number of instructions executed over all lanes
+        """
+        executed = 0
+        steps = 0
+        while max_steps is None or steps < max_steps:
+            count = self.step()
+            if not count:
+                break
+            executed += count
+            steps += 1
+        return executed
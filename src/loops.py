@@ -0,0 +1,113 @@
+"""
+This module tells programs which are stuck apart from programs which are merely slow. A LoopDetector saves the state of
+a System and runs it with a breakpoint on the saved program counter, since the state can only come round again there,
+comparing the whole state each time the breakpoint is reached. A program whose registers, program counter, flags and
+memory are exactly as they were some number of instructions ago will repeat those instructions forever.
+
+Memory is compared through Memory.fingerprint, which writes keep up to date, so each check costs the same however much
+memory there is. The saved state is replaced as in Brent's cycle detection algorithm, at the end of windows of
+instructions which double in length each time, so a loop is found within a few times its own length of entering it,
+whatever that length is, without keeping more than one state.
+"""
+import sys
+from collections import namedtuple
+
+import engines
+from system import StopReason, RunResult
+
+# Instructions in the first window of Brent's algorithm, after which the state is saved again.
+DEFAULT_INTERVAL = 100
+# A loop found by LoopDetector: the instructions executed per time round it, and the lowest and highest program counter
+# of the instructions in it.
+Loop = namedtuple('Loop', ['length', 'low_pc', 'high_pc'])
+
+
+class LoopDetector:
+    """
+    Runs a System through an engine until it stops by itself, runs out of steps or repeats a state.
+    """
+    def __init__(self, system, engine=engines.DEFAULT_ENGINE, interval=DEFAULT_INTERVAL):
+        """
+        :param system: A System with a program loaded
+        :param engine: Name of the engine to run the system with
+        :param interval: Instructions in the first window, doubled each time the state is saved. Loops longer than
+                         the window are found once it has grown past them.
+        """
+        if interval < 1:
+            raise ValueError('interval must be at least 1')
+        self.system = system
+        self.engine = engines.create(engine, system)
+        self.interval = interval
+        # The Loop found by the last run, or None.
+        self.loop = None
+
+    def close(self):
+        """
+        Closes the engine, so the system can be handed on to another.
+        """
+        self.engine.close()
+
+    def state(self):
+        """
+        :return: A tuple which is equal for two states of the system exactly when they are the same, as far as
+                 Memory.fingerprint can tell
+        """
+        system = self.system
+        return (system.program_counter, tuple(system.registers), system.overflow_flag, system.sign_flag,
+                system.zero_flag, system.mem.fingerprint())
+
+    def run(self, max_steps=None):
+        """
+        :param max_steps: Most instructions to execute, or None for no limit
+        :return: A RunResult, with StopReason.LOOP if the system repeated a state. The loop is described by loop, and
+                 the system is left at the start of it.
+        """
+        budget = sys.maxsize if max_steps is None else max_steps
+        system = self.system
+        steps = 0
+        self.loop = None
+        saved, saved_steps = self.state(), 0
+        saved_registers = list(system.registers)
+        window = self.interval
+        while True:
+            # Engines don't stop on a breakpoint at the instruction they start from, so runs carry on past it.
+            result = self.engine.run(max_steps=min(saved_steps + window, budget) - steps, breakpoints={saved[0]})
+            steps += result.steps
+            if result.reason == StopReason.BREAKPOINT:
+                # Most loops which go on changing state change a register, which is cheaper to check first.
+                if system.registers != saved_registers:
+                    continue
+                state = self.state()
+                if state == saved:
+                    self.loop = self.measure(state, steps - saved_steps)
+                    return RunResult(steps, result.status, StopReason.LOOP)
+            elif result.reason != StopReason.BUDGET or steps >= budget:
+                return RunResult(steps, result.status, result.reason)
+            else:
+                # The window is used up, so save the state here and wait twice as long for it to come round.
+                saved, saved_steps = self.state(), steps
+                saved_registers = list(system.registers)
+                window *= 2
+
+    def measure(self, state, distance):
+        """
+        Works out the shortest loop through the current state, then puts the system back as it was.
+
+        :param state: The current state
+        :param distance: Instructions after which state is known to come round again
+        :return: A Loop
+        """
+        system = self.system
+        snapshot = system.snapshot()
+        low = high = system.program_counter
+        length = 0
+        try:
+            while length < distance:
+                self.engine.step()
+                length += 1
+                if self.state() == state:
+                    break
+                low, high = min(low, system.program_counter), max(high, system.program_counter)
+        finally:
+            system.restore(snapshot)
+        return Loop(length, low, high)
@@ -2,15 +2,297 @@
 This module defines the structure of system memory and provides some helper functions for working with python integers
 as if they were words in system memory.
 """
+import hashlib
+import struct
+
+# A little endian 64 bit word, used to move words between python integers and main memory in one operation.
+WORD = struct.Struct('<Q')
+WORD_MASK = 2 ** 64 - 1
+# Size of the address space when none is given. Addresses run from 0 to DEFAULT_SIZE - 1.
+DEFAULT_SIZE = 4096
+# Memory is allocated this many bytes at a time, the first time each page is written to.
+PAGE_SIZE = 256
+# Address spaces no bigger than this are listed in full by Memory.__repr__, untouched pages included.
+DENSE_REPR_LIMIT = 2 ** 16
+# Multipliers of the splitmix64 finaliser, which word_hash uses to scatter words over 64 bits.
+MIX_MULTIPLIERS = (0x9e3779b97f4a7c15, 0xbf58476d1ce4e5b9, 0x94d049bb133111eb)
+
+
+def word_hash(address, word):
+    """
+    :param address: Address of an 8 byte aligned word of memory
+    :param word: The value of that word
+    :return: A 64 bit hash of the word being at address, 0 for a word of zeroes. Memory.fingerprint is every word's hash
+             combined with exclusive or.
+    """
+    if not word:
+        return 0
+    first, second, third = MIX_MULTIPLIERS
+    value = (word ^ address * first) & WORD_MASK
+    value = (value ^ value >> 30) * second & WORD_MASK
+    value = (value ^ value >> 27) * third & WORD_MASK
+    return value ^ value >> 31
+
+
+class AddressError(IndexError):
+    """
+    Raised when an access touches an address outside of the address space.
+    """
+    def __init__(self, address):
+        super().__init__(f'address {address:#x} is outside of main memory')
+        self.address = address
+
+
+class PagedView:
+    """
+    Presents the pages of a Memory as one flat sequence of bytes, so that main memory can be indexed, sliced and
+    assigned to as if it were a list of python integers from 0 to 2^8.
+    """
+    def __init__(self, mem):
+        self.mem = mem
+
+    def __len__(self):
+        return self.mem.size
+
+    def __getitem__(self, index):
+        mem = self.mem
+        if isinstance(index, slice):
+            start, stop, step = index.indices(mem.size)
+            if step != 1:
+                return bytearray(self[i] for i in range(start, stop, step))
+            return mem.load(start, max(stop - start, 0))
+        if index < 0 or index >= mem.size:
+            raise AddressError(index)
+        page = mem.lookup(index >> mem.page_bits)
+        return page[index & mem.offset_mask] if page is not None else 0
+
+    def __setitem__(self, index, value):
+        mem = self.mem
+        if isinstance(index, slice):
+            start, stop, step = index.indices(mem.size)
+            if step != 1 or stop - start != len(value):
+                raise ValueError('main memory can only be assigned contiguous slices of the same length')
+            mem.store(start, bytes(value))
+            return
+        if index < 0 or index >= mem.size:
+            raise AddressError(index)
+        if mem.running_fingerprint is not None:
+            mem.store(index, bytes((value,)))
+            return
+        mem.page(index >> mem.page_bits)[index & mem.offset_mask] = value
+
+    def __eq__(self, other):
+        if not isinstance(other, PagedView):
+            return NotImplemented
+        mine, theirs = self.mem, other.mem
+        if mine.size != theirs.size or mine.page_size != theirs.page_size:
+            return False
+        blank = bytes(mine.page_size)
+        for number in mine.page_numbers() | theirs.page_numbers():
+            if (mine.lookup(number) or blank) != (theirs.lookup(number) or blank):
+                return False
+        return True
+
+
+class FrozenPages:
+    """
+    A read only mapping of page numbers to pages, as returned by Memory.freeze. Each holds the pages written since the
+    one before it was frozen and refers to that one for the rest, so freezing costs as much as the pages written since
+    rather than as much as all of memory.
+    """
+    def __init__(self, pages, parent=None):
+        """
+        :param pages: A dictionary mapping page numbers to pages, which must not be modified afterwards
+        :param parent: The FrozenPages these pages were written on top of, or None
+        """
+        self.pages = pages
+        self.parent = parent
+
+    def get(self, number, default=None):
+        layer = self
+        while layer is not None:
+            page = layer.pages.get(number)
+            if page is not None:
+                return page
+            layer = layer.parent
+        return default
+
+    def __getitem__(self, number):
+        page = self.get(number)
+        if page is None:
+            raise KeyError(number)
+        return page
+
+    def keys(self):
+        return self.flatten().keys()
+
+    def flatten(self):
+        """
+        :return: A dictionary of every page, which must not be modified. It is kept in place of the chain, so later
+                 lookups don't have to follow it.
+        """
+        if self.parent is not None:
+            layers = []
+            layer = self
+            while layer is not None:
+                layers.append(layer.pages)
+                layer = layer.parent
+            pages = {}
+            for layer_pages in reversed(layers):
+                pages.update(layer_pages)
+            self.pages, self.parent = pages, None
+        return self.pages
 
 
 class Memory:
     """
     Holds the state of main memory along with some methods to read to, write to, and interpret it.
+
+    The address space is split into pages which are only allocated once they are written to, so a large address space
+    costs nothing until it is used. Accesses outside of the address space raise AddressError.
+
+    Pages can be frozen, after which they are shared read only with snapshots and copied the first time they are
+    written to again.
     """
-    def __init__(self):
-        # Main memory is little endian, and holds 'bytes' which in this case are just python integers from 0 to 2^8
-        self.main = [0 for _ in range(4096)]
+    def __init__(self, size=DEFAULT_SIZE, page_size=PAGE_SIZE):
+        """
+        :param size: Number of addressable bytes, up to 2^64
+        :param page_size: Allocation granularity in bytes, a power of two no smaller than a word
+        """
+        if page_size < 8 or page_size & (page_size - 1):
+            raise ValueError('page_size must be a power of two no smaller than 8')
+        self.size = size
+        self.page_size = page_size
+        self.page_bits = page_size.bit_length() - 1
+        self.offset_mask = page_size - 1
+        # Maps page numbers to the bytearrays holding them. Pages missing from both dictionaries hold only zeroes. Pages
+        # in frozen may be shared with snapshots and must never be modified, so writes go to a copy in pages. frozen is
+        # the flattened contents of layer, the FrozenPages last returned by freeze or passed to thaw.
+        self.pages = {}
+        self.frozen = {}
+        self.layer = FrozenPages({})
+        # Main memory is little endian. This is a view of the pages which indexes like a flat list of bytes.
+        self.main = PagedView(self)
+        # Callables taking (address, length) that are told about every write made through Memory.write
+        self.write_observers = []
+        # Numbers of pages which may have changed since clean was last called, and the pages as they were then.
+        self.dirty = set()
+        self.baseline = {}
+        # The result of fingerprint, kept up to date by every change to memory once fingerprint has been called.
+        self.running_fingerprint = None
+
+    def page(self, number):
+        """
+        :param number: A page number
+        :return: The bytearray holding that page, which is allocated if it wasn't already.
+        """
+        page = self.pages.get(number)
+        if page is None:
+            shared = self.frozen.get(number)
+            page = self.pages[number] = bytearray(shared) if shared is not None else bytearray(self.page_size)
+            # Every write to a page since the last freeze comes through here first, so writes themselves don't need to
+            # mark anything.
+            self.dirty.add(number)
+        return page
+
+    def lookup(self, number):
+        """
+        :param number: A page number
+        :return: The bytearray holding that page for reading, or None if the page holds only zeroes.
+        """
+        page = self.pages.get(number)
+        return page if page is not None else self.frozen.get(number)
+
+    def page_numbers(self):
+        """
+        :return: The set of numbers of pages which have been allocated.
+        """
+        return self.pages.keys() | self.frozen.keys()
+
+    def freeze(self):
+        """
+        Makes every page read only, so that it can be shared.
+
+        :return: A FrozenPages
+        """
+        if self.pages:
+            pages, parent = self.pages, self.layer
+            # Layers are merged into their parent whenever they have caught up with it in size, which keeps the chain
+            # of them logarithmic in length while each page is only copied a logarithmic number of times.
+            while parent is not None and len(parent.pages) <= len(pages):
+                pages, parent = {**parent.pages, **pages}, parent.parent
+            self.layer = FrozenPages(pages, parent)
+            self.frozen.update(self.pages)
+            self.pages = {}
+        return self.layer
+
+    def thaw(self, frozen):
+        """
+        Replaces the contents of memory with pages returned by an earlier call to freeze, telling write observers about
+        every page which changes.
+
+        :param frozen: A FrozenPages returned by freeze
+        """
+        layer, frozen = frozen, frozen.flatten()
+        changed = [number for number in self.page_numbers() | frozen.keys()
+                   if self.lookup(number) is not frozen.get(number)]
+        if self.running_fingerprint is not None:
+            for number in changed:
+                self.running_fingerprint ^= self.page_hash(number, self.lookup(number))
+                self.running_fingerprint ^= self.page_hash(number, frozen.get(number))
+        self.pages = {}
+        self.frozen = dict(frozen)
+        self.layer = layer
+        self.dirty.update(changed)
+        for number in changed:
+            for observer in self.write_observers:
+                observer(number << self.page_bits, self.page_size)
+
+    def clean(self):
+        """
+        Takes the current contents of memory as the baseline that dirty pages are relative to.
+        """
+        self.baseline = self.freeze()
+        self.dirty = set()
+
+    def load(self, address, length):
+        """
+        :param address: First address to copy from
+        :param length: Number of bytes to copy
+        :return: A bytearray of the bytes in [address, address + length), which must lie inside the address space.
+        """
+        if address < 0 or address + length > self.size:
+            raise AddressError(address if address < 0 else max(address, self.size))
+        result = bytearray()
+        while length > 0:
+            offset = address & self.offset_mask
+            chunk = min(length, self.page_size - offset)
+            page = self.lookup(address >> self.page_bits)
+            result += page[offset:offset + chunk] if page is not None else bytes(chunk)
+            address += chunk
+            length -= chunk
+        return result
+
+    def store(self, address, data):
+        """
+        Copies data into memory starting at address, allocating pages as needed. Write observers are not told.
+
+        :param address: First address to copy to
+        :param data: A bytes-like object which must fit inside the address space starting at address
+        """
+        length = len(data)
+        if address < 0 or address + length > self.size:
+            raise AddressError(address if address < 0 else max(address, self.size))
+        if self.running_fingerprint is not None:
+            self.running_fingerprint ^= self.span_hash(address, length)
+        done = 0
+        while done < length:
+            offset = (address + done) & self.offset_mask
+            chunk = min(length - done, self.page_size - offset)
+            self.page((address + done) >> self.page_bits)[offset:offset + chunk] = data[done:done + chunk]
+            done += chunk
+        if self.running_fingerprint is not None:
+            self.running_fingerprint ^= self.span_hash(address, length)
 
     def write(self, src, destination):
         """
@@ -18,28 +300,123 @@ class Memory:
         :param destination: Address of memory to write to
         :return:
         """
-        val = src
-        mask = 2 ** 8 - 1
-        for i in range(8):
-            byte = (val >> (8 * i)) & mask
-            self.main[destination + i] = byte
+        if destination < 0 or destination + 8 > self.size:
+            raise AddressError(destination)
+        offset = destination & self.offset_mask
+        if offset <= self.page_size - 8:
+            page = self.pages.get(destination >> self.page_bits)
+            if page is None:
+                page = self.page(destination >> self.page_bits)
+            if self.running_fingerprint is None:
+                WORD.pack_into(page, offset, src & WORD_MASK)
+            elif destination & 7:
+                # The hashes of the words overwritten are cancelled out by hashing them again before adding the new.
+                self.running_fingerprint ^= self.span_hash(destination, 8)
+                WORD.pack_into(page, offset, src & WORD_MASK)
+                self.running_fingerprint ^= self.span_hash(destination, 8)
+            else:
+                old, new = WORD.unpack_from(page, offset)[0], src & WORD_MASK
+                if old != new:
+                    self.running_fingerprint ^= word_hash(destination, old) ^ word_hash(destination, new)
+                    WORD.pack_into(page, offset, new)
+        else:
+            self.store(destination, WORD.pack(src & WORD_MASK))
+        for observer in self.write_observers:
+            observer(destination, 8)
 
     def read(self, address):
         """
-        :param address: A direct address to main memory, between 0 and 1000 - 8
+        :param address: A direct address to main memory, between 0 and the size of memory - 8
         :return: The next 8 bytes after address read into a 64 bit number.
         """
-        combined = 0
-        for x in range(8):
-            combined = combined << 8
-            combined |= self.main[address + 7 - x]
-        return combined
+        if address < 0 or address + 8 > self.size:
+            raise AddressError(address)
+        offset = address & self.offset_mask
+        if offset <= self.page_size - 8:
+            page = self.pages.get(address >> self.page_bits)
+            if page is None:
+                page = self.frozen.get(address >> self.page_bits)
+            return WORD.unpack_from(page, offset)[0] if page is not None else 0
+        return WORD.unpack(self.load(address, 8))[0]
+
+    def pprint(self, file=None):
+        """
+        Prints every 8 byte row of memory which isn't all zeroes, along with its address.
+
+        :param file: A text file to print to, or None for stdout
+        """
+        for number in sorted(self.page_numbers()):
+            page = self.lookup(number)
+            base = number << self.page_bits
+            for offset in range(0, self.page_size, 8):
+                row = page[offset:offset + 8]
+                if any(row):
+                    print(f'{base + offset:#010x}: {" ".join(f"{byte:02x}" for byte in row)}', file=file)
+
+    def digest(self):
+        """
+        :return: A hex SHA-256 digest of the contents of memory, which doesn't depend on which pages happen to be
+                 allocated.
+        """
+        digest = hashlib.sha256(WORD.pack(self.size & WORD_MASK))
+        for number in sorted(self.page_numbers()):
+            page = self.lookup(number)
+            if any(page):
+                digest.update(WORD.pack(number))
+                digest.update(page)
+        return digest.hexdigest()
+
+    def fingerprint(self):
+        """
+        A 64 bit hash of the contents of memory which, unlike digest, is kept up to date as memory changes instead of
+        being worked out again each time. The first call hashes every allocated page, and from then on every write
+        through write, store, main or thaw updates it in time proportional to the bytes written.
+
+        :return: The word_hash of every word of memory combined with exclusive or
+        """
+        if self.running_fingerprint is None:
+            fingerprint = 0
+            for number in self.page_numbers():
+                fingerprint ^= self.page_hash(number, self.lookup(number))
+            self.running_fingerprint = fingerprint
+        return self.running_fingerprint
+
+    def page_hash(self, number, page):
+        """
+        :param number: A page number
+        :param page: The contents of that page, or None for a page of zeroes
+        :return: The word_hash of every word of the page combined with exclusive or
+        """
+        result = 0
+        if page is not None and any(page):
+            base = number << self.page_bits
+            for offset, (word,) in enumerate(WORD.iter_unpack(page)):
+                if word:
+                    result ^= word_hash(base + 8 * offset, word)
+        return result
+
+    def span_hash(self, address, length):
+        """
+        :return: The word_hash of every aligned word overlapping [address, address + length) combined with exclusive or
+        """
+        result = 0
+        for aligned in range(address & ~7, address + length, 8):
+            page = self.lookup(aligned >> self.page_bits)
+            if page is not None:
+                result ^= word_hash(aligned, WORD.unpack_from(page, aligned & self.offset_mask)[0])
+        return result
 
     def __repr__(self):
-        string = ''
-        for i in range(512):
-            string += str([self.main[j + (i * 8)] for j in range(8)]) + '\n'
-        return string
+        if self.size <= DENSE_REPR_LIMIT:
+            return ''.join(str(list(self.main[i:i + 8])) + '\n' for i in range(0, self.size, 8))
+        # Listing every row of a large address space is hopeless, so only allocated pages are shown, each under a line
+        # giving its address.
+        lines = []
+        for number in sorted(self.page_numbers()):
+            page = self.lookup(number)
+            lines.append(f'# {number << self.page_bits:#x}\n')
+            lines += [str(list(page[i:i + 8])) + '\n' for i in range(0, self.page_size, 8)]
+        return ''.join(lines)
 
     @staticmethod
     def to_unsigned(num):
@@ -0,0 +1,223 @@
+"""
+This module reads and writes Y86_64 object files, which hold an assembled program so it can be run again without
+assembling it.
+
+An object file is laid out as, with every integer little endian:
+
+    header          magic b'Y86O', format version (u16), flags (u16), entry point (u64), memory size (u64, with 0
+                    meaning 2^64), segment, symbol and line counts (u32 each)
+    segment table   base address, length and file offset of each segment's bytes (u64 each)
+    symbol table    address (u64), name length (u16) and UTF-8 name of each label
+    line table      address (u64) and source line number (u32) of each instruction
+    segment data
+
+Segments are the runs of allocated memory pages holding the program, with zero bytes trimmed from both ends. Loading
+copies each one into memory in a single store, reading large ones through a memory map of the file.
+"""
+import argparse
+from collections import namedtuple
+import mmap
+import struct
+import sys
+
+import assembler
+from memory import DEFAULT_SIZE, WORD_MASK
+from system import System
+
+MAGIC = b'Y86O'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sHHQQIII')
+SEGMENT = struct.Struct('<QQQ')
+SYMBOL = struct.Struct('<QH')
+LINE = struct.Struct('<QI')
+# Segments at least this long are loaded through a memory map of the file instead of being read into a bytes object.
+MMAP_THRESHOLD = 1 << 16
+# Suffix given to object files written from source files.
+SUFFIX = '.yo'
+
+# segments is a list of (base address, bytes) pairs when an image is built and of (base address, length) pairs once it
+# has been loaded, since the bytes are then in memory. symbols maps labels to addresses, and lines maps instruction
+# addresses to source line numbers.
+Image = namedtuple('Image', ['entry', 'memory_size', 'segments', 'symbols', 'lines'])
+
+
+def segments_of(mem):
+    """
+    :param mem: A Memory object
+    :return: A list of (base address, bytes) pairs covering every non zero byte of mem, in order of address.
+    """
+    segments = []
+    numbers = sorted(mem.page_numbers())
+    run_start = None
+    for i, number in enumerate(numbers):
+        if run_start is None:
+            run_start = number
+        if i + 1 < len(numbers) and numbers[i + 1] == number + 1:
+            continue
+        base = run_start << mem.page_bits
+        data = bytes(mem.load(base, ((number + 1) << mem.page_bits) - base))
+        run_start = None
+        stripped = data.lstrip(b'\0')
+        if stripped:
+            base += len(data) - len(stripped)
+            segments.append((base, stripped.rstrip(b'\0')))
+    return segments
+
+
+def from_system(system, symbols=None, lines=None):
+    """
+    :param system: A System holding a program, with its program counter on the first instruction to run
+    :param symbols: Optionally, a dictionary mapping labels to addresses
+    :param lines: Optionally, a dictionary mapping instruction addresses to source line numbers
+    :return: An Image of the program
+    """
+    return Image(system.program_counter, system.mem.size, segments_of(system.mem), symbols or {}, lines or {})
+
+
+def assemble(lines, memory_size=DEFAULT_SIZE):
+    """
+    :param lines: Lines of Y86_64 source code
+    :param memory_size: Size of the address space the program is to run in
+    :return: An Image of the assembled program
+    :raises AssemblyError: If any line couldn't be assembled or doesn't fit in memory_size bytes
+    """
+    assembly = assembler.assemble_segments(lines, memory_size=memory_size)
+    system = System(memory_size)
+    for place, segment in assembly.segments:
+        system.mem.store(place, segment)
+    return from_system(system, assembly.labels, assembly.line_numbers)
+
+
+def dumps(image):
+    """
+    :param image: An Image built from a program, holding the bytes of its segments
+    :return: The bytes of an object file holding image
+    :raises ValueError: If the memory size of image is not between 1 and 2^64
+    """
+    if not 0 < image.memory_size <= 2 ** 64:
+        raise ValueError(f'An object file can only hold a memory size from 1 to 2^64, not {image.memory_size}')
+    symbols = [(address, name.encode()) for name, address in sorted(image.symbols.items(), key=lambda s: s[1])]
+    tables = bytearray()
+    for address, name in symbols:
+        tables += SYMBOL.pack(address, len(name)) + name
+    for address, line in sorted(image.lines.items()):
+        tables += LINE.pack(address, line)
+
+    offset = HEADER.size + SEGMENT.size * len(image.segments) + len(tables)
+    out = bytearray(HEADER.pack(MAGIC, FORMAT_VERSION, 0, image.entry, image.memory_size & WORD_MASK,
+                                len(image.segments), len(symbols), len(image.lines)))
+    for base, data in image.segments:
+        out += SEGMENT.pack(base, len(data), offset)
+        offset += len(data)
+    out += tables
+    for _, data in image.segments:
+        out += data
+    return bytes(out)
+
+
+def save(image, path):
+    with open(path, 'wb') as file:
+        file.write(dumps(image))
+
+
+def is_object_file(path):
+    """
+    :return: True if the file at path starts like an object file.
+    """
+    with open(path, 'rb') as file:
+        return file.read(len(MAGIC)) == MAGIC
+
+
+def _read(file, size):
+    """
+    :return: The next size bytes of file
+    :raises ValueError: If the file ends first
+    """
+    data = file.read(size)
+    if len(data) < size:
+        raise ValueError(f'{file.name} is truncated')
+    return data
+
+
+def _read_tables(file):
+    """
+    Reads everything but the segment data from an open object file.
+
+    :return: A 2-tuple of an Image holding (base, length) segments, and a list of the file offsets of the segments.
+    :raises ValueError: If the file is not an object file this version can read, or is truncated
+    """
+    header = file.read(HEADER.size)
+    if len(header) < HEADER.size or header[:len(MAGIC)] != MAGIC:
+        raise ValueError(f'{file.name} is not a Y86_64 object file')
+    _, version, _, entry, memory_size, segment_count, symbol_count, line_count = HEADER.unpack(header)
+    if version != FORMAT_VERSION:
+        raise ValueError(f'{file.name} has object format version {version}, expected {FORMAT_VERSION}')
+    segments, offsets = [], []
+    for base, length, offset in SEGMENT.iter_unpack(_read(file, SEGMENT.size * segment_count)):
+        segments.append((base, length))
+        offsets.append(offset)
+    symbols = {}
+    for _ in range(symbol_count):
+        address, length = SYMBOL.unpack(_read(file, SYMBOL.size))
+        symbols[_read(file, length).decode()] = address
+    lines = dict(LINE.iter_unpack(_read(file, LINE.size * line_count)))
+    return Image(entry, memory_size or 2 ** 64, segments, symbols, lines), offsets
+
+
+def load(path, system=None, mmap_threshold=MMAP_THRESHOLD):
+    """
+    Copies the program in an object file into a system's memory and points its program counter at the entry point.
+
+    :param path: Path to an object file
+    :param system: The System to load into, or None for a new one with the memory size the file asks for
+    :param mmap_threshold: Segments at least this many bytes long are copied out of a memory map of the file
+    :return: A 2-tuple of the System and an Image whose segments are (base address, length) pairs
+    :raises ValueError: If the file is not an object file this version can read, or is truncated
+    :raises AddressError: If a segment doesn't fit in the memory of system
+    """
+    with open(path, 'rb') as file:
+        image, offsets = _read_tables(file)
+        if system is None:
+            system = System(image.memory_size)
+        mem = system.mem
+        mapped = None
+        try:
+            for (base, length), offset in zip(image.segments, offsets):
+                if length >= mmap_threshold:
+                    if mapped is None:
+                        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                    if offset + length > len(mapped):
+                        raise ValueError(f'{path} is truncated')
+                    with memoryview(mapped) as view:
+                        mem.store(base, view[offset:offset + length])
+                else:
+                    file.seek(offset)
+                    mem.store(base, _read(file, length))
+                # Stores bypass write observers, and anything already decoded from this memory is now stale.
+                for observer in mem.write_observers:
+                    observer(base, length)
+        finally:
+            if mapped is not None:
+                mapped.close()
+    system.program_counter = image.entry
+    return system, image
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Assemble a Y86_64 program into an object file.')
+    parser.add_argument('source', help='Y86_64 source file')
+    parser.add_argument('-o', '--output', default=None, help=f'object file to write (default: source with {SUFFIX})')
+    parser.add_argument('--memory-size', type=int, default=DEFAULT_SIZE, help='size of the address space in bytes')
+    args = parser.parse_args()
+
+    with open(args.source, 'r') as file:
+        image = assemble(file.readlines(), args.memory_size)
+    output = args.output
+    if output is None:
+        output = (args.source[:-3] if args.source.endswith('.ys') else args.source) + SUFFIX
+    save(image, output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,226 @@
+"""
+This module estimates how many clock cycles a program would take on the five stage (fetch, decode, execute, memory,
+writeback) PIPE processor that the Y86_64 ISA was designed for.
+
+The System still executes every instruction itself, so its final state is exactly that of an ordinary run. The model
+watches the stream of executed instructions and charges the cycles the pipeline would lose to hazards:
+
+- Forwarding covers every data hazard except a value loaded by mrmovq or popq being used by the very next instruction,
+  which has to stall in decode for one cycle until the load has passed through memory.
+- ret doesn't know where to fetch from until it reaches writeback, inserting three bubbles.
+- A conditional jump is resolved in execute, so a wrong prediction throws away the two instructions fetched after it.
+
+Filling the pipeline costs four cycles before the first instruction completes.
+"""
+import json
+
+import decoder
+from decoder import CONDITION_TABLE, pack_flags
+from memory import AddressError
+from system import Status
+
+# Cycles spent before the first instruction completes, and lost to each kind of hazard.
+FILL_CYCLES = 4
+LOAD_USE_PENALTY = 1
+RET_PENALTY = 3
+MISPREDICT_PENALTY = 2
+# Branch predictors: always predict taken, predict backward branches taken and forward ones not taken, or keep a two
+# bit saturating counter per branch.
+PREDICTORS = ('taken', 'btfnt', '2bit')
+# Two bit counters start out weakly taken. Values of 2 and 3 predict taken.
+COUNTER_START = 2
+RSP = 4
+
+
+def source_registers(ins):
+    """
+    :param ins: A decoder.Decoded instruction
+    :return: A tuple of the registers ins reads in the decode stage.
+    """
+    icode = ins.icode
+    if icode in (4, 6):
+        return ins.reg_a, ins.reg_b
+    if icode == 2:
+        return ins.reg_a,
+    if icode == 5:
+        return ins.reg_b,
+    if icode == 10:
+        return ins.reg_a, RSP
+    if icode in (8, 9, 11):
+        return RSP,
+    return ()
+
+
+def loaded_register(ins):
+    """
+    :param ins: A decoder.Decoded instruction
+    :return: The register ins fills from memory, or None if it doesn't load a register.
+    """
+    if ins.icode in (5, 11) and ins.reg_a < 15:
+        return ins.reg_a
+    return None
+
+
+class PipelineModel:
+    """
+    Runs a System while counting the cycles a pipelined implementation would take.
+    """
+    def __init__(self, system, predictor='taken'):
+        """
+        :param system: The System to run
+        :param predictor: One of PREDICTORS
+        """
+        if predictor not in PREDICTORS:
+            raise ValueError(f'Unknown branch predictor {predictor}, expected one of {", ".join(PREDICTORS)}')
+        self.system = system
+        self.predictor = predictor
+        self.decoded = decoder.DecodeCache(system.mem)
+        self.instructions = 0
+        self.load_use_stalls = 0
+        self.ret_bubbles = 0
+        self.branches = 0
+        self.mispredictions = 0
+        # Per program counter counts of stall cycles, ret bubbles, executed conditional jumps and mispredictions
+        self.stalls_at = {}
+        self.bubbles_at = {}
+        self.branches_at = {}
+        self.mispredictions_at = {}
+        self.counters = {}
+        # The register loaded by the previous instruction, if it was a load
+        self.pending_load = None
+
+    def _decode(self, address):
+        try:
+            return self.decoded.entries[address]
+        except KeyError:
+            ins = decoder.decode(self.system.mem, address)
+            self.decoded.insert(address, ins.next_pc - address, ins)
+            return ins
+
+    def _predict(self, pc, target):
+        if self.predictor == 'taken':
+            return True
+        if self.predictor == 'btfnt':
+            return target <= pc
+        return self.counters.get(pc, COUNTER_START) >= 2
+
+    def _train(self, pc, taken):
+        if self.predictor == '2bit':
+            counter = self.counters.get(pc, COUNTER_START)
+            self.counters[pc] = min(counter + 1, 3) if taken else max(counter - 1, 0)
+
+    def step(self):
+        """
+        Executes one instruction and charges the cycles it loses to hazards.
+
+        :return: True if the system is still AOK afterwards, False otherwise.
+        """
+        system = self.system
+        if system.status != Status.AOK:
+            return False
+        pc = system.program_counter
+        try:
+            ins = self._decode(pc)
+        except AddressError:
+            ins = None
+        self.instructions += 1
+        if ins is None:
+            system.step()
+            return False
+
+        if self.pending_load is not None and self.pending_load in source_registers(ins):
+            self.load_use_stalls += LOAD_USE_PENALTY
+            self.stalls_at[pc] = self.stalls_at.get(pc, 0) + LOAD_USE_PENALTY
+        if ins.icode == 7 and 0 < ins.ifun < 7:
+            taken = CONDITION_TABLE[ins.ifun][pack_flags(system.overflow_flag, system.sign_flag, system.zero_flag)]
+            self.branches += 1
+            self.branches_at[pc] = self.branches_at.get(pc, 0) + 1
+            if self._predict(pc, ins.value) != taken:
+                self.mispredictions += 1
+                self.mispredictions_at[pc] = self.mispredictions_at.get(pc, 0) + 1
+            self._train(pc, taken)
+        elif ins.icode == 9:
+            self.ret_bubbles += RET_PENALTY
+            self.bubbles_at[pc] = self.bubbles_at.get(pc, 0) + RET_PENALTY
+        self.pending_load = loaded_register(ins)
+
+        system.step()
+        return system.status == Status.AOK
+
+    def run(self, max_steps=None):
+        """
+        Runs the system until its status isn't AOK or max_steps instructions have executed.
+
+        :return: The number of instructions executed
+        """
+        steps = 0
+        while self.system.status == Status.AOK and (max_steps is None or steps < max_steps):
+            self.step()
+            steps += 1
+        return steps
+
+    def cycles(self):
+        """
+        :return: The number of cycles the instructions executed so far would take, including filling the pipeline.
+        """
+        if not self.instructions:
+            return 0
+        return (self.instructions + FILL_CYCLES + self.load_use_stalls + self.ret_bubbles
+                + self.mispredictions * MISPREDICT_PENALTY)
+
+    def cpi(self):
+        """
+        :return: Cycles per instruction, or 0.0 if nothing has executed
+        """
+        return self.cycles() / self.instructions if self.instructions else 0.0
+
+    def per_pc(self):
+        """
+        :return: A list of dictionaries, one per program counter which lost cycles or executed a conditional jump, most
+                 cycles lost first.
+        """
+        rows = []
+        for pc in set(self.stalls_at) | set(self.bubbles_at) | set(self.branches_at):
+            row = {'pc': pc, 'stalls': self.stalls_at.get(pc, 0), 'bubbles': self.bubbles_at.get(pc, 0)}
+            if pc in self.branches_at:
+                row['branches'] = self.branches_at[pc]
+                row['mispredictions'] = self.mispredictions_at.get(pc, 0)
+            row['lost'] = row['stalls'] + row['bubbles'] + row.get('mispredictions', 0) * MISPREDICT_PENALTY
+            rows.append(row)
+        rows.sort(key=lambda row: (-row['lost'], row['pc']))
+        return rows
+
+    def summary(self):
+        return {
+            'predictor': self.predictor,
+            'instructions': self.instructions,
+            'cycles': self.cycles(),
+            'cpi': self.cpi(),
+            'load_use_stalls': self.load_use_stalls,
+            'ret_bubbles': self.ret_bubbles,
+            'branches': self.branches,
+            'mispredictions': self.mispredictions,
+        }
+
+    def to_json(self):
+        return json.dumps(dict(self.summary(), per_pc=self.per_pc()), indent=2)
+
+    def report(self, limit=20):
+        """
+        :param limit: Most rows of the per program counter table to show
+        :return: A printable summary followed by the program counters which lost the most cycles.
+        """
+        summary = self.summary()
+        lines = [f'{"predictor":>16} {summary["predictor"]}',
+                 f'{"instructions":>16} {summary["instructions"]}',
+                 f'{"cycles":>16} {summary["cycles"]}',
+                 f'{"CPI":>16} {summary["cpi"]:.3f}',
+                 f'{"load/use stalls":>16} {summary["load_use_stalls"]}',
+                 f'{"ret bubbles":>16} {summary["ret_bubbles"]}',
+                 f'{"mispredictions":>16} {summary["mispredictions"]} of {summary["branches"]} branches',
+                 '',
+                 f'{"pc":>8} {"lost":>10} {"stalls":>10} {"bubbles":>10} {"mispredict":>10} {"branches":>10}']
+        for row in self.per_pc()[:limit]:
+            lines.append(f'{row["pc"]:#8x} {row["lost"]:>10} {row["stalls"]:>10} {row["bubbles"]:>10} '
+                         f'{row.get("mispredictions", ""):>10} {row.get("branches", ""):>10}')
+        return '\n'.join(lines)
@@ -0,0 +1,146 @@
+"""
+This module profiles a running System: how often each instruction executes, how often each kind of instruction
+executes, and how often each conditional jump or move goes each way.
+
+Counters live in arrays. Each program counter is given a slot the first time it executes, so per instruction
+bookkeeping is one dictionary lookup and a few array increments. Instructions are classified by what was at their
+address when it first executed.
+"""
+from array import array
+import json
+
+import assembler
+import decoder
+from decoder import CONDITION_TABLE, pack_flags
+from memory import AddressError
+from system import Status
+
+# Names of instructions indexed by (icode, ifun), and of kinds of instruction indexed by icode.
+MNEMONIC = {tuple(codes): name for name, codes in assembler.INS_OP_FUNCTION.items()}
+OPCODE_CLASS = ('halt', 'nop', 'rrmovq/cmovxx', 'irmovq', 'rmmovq', 'mrmovq', 'opq', 'jxx', 'call', 'ret', 'pushq',
+                'popq', 'invalid', 'invalid', 'invalid', 'invalid')
+
+
+class Profiler:
+    """
+    Runs a System while counting executions per program counter and per kind of instruction.
+    """
+    def __init__(self, system, line_numbers=None, source_lines=None):
+        """
+        :param system: The System to run
+        :param line_numbers: Optionally, the dictionary of instruction addresses to line numbers returned by
+                             assembler.assemble, so the report can point at source lines
+        :param source_lines: Optionally, the source code the program was assembled from
+        """
+        self.system = system
+        self.line_numbers = line_numbers or {}
+        self.source_lines = source_lines
+        # Maps a program counter to its slot in the arrays below
+        self.slots = {}
+        self.addresses = array('Q')
+        self.codes = array('B')
+        self.counts = array('Q')
+        self.taken = array('Q')
+        self.not_taken = array('Q')
+        self.class_counts = array('Q', bytes(8 * 16))
+        self.steps = 0
+
+    def _new_slot(self, address):
+        try:
+            ins = decoder.decode(self.system.mem, address)
+            code = ins.icode << 4 | ins.ifun
+        except AddressError:
+            code = 0xff
+        slot = len(self.addresses)
+        self.slots[address] = slot
+        self.addresses.append(address)
+        self.codes.append(code)
+        self.counts.append(0)
+        self.taken.append(0)
+        self.not_taken.append(0)
+        return slot
+
+    def run(self, max_steps=None):
+        """
+        Runs the system until its status isn't AOK or max_steps instructions have executed, counting as it goes.
+
+        :return: The number of instructions executed
+        """
+        system = self.system
+        slots, codes, counts, taken, not_taken = self.slots, self.codes, self.counts, self.taken, self.not_taken
+        class_counts = self.class_counts
+        steps = 0
+        while system.status is Status.AOK and (max_steps is None or steps < max_steps):
+            pc = system.program_counter
+            slot = slots.get(pc)
+            if slot is None:
+                slot = self._new_slot(pc)
+            code = codes[slot]
+            counts[slot] += 1
+            class_counts[code >> 4 & 0xf] += 1
+            # Conditional instructions are jxx and cmovxx with a non zero function code
+            if code >> 4 in (2, 7) and 0 < code & 0xf < 7:
+                flags = pack_flags(system.overflow_flag, system.sign_flag, system.zero_flag)
+                if CONDITION_TABLE[code & 0xf][flags]:
+                    taken[slot] += 1
+                else:
+                    not_taken[slot] += 1
+            system.step()
+            steps += 1
+        self.steps += steps
+        return steps
+
+    def hot_spots(self):
+        """
+        :return: A list of dictionaries, one per executed instruction, most executed first.
+        """
+        rows = []
+        total = self.steps or 1
+        for slot in sorted(range(len(self.addresses)), key=lambda s: (-self.counts[s], self.addresses[s])):
+            address, code = self.addresses[slot], self.codes[slot]
+            row = {
+                'pc': address,
+                'instruction': MNEMONIC.get((code >> 4, code & 0xf), 'invalid'),
+                'count': self.counts[slot],
+                'percent': 100 * self.counts[slot] / total,
+            }
+            if code >> 4 in (2, 7) and 0 < code & 0xf < 7:
+                row['taken'] = self.taken[slot]
+                row['not_taken'] = self.not_taken[slot]
+            line = self.line_numbers.get(address)
+            if line is not None:
+                row['line'] = line
+                if self.source_lines is not None:
+                    row['source'] = self.source_lines[line - 1].strip()
+            rows.append(row)
+        return rows
+
+    def opcode_classes(self):
+        """
+        :return: A dictionary of executions per kind of instruction, leaving out kinds which never executed.
+        """
+        classes = {}
+        for icode, count in enumerate(self.class_counts):
+            if count:
+                classes[OPCODE_CLASS[icode]] = classes.get(OPCODE_CLASS[icode], 0) + count
+        return classes
+
+    def to_json(self):
+        return json.dumps({'steps': self.steps, 'opcode_classes': self.opcode_classes(),
+                           'hot_spots': self.hot_spots()}, indent=2)
+
+    def report(self, limit=20):
+        """
+        :param limit: Most rows of the hot spot table to show
+        :return: A printable table of the most executed instructions followed by counts per kind of instruction.
+        """
+        lines = [f'{"pc":>8} {"count":>12} {"%":>6} {"taken":>9} {"not taken":>9}  instruction']
+        for row in self.hot_spots()[:limit]:
+            branches = (f'{row["taken"]:>9} {row["not_taken"]:>9}' if 'taken' in row else f'{"":>9} {"":>9}')
+            where = f'line {row["line"]}: {row.get("source", row["instruction"])}' if 'line' in row \
+                else row['instruction']
+            lines.append(f'{row["pc"]:#8x} {row["count"]:>12} {row["percent"]:>6.2f} {branches}  {where}')
+        lines.append('')
+        for name, count in sorted(self.opcode_classes().items(), key=lambda item: -item[1]):
+            lines.append(f'{name:>14} {count:>12}')
+        return '\n'.join(lines)
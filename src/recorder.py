@@ -0,0 +1,208 @@
+"""
+This module records the execution of a System so that it can be run backwards.
+
+Each executed instruction appends one entry to an undo log held in preallocated arrays: the program counter and flags
+before the instruction, the old value of the register it writes along with the old stack pointer, and the old 8 bytes of
+memory it writes. Every checkpoint_interval instructions the System is snapshotted and the log starts over, so memory use
+is bounded by the log size plus the pages held by the most recent max_checkpoints snapshots. Going back past the start
+of the log restores a checkpoint and replays forward from it.
+"""
+from array import array
+
+import decoder
+from memory import AddressError, WORD_MASK
+from system import Status
+
+# Bits of the flags entry in the undo log
+OVERFLOW, SIGN, ZERO, WROTE_MEMORY = 1, 2, 4, 8
+
+
+def written_register(ins):
+    """
+    :param ins: A decoder.Decoded instruction
+    :return: The register ins writes other than the stack pointer, or -1 if there isn't one.
+    """
+    icode = ins.icode
+    if icode in (2, 3, 6):
+        return ins.reg_b
+    if icode in (5, 11):
+        return ins.reg_a
+    return -1
+
+
+class Recorder:
+    """
+    Runs a System while keeping enough history to step it backwards.
+    """
+    def __init__(self, system, checkpoint_interval=4096, max_checkpoints=64):
+        """
+        :param system: The System to record, in the state history should start from
+        :param checkpoint_interval: Instructions between checkpoints, which is also the length of the undo log
+        :param max_checkpoints: Checkpoints to keep. Older history is forgotten.
+        """
+        self.system = system
+        self.interval = checkpoint_interval
+        self.max_checkpoints = max_checkpoints
+        self.program_counter = array('Q', bytes(8 * checkpoint_interval))
+        self.flags = array('B', bytes(checkpoint_interval))
+        self.register = array('b', bytes(checkpoint_interval))
+        self.register_value = array('Q', bytes(8 * checkpoint_interval))
+        self.stack_pointer = array('Q', bytes(8 * checkpoint_interval))
+        self.address = array('Q', bytes(8 * checkpoint_interval))
+        self.memory_value = array('Q', bytes(8 * checkpoint_interval))
+        # Number of entries in the undo log, and the number of instructions executed since recording started.
+        self.count = 0
+        self.steps = 0
+        # (steps, Snapshot) pairs, oldest first. The undo log covers the instructions after the last one.
+        self.checkpoints = [(0, system.snapshot())]
+        self.decoded = decoder.DecodeCache(system.mem)
+
+    def _decode(self, address):
+        try:
+            return self.decoded.entries[address]
+        except KeyError:
+            ins = decoder.decode(self.system.mem, address)
+            self.decoded.insert(address, ins.next_pc - address, ins)
+            return ins
+
+    def step(self):
+        """
+        Executes and records one instruction.
+
+        :return: True if the system is still AOK afterwards, False otherwise.
+        """
+        system = self.system
+        if system.status != Status.AOK:
+            return False
+        if self.count == self.interval:
+            self.checkpoint()
+        registers = system.registers
+        i = self.count
+        pc = system.program_counter
+        flags = system.overflow_flag * OVERFLOW | system.sign_flag * SIGN | system.zero_flag * ZERO
+        reg = -1
+        try:
+            ins = self._decode(pc)
+        except AddressError:
+            ins = None
+        if ins is not None:
+            reg = written_register(ins)
+            if reg > 14:
+                reg = -1
+            address = None
+            if ins.icode == 4 and ins.reg_b < 15:
+                address = (registers[ins.reg_b] + ins.value) & WORD_MASK
+            elif ins.icode in (8, 10):
+                address = (registers[4] - 8) & WORD_MASK
+            if address is not None and 0 <= address <= system.mem.size - 8:
+                flags |= WROTE_MEMORY
+                self.address[i] = address
+                self.memory_value[i] = system.mem.read(address)
+        self.program_counter[i] = pc
+        self.flags[i] = flags
+        self.register[i] = reg
+        if reg >= 0:
+            self.register_value[i] = registers[reg] & WORD_MASK
+        self.stack_pointer[i] = registers[4] & WORD_MASK
+        self.count += 1
+        self.steps += 1
+        system.step()
+        return system.status == Status.AOK
+
+    def run(self, max_steps=None):
+        """
+        Executes and records instructions until the system stops being AOK or max_steps have run.
+
+        :return: The number of instructions executed
+        """
+        steps = 0
+        while self.system.status == Status.AOK and (max_steps is None or steps < max_steps):
+            self.step()
+            steps += 1
+        return steps
+
+    def checkpoint(self):
+        self.checkpoints.append((self.steps, self.system.snapshot()))
+        if len(self.checkpoints) > self.max_checkpoints:
+            del self.checkpoints[0]
+        self.count = 0
+
+    def earliest(self):
+        """
+        :return: The earliest step that can still be gone back to.
+        """
+        return self.checkpoints[0][0]
+
+    def _undo(self):
+        system = self.system
+        self.count -= 1
+        self.steps -= 1
+        i = self.count
+        flags = self.flags[i]
+        if flags & WROTE_MEMORY:
+            system.mem.write(self.memory_value[i], self.address[i])
+        system.registers[4] = self.stack_pointer[i]
+        if self.register[i] >= 0:
+            system.registers[self.register[i]] = self.register_value[i]
+        system.overflow_flag = bool(flags & OVERFLOW)
+        system.sign_flag = bool(flags & SIGN)
+        system.zero_flag = bool(flags & ZERO)
+        system.program_counter = self.program_counter[i]
+        system.status = Status.AOK
+        system.fault_address = None
+
+    def _rewind_to_checkpoint(self, target):
+        """
+        Restores the latest checkpoint at or before step target and drops everything after it.
+        """
+        while self.checkpoints[-1][0] > target:
+            self.checkpoints.pop()
+        steps, snap = self.checkpoints[-1]
+        self.system.restore(snap)
+        self.steps = steps
+        self.count = 0
+
+    def step_back(self, n=1):
+        """
+        Undoes the last n instructions, or as many as history still holds.
+
+        :return: The number of instructions undone
+        """
+        target = max(self.steps - n, self.earliest())
+        undone = self.steps - target
+        if target < self.steps - self.count:
+            self._rewind_to_checkpoint(target)
+            while self.steps < target:
+                self.step()
+        while self.steps > target:
+            self._undo()
+        return undone
+
+    def run_back_until(self, predicate):
+        """
+        Steps backwards until predicate holds or history runs out.
+
+        :param predicate: A callable taking the System
+        :return: The number of instructions undone
+        """
+        start = self.steps
+        while self.steps > self.earliest():
+            if self.count:
+                self._undo()
+                if predicate(self.system):
+                    return start - self.steps
+                continue
+            # The undo log is used up, so replay the segment before it from its checkpoint and find the last step in
+            # it where predicate holds.
+            end = self.steps
+            self._rewind_to_checkpoint(end - 1)
+            found = self.steps if predicate(self.system) else None
+            while self.steps < end:
+                self.step()
+                if self.steps < end and predicate(self.system):
+                    found = self.steps
+            if found is not None:
+                self.step_back(end - found)
+                return start - self.steps
+            self.step_back(self.count)
+        return start - self.steps
@@ -1,5 +1,8 @@
 # This module defines the System class, which holds the entire system state and methods to carry out instructions.
 import memory as memory
+import decoder
+import sys
+from collections import namedtuple
 from enum import Enum
 
 
@@ -14,24 +17,270 @@ class Status(Enum):
     INS = 3
 
 
+class StopReason(Enum):
+    # The program executed halt
+    HALT = 0
+    # The step budget ran out
+    BUDGET = 1
+    # The program counter reached a breakpoint
+    BREAKPOINT = 2
+    # An invalid address or instruction was encountered
+    FAULT = 3
+    # The stop_on condition became true
+    CONDITION = 4
+    # The system came back to a state it had already been in, so would never stop by itself (see loops.LoopDetector)
+    LOOP = 5
+
+
+# Names of the registers, indexed by their number in the register file.
+REGISTER_NAMES = ('%rax', '%rcx', '%rdx', '%rbx', '%rsp', '%rbp', '%rsi', '%rdi', '%r8', '%r9', '%r10', '%r11', '%r12',
+                  '%r13', '%r14')
+# What System.run_until reports: instructions executed, the final Status and a StopReason.
+RunResult = namedtuple('RunResult', ['steps', 'status', 'reason'])
+# The full state of a System as saved by System.snapshot. pages are frozen pages of memory shared with the System and
+# with other snapshots.
+Snapshot = namedtuple('Snapshot', ['registers', 'program_counter', 'status', 'overflow_flag', 'sign_flag', 'zero_flag',
+                                   'fault_address', 'pages'])
+
+
 class System:
 
-    def __init__(self):
-        self.mem = memory.Memory()
+    def __init__(self, memory_size=memory.DEFAULT_SIZE):
+        """
+        :param memory_size: Number of addressable bytes of main memory, up to 2^64
+        """
+        self.mem = memory.Memory(memory_size)
         # Registers hold 64 bits, i.e python ints from 0 to 2^64 - 1
         self.registers = [0 for _ in range(15)]
         self.program_counter = 0
         self.status = Status.AOK
-        self.overflow_flag = False
-        self.sign_flag = False
-        self.zero_flag = False
+        # Condition codes are worked out lazily. After an ALU operation _alu holds (op_code, a, b, result) until a flag
+        # is read or set, and only then are the three flags below brought up to date.
+        self._alu = None
+        self._overflow_flag = False
+        self._sign_flag = False
+        self._zero_flag = False
+        # The address whose access set Status.ADR, or None
+        self.fault_address = None
+        self.decode_cache = decoder.DecodeCache(self.mem)
 
     def __repr__(self):
         return (f'registers: {[self.mem.to_signed(register) for register in self.registers]}\n'
         f'program_counter: {self.program_counter}\n'
-        f'status: {self.status}\n'
+        f'status: {self.status}{self.fault_description()}\n'
         f'overflow flag: {self.overflow_flag} ; sign flag {self.sign_flag} ; zero flag {self.zero_flag}')
 
+    def pprint(self, file=None):
+        """
+        Prints the flags, program counter, registers and status, with registers in hex and as signed values.
+
+        :param file: A text file to print to, or None for stdout
+        """
+        print(f'program counter: {self.program_counter:#x}', file=file)
+        print(f'status: {self.status.name}{self.fault_description()}', file=file)
+        print(f'flags: of={int(self.overflow_flag)} sf={int(self.sign_flag)} zf={int(self.zero_flag)}', file=file)
+        for name, value in zip(REGISTER_NAMES, self.registers):
+            print(f'{name:>5} {value:#018x} {self.mem.to_signed(value):>20}', file=file)
+
+    def _settle(self):
+        """
+        Computes the condition codes left by the last ALU operation.
+        """
+        op_code, a, b, result = self._alu
+        self._alu = None
+        if op_code == 1:
+            # Subtraction adds the two's complement negation of the source
+            b = -b & memory.WORD_MASK
+        self._overflow_flag = op_code < 2 and ((a ^ result) & (b ^ result)) >> 63 == 1
+        self._sign_flag = result >> 63 == 1
+        self._zero_flag = result == 0
+
+    @property
+    def overflow_flag(self):
+        if self._alu is not None:
+            self._settle()
+        return self._overflow_flag
+
+    @overflow_flag.setter
+    def overflow_flag(self, value):
+        if self._alu is not None:
+            self._settle()
+        self._overflow_flag = value
+
+    @property
+    def sign_flag(self):
+        if self._alu is not None:
+            self._settle()
+        return self._sign_flag
+
+    @sign_flag.setter
+    def sign_flag(self, value):
+        if self._alu is not None:
+            self._settle()
+        self._sign_flag = value
+
+    @property
+    def zero_flag(self):
+        if self._alu is not None:
+            self._settle()
+        return self._zero_flag
+
+    @zero_flag.setter
+    def zero_flag(self, value):
+        if self._alu is not None:
+            self._settle()
+        self._zero_flag = value
+
+    def snapshot(self):
+        """
+        Saves the state of the system. Memory is shared copy on write with the system and earlier snapshots, so this
+        only costs as much as the pages written since the last snapshot.
+
+        :return: A Snapshot
+        """
+        return Snapshot(tuple(self.registers), self.program_counter, self.status, self.overflow_flag, self.sign_flag,
+                        self.zero_flag, self.fault_address, self.mem.freeze())
+
+    def restore(self, snap):
+        """
+        Puts the system back into the state saved by snapshot. The snapshot can be restored again later.
+
+        :param snap: A Snapshot taken of this system
+        """
+        self.registers = list(snap.registers)
+        self.program_counter = snap.program_counter
+        self.status = snap.status
+        self.overflow_flag, self.sign_flag, self.zero_flag = snap.overflow_flag, snap.sign_flag, snap.zero_flag
+        self.fault_address = snap.fault_address
+        self.mem.thaw(snap.pages)
+
+    def fault_description(self):
+        return f' (address {self.fault_address:#x})' if self.fault_address is not None else ''
+
+    def step(self):
+        """
+        Executes the instruction pointed to by the program counter, turning accesses outside of main memory into
+        Status.ADR. The program counter is left on the faulting instruction.
+
+        :return:
+        """
+        pc = self.program_counter
+        try:
+            handler, args = self.fetch()
+            handler(*args)
+        except memory.AddressError as fault:
+            self.program_counter = pc
+            self.address_fault(fault.address)
+
+    def address_fault(self, address):
+        """
+        Sets invalid address status on the processor
+
+        :param address: The address which could not be accessed
+        :return:
+        """
+        self.status = Status.ADR
+        self.fault_address = address
+
+    def run_until(self, max_steps=None, breakpoints=None, stop_on=None):
+        """
+        Executes instructions until the status is no longer AOK or one of the given limits is reached.
+
+        Without breakpoints or stop_on the loop does nothing per instruction beyond executing it and checking status, and
+        the budget is only compared against a counter.
+
+        :param max_steps: Most instructions to execute, or None for no limit
+        :param breakpoints: A set of addresses. Execution stops before any instruction at one of them, other than the
+                            one the program counter points to when run_until is called.
+        :param stop_on: A callable taking this System, called after every instruction. Execution stops once it returns
+                        True.
+        :return: A RunResult
+        """
+        budget = sys.maxsize if max_steps is None else max_steps
+        steps = 0
+        fetch = self.fetch
+        aok = Status.AOK
+        reason = None
+        try:
+            if not breakpoints and stop_on is None:
+                while self.status is aok and steps < budget:
+                    steps += 1
+                    handler, args = fetch()
+                    handler(*args)
+            else:
+                while self.status is aok and steps < budget:
+                    if steps and breakpoints and self.program_counter in breakpoints:
+                        reason = StopReason.BREAKPOINT
+                        break
+                    steps += 1
+                    handler, args = fetch()
+                    handler(*args)
+                    if stop_on is not None and stop_on(self):
+                        reason = StopReason.CONDITION
+                        break
+        except memory.AddressError as fault:
+            # Instructions only move the program counter once they can no longer fault, so it still points at the
+            # faulting instruction.
+            self.address_fault(fault.address)
+
+        if self.status == Status.HLT:
+            reason = StopReason.HALT
+        elif self.status != aok:
+            reason = StopReason.FAULT
+        elif reason is None:
+            reason = StopReason.BUDGET
+        return RunResult(steps, self.status, reason)
+
+    def fetch(self):
+        """
+        Looks up the instruction pointed to by the program counter, decoding it and caching the result on first use.
+
+        :return: A 2-tuple of a bound method which executes the instruction and the arguments to call it with
+        """
+        try:
+            return self.decode_cache.entries[self.program_counter]
+        except KeyError:
+            ins = decoder.decode(self.mem, self.program_counter)
+            record = self.bind(ins)
+            self.decode_cache.insert(self.program_counter, ins.next_pc - self.program_counter, record)
+            return record
+
+    def bind(self, ins):
+        """
+        :param ins: A decoder.Decoded instruction
+        :return: A 2-tuple of the method which carries out ins and the arguments it should be called with
+        """
+        icode, ifun, reg_a, reg_b, value = ins.icode, ins.ifun, ins.reg_a, ins.reg_b, ins.value
+        if decoder.uses_missing_register(ins):
+            return self.invalid, ()
+        if icode == 0:
+            return self.halt, ()
+        elif icode == 1:
+            return self.nop, ()
+        elif icode == 2:
+            if ifun == 0:
+                return self.rrmovq, (reg_a, reg_b)
+            return self.cmovxx, (reg_a, reg_b, ifun)
+        elif icode == 3:
+            return self.irmovq, (value, reg_b)
+        elif icode == 4:
+            return self.rmmovq, (reg_a, reg_b, value)
+        elif icode == 5:
+            return self.mrmovq, (reg_b, reg_a, value)
+        elif icode == 6:
+            return self.bin_op, (reg_a, reg_b, ifun)
+        elif icode == 7:
+            return self.jxx, (value, ifun)
+        elif icode == 8:
+            return self.call, (value,)
+        elif icode == 9:
+            return self.ret, ()
+        elif icode == 10:
+            return self.pushq, (reg_a,)
+        elif icode == 11:
+            return self.popq, (reg_a,)
+        return self.invalid, ()
+
     def halt(self):
         """
         Sets halt status on the processor
@@ -40,6 +289,17 @@ class System:
         """
         self.status = Status.HLT
 
+    def nop(self):
+        self.program_counter += 1
+
+    def invalid(self):
+        """
+        Sets invalid instruction status on the processor
+
+        :return:
+        """
+        self.status = Status.INS
+
     def bin_op(self, src, dest, op_code):
         """
         Executes instructions which consist of binary operations on words in registers.
@@ -49,24 +309,24 @@ class System:
         :param op_code: Specifies which binary operation to perform.
         :return:
         """
-        src_val, dest_val = self.registers[src], self.registers[dest]
-        overflow = False
+        registers = self.registers
+        src_val, dest_val = registers[src], registers[dest]
         if op_code == 0:
-            overflow, self.registers[dest] = self.mem.overflowing_add(dest_val, src_val)
+            result = (dest_val + src_val) & memory.WORD_MASK
         elif op_code == 1:
             # dest - src
-            overflow, self.registers[dest] = self.mem.overflowing_sub(dest_val, src_val)
+            result = (dest_val - src_val) & memory.WORD_MASK
         elif op_code == 2:
-            self.registers[dest] = src_val & dest_val
+            result = src_val & dest_val
         elif op_code == 3:
-            self.registers[dest] = src_val ^ dest_val
+            result = src_val ^ dest_val
         else:
             self.status = Status.INS
             return
 
-        self.overflow_flag = overflow
-        self.sign_flag = self.mem.to_signed(self.registers[dest]) < 0
-        self.zero_flag = self.registers[dest] == 0
+        registers[dest] = result
+        # Flags are only worked out if something reads them before the next ALU operation replaces them.
+        self._alu = (op_code, dest_val, src_val, result)
         self.program_counter += 2
 
     def jxx(self, dest, op_code):
@@ -78,21 +338,24 @@ class System:
         :return:
         """
         will_jump = False
+        # The flags are read directly, so bring them up to date first.
+        if self._alu is not None:
+            self._settle()
 
         if op_code == 0:
             will_jump = True
         elif op_code == 1:
-            will_jump = self.zero_flag or (self.sign_flag != self.overflow_flag)
+            will_jump = self._zero_flag or (self._sign_flag != self._overflow_flag)
         elif op_code == 2:
-            will_jump = self.sign_flag != self.overflow_flag
+            will_jump = self._sign_flag != self._overflow_flag
         elif op_code == 3:
-            will_jump = self.zero_flag
+            will_jump = self._zero_flag
         elif op_code == 4:
-            will_jump = not self.zero_flag
+            will_jump = not self._zero_flag
         elif op_code == 5:
-            will_jump = self.zero_flag or (self.sign_flag == self.overflow_flag)
+            will_jump = self._zero_flag or (self._sign_flag == self._overflow_flag)
         elif op_code == 6:
-            will_jump = not self.zero_flag and (self.sign_flag == self.overflow_flag)
+            will_jump = not self._zero_flag and (self._sign_flag == self._overflow_flag)
         else:
             self.status = Status.INS
             return
@@ -132,7 +395,7 @@ class System:
         :param displacement: The difference between where we wish to write to memory and the contents dest_reg
         :return:
         """
-        destination = self.registers[dest_reg] + displacement
+        destination = (self.registers[dest_reg] + displacement) & memory.WORD_MASK
         self.mem.write(self.registers[src], destination)
         self.program_counter += 10
 
@@ -145,28 +408,30 @@ class System:
         :param displacement: Where in memory you wish to read from relative to the address held by src_reg
         :return:
         """
-        source = self.registers[src_reg] + displacement
+        source = (self.registers[src_reg] + displacement) & memory.WORD_MASK
         self.registers[dest] = self.mem.read(source)
         self.program_counter += 10
 
     def cmovxx(self, src, dest, op_code):
         will_move = False
+        # The flags are read directly, so bring them up to date first.
+        if self._alu is not None:
+            self._settle()
 
         if op_code == 0:
             will_move = True
         elif op_code == 1:
-            print('here')
-            will_move = self.zero_flag or (self.sign_flag != self.overflow_flag)
+            will_move = self._zero_flag or (self._sign_flag != self._overflow_flag)
         elif op_code == 2:
-            will_move = self.sign_flag != self.overflow_flag
+            will_move = self._sign_flag != self._overflow_flag
         elif op_code == 3:
-            will_move = self.zero_flag
+            will_move = self._zero_flag
         elif op_code == 4:
-            will_move = not self.zero_flag
+            will_move = not self._zero_flag
         elif op_code == 5:
-            will_move = self.zero_flag or (self.sign_flag == self.overflow_flag)
+            will_move = self._zero_flag or (self._sign_flag == self._overflow_flag)
         elif op_code == 6:
-            will_move = (not self.zero_flag) and (self.sign_flag == self.overflow_flag)
+            will_move = (not self._zero_flag) and (self._sign_flag == self._overflow_flag)
         else:
             self.status = Status.INS
             return
@@ -177,23 +442,22 @@ class System:
         self.program_counter += 2
 
     def pushq(self, src):
-        # Register four is the stack pointer
-        self.registers[4] -= 8
+        # Register four is the stack pointer. Like every address it wraps around at 2^64.
+        self.registers[4] = (self.registers[4] - 8) & memory.WORD_MASK
         self.mem.write(self.registers[src], self.registers[4])
         self.program_counter += 2
 
     def popq(self, dest):
         self.registers[dest] = self.mem.read(self.registers[4])
-        self.registers[4] += 8
+        self.registers[4] = (self.registers[4] + 8) & memory.WORD_MASK
         self.program_counter += 2
 
     def call(self, dest):
-        self.registers[4] -= 8
-        self.program_counter += 9
-        self.mem.write(self.program_counter, self.registers[4])
+        self.registers[4] = (self.registers[4] - 8) & memory.WORD_MASK
+        self.mem.write(self.program_counter + 9, self.registers[4])
         self.program_counter = dest
 
     def ret(self):
         address = self.mem.read(self.registers[4])
-        self.registers[4] += 8
+        self.registers[4] = (self.registers[4] + 8) & memory.WORD_MASK
         self.program_counter = address
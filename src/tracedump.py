@@ -0,0 +1,89 @@
+"""
+This module prints traces written by tracing.Tracer as text, one line per instruction, optionally keeping only some
+program counters or kinds of instruction. For example:
+
+    python tracedump.py trace.bin --pc 0x100:0x200 --op mrmovq --op jxx
+"""
+import argparse
+import sys
+
+import assembler
+import tracing
+from profiler import MNEMONIC, OPCODE_CLASS
+
+REGISTER_NAME = {index: name for name, index in assembler.REGISTER_INDEX.items()}
+
+
+def mnemonic(code):
+    """
+    :param code: The icode << 4 | ifun byte of a record
+    :return: The name of the instruction, or 'invalid'
+    """
+    return MNEMONIC.get((code >> 4, code & 0xf), 'invalid')
+
+
+def parse_range(text):
+    """
+    :param text: An address, or two separated by a colon with either one left out
+    :return: A 2-tuple of the first address in the range and the one after the last
+    """
+    if ':' not in text:
+        address = int(text, 0)
+        return address, address + 1
+    low, high = text.split(':', 1)
+    return int(low, 0) if low else 0, int(high, 0) if high else 2 ** 64
+
+
+def matches(record, pc_ranges, ops):
+    """
+    :param pc_ranges: A list of ranges from parse_range, any of which the program counter must fall in, or an empty list
+    :param ops: A set of instruction names and kinds of instruction (as named by profiler.OPCODE_CLASS), one of which
+                the instruction must be, or an empty set
+    """
+    if pc_ranges and not any(low <= record.pc < high for low, high in pc_ranges):
+        return False
+    if ops:
+        kind = OPCODE_CLASS[record.code >> 4] if record.code != 0xff else 'invalid'
+        return mnemonic(record.code) in ops or kind in ops
+    return True
+
+
+def format_record(record):
+    """
+    :return: A line of text describing a tracing.Record
+    """
+    flags = record.flags
+    parts = [f'{record.step:>10} {record.pc:#08x} {mnemonic(record.code):<7} {tracing.STATUS[record.status].name}',
+             f'of={int(bool(flags & tracing.OVERFLOW))} sf={int(bool(flags & tracing.SIGN))} '
+             f'zf={int(bool(flags & tracing.ZERO))}']
+    if record.register >= 0:
+        parts.append(f'{REGISTER_NAME[record.register]}={record.register_value:#x}')
+    parts.append(f'%rsp={record.stack_pointer:#x}')
+    if flags & tracing.WROTE_MEMORY:
+        parts.append(f'write [{record.address:#x}]={record.memory_value:#x}')
+    elif flags & tracing.READ_MEMORY:
+        parts.append(f'read [{record.address:#x}]={record.memory_value:#x}')
+    return ' '.join(parts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Print a Y86_64 execution trace as text.')
+    parser.add_argument('trace', help='trace file written by tracing.Tracer')
+    parser.add_argument('--pc', action='append', default=[], metavar='LOW:HIGH',
+                        help='only show instructions at an address, or in a range of them (repeatable)')
+    parser.add_argument('--op', action='append', default=[], metavar='NAME',
+                        help='only show an instruction, such as mrmovq, or kind of instruction, such as jxx '
+                             '(repeatable)')
+    args = parser.parse_args()
+
+    pc_ranges = [parse_range(text) for text in args.pc]
+    ops = set(args.op)
+    with open(args.trace, 'rb') as file:
+        for record in tracing.read_records(file):
+            if matches(record, pc_ranges, ops):
+                print(format_record(record))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
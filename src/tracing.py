@@ -0,0 +1,202 @@
+"""
+This module records a trace of a running System as fixed size binary records, one per executed instruction.
+
+Each record holds the step number, program counter, icode and ifun, the status and condition codes after the
+instruction, the register it wrote other than the stack pointer along with its new value, the new stack pointer, and
+the address and value of any memory word it read or wrote.
+
+A Tracer either keeps the most recent records in a ring buffer, so the lead up to a fault can be looked at afterwards,
+or streams every record to a file, buffering a block of records between writes. Trace files start with a short header
+and can be read back with read_records, or printed with tracedump.py.
+"""
+from collections import namedtuple
+import struct
+
+import decoder
+from memory import AddressError, Memory, WORD_MASK
+from recorder import written_register
+from system import Status
+
+MAGIC = b'Y86T'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sHH')
+RECORD = struct.Struct('<QQBBbBQQQQ')
+# Bits of the flags field of a record
+OVERFLOW, SIGN, ZERO, READ_MEMORY, WROTE_MEMORY = 1, 2, 4, 8, 16
+# Records kept by a ring buffer, or buffered between writes to a file, when no capacity is given.
+DEFAULT_CAPACITY = 4096
+STATUS = {status.value: status for status in Status}
+
+Record = namedtuple('Record', ['step', 'pc', 'code', 'flags', 'register', 'status', 'register_value',
+                               'stack_pointer', 'address', 'memory_value'])
+
+
+def memory_access(ins, registers):
+    """
+    :param ins: A decoder.Decoded instruction
+    :param registers: Register values before ins executes
+    :return: A 2-tuple of the address of the word ins will access and READ_MEMORY or WROTE_MEMORY, or (0, 0) if it
+             doesn't access memory.
+    """
+    icode = ins.icode
+    if icode in (4, 5) and ins.reg_b < 15:
+        return (registers[ins.reg_b] + ins.value) & WORD_MASK, WROTE_MEMORY if icode == 4 else READ_MEMORY
+    if icode in (8, 10):
+        return (registers[4] - 8) & WORD_MASK, WROTE_MEMORY
+    if icode in (9, 11):
+        return registers[4], READ_MEMORY
+    return 0, 0
+
+
+class Tracer:
+    """
+    Runs a System while recording a trace of it.
+    """
+    def __init__(self, system, capacity=DEFAULT_CAPACITY, file=None):
+        """
+        :param system: The System to trace
+        :param capacity: Records kept by the ring buffer, or held between writes when streaming to file
+        :param file: A file open for binary writing to stream the trace to, or None to keep a ring buffer
+        """
+        self.system = system
+        self.capacity = capacity
+        self.file = file
+        self.buffer = bytearray(RECORD.size * capacity)
+        # Records in the buffer, which for a ring buffer is at most capacity however many have been recorded
+        self.count = 0
+        # Where the next record goes in the ring buffer
+        self.next = 0
+        self.steps = 0
+        self.decoded = decoder.DecodeCache(system.mem)
+        if file is not None:
+            file.write(HEADER.pack(MAGIC, FORMAT_VERSION, RECORD.size))
+
+    def _decode(self, address):
+        try:
+            return self.decoded.entries[address]
+        except KeyError:
+            ins = decoder.decode(self.system.mem, address)
+            self.decoded.insert(address, ins.next_pc - address, ins)
+            return ins
+
+    def step(self):
+        """
+        Executes and records one instruction.
+
+        :return: True if the system is still AOK afterwards, False otherwise.
+        """
+        system = self.system
+        if system.status != Status.AOK:
+            return False
+        registers = system.registers
+        pc = system.program_counter
+        try:
+            ins = self._decode(pc)
+        except AddressError:
+            ins = None
+        code, register, address, access = 0xff, -1, 0, 0
+        if ins is not None:
+            code = ins.icode << 4 | ins.ifun
+            register = written_register(ins)
+            if register > 14:
+                register = -1
+            address, access = memory_access(ins, registers)
+
+        system.step()
+
+        flags = system.overflow_flag * OVERFLOW | system.sign_flag * SIGN | system.zero_flag * ZERO
+        memory_value = 0
+        if access and system.status == Status.AOK:
+            flags |= access
+            memory_value = Memory.read(system.mem, address)
+        else:
+            address = 0
+        self._append(self.steps, pc, code, flags, register, system.status.value,
+                     registers[register] & WORD_MASK if register >= 0 else 0, registers[4] & WORD_MASK, address,
+                     memory_value)
+        self.steps += 1
+        return system.status == Status.AOK
+
+    def _append(self, *fields):
+        RECORD.pack_into(self.buffer, self.next * RECORD.size, *fields)
+        self.next += 1
+        if self.file is None:
+            self.count = min(self.count + 1, self.capacity)
+            if self.next == self.capacity:
+                self.next = 0
+        else:
+            self.count += 1
+            if self.count == self.capacity:
+                self.flush()
+
+    def run(self, max_steps=None):
+        """
+        Executes and records instructions until the system stops being AOK or max_steps have run.
+
+        :return: The number of instructions executed
+        """
+        steps = 0
+        while self.system.status == Status.AOK and (max_steps is None or steps < max_steps):
+            self.step()
+            steps += 1
+        return steps
+
+    def flush(self):
+        """
+        Writes buffered records to the trace file, when streaming.
+        """
+        if self.file is not None and self.count:
+            self.file.write(memoryview(self.buffer)[:self.count * RECORD.size])
+            self.count = 0
+            self.next = 0
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.flush()
+
+    def raw(self):
+        """
+        :return: The bytes of the records held in memory, oldest first.
+        """
+        if self.file is None and self.count == self.capacity:
+            split = self.next * RECORD.size
+            return bytes(self.buffer[split:] + self.buffer[:split])
+        return bytes(self.buffer[:self.count * RECORD.size])
+
+    def records(self):
+        """
+        :return: A list of the Records held in memory, oldest first.
+        """
+        return [Record(*fields) for fields in RECORD.iter_unpack(self.raw())]
+
+    def save(self, file):
+        """
+        Writes the ring buffer to a file as a trace, for instance after a fault.
+
+        :param file: A file open for binary writing
+        """
+        file.write(HEADER.pack(MAGIC, FORMAT_VERSION, RECORD.size))
+        file.write(self.raw())
+
+
+def read_records(file, chunk_records=DEFAULT_CAPACITY):
+    """
+    :param file: A trace file open for binary reading
+    :param chunk_records: Records read from the file at a time
+    :return: A generator of the Records in the file
+    """
+    header = file.read(HEADER.size)
+    if len(header) < HEADER.size or header[:len(MAGIC)] != MAGIC:
+        raise ValueError('not a Y86_64 trace file')
+    _, version, size = HEADER.unpack(header)
+    if version != FORMAT_VERSION or size != RECORD.size:
+        raise ValueError(f'trace format version {version} with {size} byte records is not supported')
+    while True:
+        chunk = file.read(RECORD.size * chunk_records)
+        # A trace cut short by a crash may end with part of a record, which is ignored.
+        chunk = chunk[:len(chunk) - len(chunk) % RECORD.size]
+        if not chunk:
+            return
+        for fields in RECORD.iter_unpack(chunk):
+            yield Record(*fields)
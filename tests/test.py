@@ -1,14 +1,39 @@
+import ast
+import concurrent.futures
+import contextlib
+import io
+import json
+import tempfile
 import unittest
+from unittest import mock
 import sys
 import os
 import os
 import sys
 sys.path.insert(0, os.path.abspath( os.path.join(os.path.dirname(__file__), 
                                                '../src/') ))
-from instructions import System, Status
+from system import System, Status, StopReason
 from memory import Memory
+import Y86_64
 from Y86_64 import run
 from assembler import tokenize, mem_map, encode
+from compiler import BlockEngine
+import batch
+import lockstep
+from recorder import Recorder
+from profiler import Profiler
+from pipeline import PipelineModel
+from cache import DataCache
+import objfile
+import dump
+import tracing
+import tracedump
+from asmcache import AssemblyCache
+import assembler
+import engines
+import benchmark
+import debugger
+import loops
 
 class TestISAImplementation(unittest.TestCase):
 
@@ -434,3 +459,1445 @@ class TestISAImplementation(unittest.TestCase):
         print(sys.registers[0])
         self.assertTrue(True)
 
+    NEGATIVE_DISPLACEMENT = '''irmovq 0x200, %rbp
+rmmovq %rbp, -8(%rbp)
+mrmovq -8(%rbp), %rax
+irmovq 0, %rsp
+pushq %rax'''
+
+    def test_negative_displacement(self):
+        """
+        Addresses and the stack pointer wrap around at 2^64, so -8(%rbp) is the word before %rbp and pushing with %rsp
+        at zero faults at the top of the address space.
+        """
+        for name in engines.ENGINES:
+            with self.subTest(engine=name):
+                system = System()
+                assembler.assemble(self.NEGATIVE_DISPLACEMENT.split('\n'), system)
+                engines.create(name, system).run()
+                self.assertEqual(system.mem.read(0x1f8), 0x200)
+                self.assertEqual(system.registers[0], 0x200)
+                self.assertEqual((system.status, system.fault_address), (Status.ADR, 2 ** 64 - 8))
+                self.assertEqual(system.registers[4], 2 ** 64 - 8)
+        if lockstep.np is not None:
+            template = System()
+            assembler.assemble(self.NEGATIVE_DISPLACEMENT.split('\n'), template)
+            engine = lockstep.LockstepEngine(template, 2)
+            engine.run()
+            for index in range(2):
+                with self.subTest(engine='lockstep', lane=index):
+                    system = engine.lane(index)
+                    self.assertEqual(system.mem.read(0x1f8), 0x200)
+                    self.assertEqual(system.registers[0], 0x200)
+                    self.assertEqual((system.status, system.fault_address), (Status.ADR, 2 ** 64 - 8))
+                    self.assertEqual(system.registers[4], 2 ** 64 - 8)
+
+
+
+class TestDecodeCache(unittest.TestCase):
+
+    def test_cache_reused(self):
+        """
+        irmovq 5, %rax
+        addq %rax, %rax
+        """
+        system = System()
+        byte_list = Memory.hex_string_to_bytes("30f005000000000000006000")
+        for i, byte in enumerate(byte_list):
+            system.mem.main[i] = byte
+
+        while run(system):
+            pass
+        self.assertEqual(sorted(system.decode_cache.entries), [0, 10, 12])
+        self.assertEqual(system.registers[0], 10)
+
+    def test_self_modifying(self):
+        """
+        The second call runs the irmovq that rmmovq wrote over the first instruction of func.
+        Expected result: %rax = 1 + 7
+        """
+        source = '''
+        irmovq stack, %rsp
+        call func
+        irmovq 0x7f330, %rcx
+        rmmovq %rcx, 256(%rdx)
+        call func
+        halt
+        .pos 0x100
+        func:
+        irmovq 1, %rbx
+        addq %rbx, %rax
+        ret
+        .pos 0x200
+        stack:
+        '''
+        system = System()
+        encode(mem_map(tokenize(source.split('\n'))), system)
+
+        while run(system):
+            pass
+        self.assertEqual(system.registers[0], 8)
+
+
+class TestBlockEngine(unittest.TestCase):
+
+    SUM_LOOP = '''
+    irmovq stack, %rsp
+    irmovq 50, %rcx
+    irmovq 1, %rsi
+    loop:
+    addq %rcx, %rax
+    pushq %rax
+    popq %rdx
+    subq %rsi, %rcx
+    cmovg %rdx, %rbx
+    jne loop
+    halt
+    .pos 0x200
+    stack:
+    '''
+
+    def assert_same_state(self, interpreted, compiled):
+        self.assertEqual(interpreted.registers, compiled.registers)
+        self.assertEqual(interpreted.program_counter, compiled.program_counter)
+        self.assertEqual(interpreted.status, compiled.status)
+        self.assertEqual((interpreted.overflow_flag, interpreted.sign_flag, interpreted.zero_flag),
+                         (compiled.overflow_flag, compiled.sign_flag, compiled.zero_flag))
+        self.assertEqual(interpreted.mem.main, compiled.mem.main)
+
+    def test_matches_run(self):
+        interpreted, compiled = System(), System()
+        for system in (interpreted, compiled):
+            encode(mem_map(tokenize(self.SUM_LOOP.split('\n'))), system)
+
+        while run(interpreted):
+            pass
+        BlockEngine(compiled).run()
+        self.assert_same_state(interpreted, compiled)
+        self.assertEqual(compiled.registers[0], 1275)
+
+    def test_step_budget(self):
+        for budget in (1, 4, 9, 100):
+            interpreted, compiled = System(), System()
+            for system in (interpreted, compiled):
+                encode(mem_map(tokenize(self.SUM_LOOP.split('\n'))), system)
+
+            for _ in range(budget):
+                run(interpreted)
+            self.assertEqual(BlockEngine(compiled).run(budget), budget)
+            self.assert_same_state(interpreted, compiled)
+
+    def test_self_modifying(self):
+        """
+        rmmovq overwrites the instruction that follows it within the same block.
+        Expected result: %rax = 7
+        """
+        source = '''
+        irmovq 0x7f030, %rcx
+        irmovq 30, %rdx
+        rmmovq %rcx, 0(%rdx)
+        irmovq 1, %rax
+        halt
+        '''
+        system = System()
+        encode(mem_map(tokenize(source.split('\n'))), system)
+
+        BlockEngine(system).run()
+        self.assertEqual(system.registers[0], 7)
+        self.assertEqual(system.status, Status.HLT)
+
+
+class TestMemory(unittest.TestCase):
+
+    def test_read_write(self):
+        mem = Memory()
+        mem.write(0x0102030405060708, 16)
+        self.assertEqual(list(mem.main[16:24]), [8, 7, 6, 5, 4, 3, 2, 1])
+        self.assertEqual(mem.read(16), 0x0102030405060708)
+        mem.write(-1, 32)
+        self.assertEqual(mem.read(32), 2 ** 64 - 1)
+
+    def test_out_of_range(self):
+        mem = Memory()
+        with self.assertRaises(IndexError):
+            mem.read(4090)
+        with self.assertRaises(IndexError):
+            mem.write(1, 2 ** 64 - 8)
+
+    def test_sparse_pages(self):
+        """
+        irmovq 0xfffff000, %rsp
+        irmovq 5, %rax
+        pushq %rax
+        popq %rbx
+        """
+        source = '''
+        irmovq 0xfffff000, %rsp
+        irmovq 5, %rax
+        pushq %rax
+        popq %rbx
+        '''
+        system = System(memory_size=2 ** 32)
+        encode(mem_map(tokenize(source.split('\n'))), system)
+
+        while run(system):
+            pass
+        self.assertEqual(system.registers[3], 5)
+        self.assertEqual(sorted(system.mem.page_numbers()), [0, 0xfffff000 // system.mem.page_size - 1])
+
+    def test_address_fault(self):
+        """
+        irmovq 4096, %rcx
+        mrmovq 0(%rcx), %rax
+        Expected result: ADR status at the mrmovq
+        """
+        source = '''
+        irmovq 4096, %rcx
+        mrmovq 0(%rcx), %rax
+        '''
+        interpreted, compiled = System(), System()
+        for system in (interpreted, compiled):
+            encode(mem_map(tokenize(source.split('\n'))), system)
+
+        while run(interpreted):
+            pass
+        BlockEngine(compiled).run()
+        for system in (interpreted, compiled):
+            self.assertEqual(system.status, Status.ADR)
+            self.assertEqual(system.fault_address, 4096)
+            self.assertEqual(system.program_counter, 10)
+
+    def test_fingerprint(self):
+        mem = Memory()
+        empty = mem.fingerprint()
+        mem.write(7, 100)
+        mem.store(300, b'\x01\x02\x03')
+        mem.main[20] = 9
+        snapshot = mem.freeze()
+        mem.write(0, 100)
+        mem.write(2 ** 64 - 1, 4000)
+        changed = mem.fingerprint()
+        mem.thaw(snapshot)
+        restored = mem.fingerprint()
+
+        # Whatever way memory got its contents, the fingerprint is the one worked out from scratch.
+        fresh = Memory()
+        fresh.store(0, mem.load(0, mem.size))
+        self.assertEqual(restored, fresh.fingerprint())
+        self.assertEqual(len({empty, changed, restored}), 3)
+        mem.write(0, 100)
+        mem.write(2 ** 64 - 1, 4000)
+        self.assertEqual(mem.fingerprint(), changed)
+
+
+class TestRunUntil(unittest.TestCase):
+
+    COUNT_DOWN = '''
+    irmovq 10, %rcx
+    irmovq 1, %rsi
+    loop:
+    subq %rsi, %rcx
+    jne loop
+    halt
+    '''
+
+    def load(self, source):
+        system = System()
+        encode(mem_map(tokenize(source.split('\n'))), system)
+        return system
+
+    def test_halt(self):
+        system = self.load(self.COUNT_DOWN)
+        result = system.run_until()
+        self.assertEqual(result.reason, StopReason.HALT)
+        self.assertEqual(result.status, Status.HLT)
+        self.assertEqual(result.steps, 23)
+
+    def test_budget(self):
+        system = self.load(self.COUNT_DOWN)
+        result = system.run_until(max_steps=5)
+        self.assertEqual((result.steps, result.reason), (5, StopReason.BUDGET))
+        self.assertEqual(system.registers[1], 8)
+
+    def test_breakpoint(self):
+        system = self.load(self.COUNT_DOWN)
+        self.assertEqual(system.run_until(breakpoints={22}).steps, 3)
+        result = system.run_until(breakpoints={22})
+        self.assertEqual((result.steps, result.reason), (2, StopReason.BREAKPOINT))
+        self.assertEqual(system.registers[1], 8)
+
+    def test_stop_on(self):
+        system = self.load(self.COUNT_DOWN)
+        result = system.run_until(stop_on=lambda s: s.registers[1] == 4)
+        self.assertEqual(result.reason, StopReason.CONDITION)
+        self.assertEqual(system.program_counter, 22)
+
+    def test_fault(self):
+        system = self.load('''
+        irmovq 8192, %rsp
+        popq %rax
+        ''')
+        result = system.run_until()
+        self.assertEqual((result.status, result.reason), (Status.ADR, StopReason.FAULT))
+        self.assertEqual(system.fault_address, 8192)
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        with open(os.path.join(self.directory.name, 'count.ys'), 'w') as file:
+            file.write('irmovq 1, %rsi\nloop:\nsubq %rsi, %rcx\njne loop\nhalt\n')
+        with open(os.path.join(self.directory.name, 'spin.ys'), 'w') as file:
+            file.write('loop: jmp loop\n')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_overrides(self):
+        job = {'source': os.path.join(self.directory.name, 'count.ys'), 'registers': {'%rcx': 3},
+               'memory': {'0x100': '-1'}}
+        result = batch.run_job(job)
+        self.assertEqual((result['status'], result['reason'], result['steps']), ('HLT', 'halt', 8))
+        self.assertEqual(result['registers']['%rcx'], 0)
+
+    def test_run_batch(self):
+        output = io.StringIO()
+        halted = batch.run_batch(batch.find_jobs(self.directory.name), output, workers=2, max_steps=500)
+        results = {os.path.basename(result['source']): result
+                   for result in map(json.loads, output.getvalue().splitlines())}
+        self.assertEqual(halted, 0)
+        self.assertEqual(results['spin.ys']['reason'], 'budget')
+        self.assertEqual(results['spin.ys']['steps'], 500)
+        self.assertEqual(results['count.ys']['reason'], 'budget')
+
+    def test_worker_died(self):
+        run_job = batch.run_job
+
+        def crash(job, *arguments):
+            if job['source'].endswith('spin.ys'):
+                raise concurrent.futures.process.BrokenProcessPool('A child process terminated abruptly')
+            return run_job(job, *arguments)
+
+        output = io.StringIO()
+        # Threads run the mocked run_job in this process, where a process pool's workers wouldn't see it.
+        with mock.patch('concurrent.futures.ProcessPoolExecutor', concurrent.futures.ThreadPoolExecutor), \
+                mock.patch('batch.run_job', crash):
+            batch.run_batch(batch.find_jobs(self.directory.name), output, workers=2, max_steps=500)
+        results = {os.path.basename(result['source']): result
+                   for result in map(json.loads, output.getvalue().splitlines())}
+        self.assertEqual(results['spin.ys'], {'source': os.path.join(self.directory.name, 'spin.ys'),
+                                              'error': 'BrokenProcessPool: A child process terminated abruptly'})
+        self.assertEqual(results['count.ys']['reason'], 'budget')
+
+
+@unittest.skipUnless(lockstep.np is not None, 'numpy is not installed')
+class TestLockstepEngine(unittest.TestCase):
+
+    PROGRAM = '''
+    irmovq stack, %rsp
+    irmovq data, %rdi
+    irmovq 1, %rsi
+    loop:
+    mrmovq 0(%rdi), %rdx
+    addq %rcx, %rdx
+    rmmovq %rdx, 0(%rdi)
+    call func
+    subq %rsi, %rcx
+    jg loop
+    cmovl %rsi, %rbx
+    halt
+    func:
+    pushq %rcx
+    xorq %rax, %rcx
+    popq %r8
+    addq %r8, %rax
+    ret
+    .align 8
+    data:
+    .quad 5
+    .pos 0x400
+    stack:
+    '''
+
+    def test_lanes_match_system(self):
+        counts = [0, 1, 3, 2 ** 64 - 2, 2 ** 63, 12]
+        template = System()
+        encode(mem_map(tokenize(self.PROGRAM.split('\n'))), template)
+        engine = lockstep.LockstepEngine(template, len(counts))
+        engine.registers[:, 1] = lockstep.np.array(counts, dtype=lockstep.np.uint64)
+        engine.run(max_steps=200)
+
+        for lane, count in enumerate(counts):
+            system = System()
+            encode(mem_map(tokenize(self.PROGRAM.split('\n'))), system)
+            system.registers[1] = count
+            system.run_until(max_steps=200)
+            result = engine.lane(lane)
+            self.assertEqual(system.registers, result.registers)
+            self.assertEqual((system.program_counter, system.status), (result.program_counter, result.status))
+            self.assertEqual((system.overflow_flag, system.sign_flag, system.zero_flag),
+                             (result.overflow_flag, result.sign_flag, result.zero_flag))
+            self.assertTrue(system.mem.main == result.mem.main)
+
+    def test_address_fault(self):
+        template = System()
+        encode(mem_map(tokenize(['mrmovq 0(%rcx), %rax'])), template)
+        engine = lockstep.LockstepEngine(template, 2)
+        engine.registers[1, 1] = 4090
+        engine.run()
+        self.assertEqual(engine.lane(0).status, Status.HLT)
+        self.assertEqual(engine.lane(1).status, Status.ADR)
+        self.assertEqual(engine.lane(1).fault_address, 4090)
+
+
+class TestSnapshot(unittest.TestCase):
+
+    PROGRAM = '''
+    irmovq stack, %rsp
+    irmovq 1, %rsi
+    loop:
+    pushq %rcx
+    subq %rsi, %rcx
+    jg loop
+    halt
+    .pos 0x800
+    stack:
+    '''
+
+    def test_restore(self):
+        system = System()
+        encode(mem_map(tokenize(self.PROGRAM.split('\n'))), system)
+        system.run_until(max_steps=2)
+        boot = system.snapshot()
+
+        system.registers[1] = 3
+        system.run_until()
+        first = (list(system.registers), system.mem.digest())
+        system.restore(boot)
+        self.assertEqual(system.program_counter, 20)
+        self.assertEqual(system.status, Status.AOK)
+        self.assertEqual(system.mem.read(0x7f8), 0)
+
+        system.registers[1] = 3
+        system.run_until()
+        self.assertEqual((system.registers, system.mem.digest()), first)
+
+    def test_pages_shared(self):
+        system = System()
+        encode(mem_map(tokenize(self.PROGRAM.split('\n'))), system)
+        system.registers[1] = 2
+        system.run_until(max_steps=3)
+        first = system.snapshot()
+        system.run_until()
+        second = system.snapshot()
+        self.assertIs(first.pages[0], second.pages[0])
+        self.assertIsNot(first.pages[7], second.pages[7])
+        self.assertEqual(first.pages[7][-8], 2)
+        self.assertEqual(second.pages[7][-16], 1)
+
+    def test_snapshot_cost(self):
+        """
+        Freezing only copies the pages written since the last freeze, so a chain of snapshots stays short.
+        """
+        mem = Memory(2 ** 32)
+        for number in range(1000):
+            mem.write(number, number * mem.page_size)
+        first = mem.freeze()
+        snapshots = []
+        for number in range(100):
+            mem.write(-number, number * mem.page_size)
+            snapshots.append(mem.freeze())
+            self.assertLessEqual(len(snapshots[-1].pages), 128)
+        chain = [snapshots[-1]]
+        while chain[-1].parent is not None:
+            chain.append(chain[-1].parent)
+        self.assertIs(chain[-1], first)
+        self.assertLessEqual(len(chain), 8)
+        mem.thaw(snapshots[10])
+        self.assertEqual([mem.read(number * mem.page_size) for number in (10, 11)], [2 ** 64 - 10, 11])
+        mem.thaw(first)
+        self.assertEqual(mem.read(10 * mem.page_size), 10)
+
+    def test_restore_invalidates_code(self):
+        """
+        Restoring memory written by a self modifying program must bring the old instructions back.
+        """
+        source = '''
+        irmovq 0x7f030, %rcx
+        rmmovq %rcx, 20(%rdx)
+        irmovq 1, %rax
+        halt
+        '''
+        system = System()
+        encode(mem_map(tokenize(source.split('\n'))), system)
+        start = system.snapshot()
+        system.run_until()
+        self.assertEqual(system.registers[0], 7)
+        system.restore(start)
+        system.run_until(max_steps=1)
+        system.program_counter = 20
+        system.run_until()
+        self.assertEqual(system.registers[0], 1)
+
+
+class TestRecorder(unittest.TestCase):
+
+    PROGRAM = '''
+    irmovq stack, %rsp
+    irmovq 1, %rsi
+    irmovq 6, %rcx
+    loop:
+    pushq %rcx
+    call func
+    popq %rdx
+    subq %rsi, %rcx
+    jg loop
+    halt
+    func:
+    rmmovq %rcx, 768(%rcx)
+    addq %rcx, %rax
+    ret
+    .pos 0x800
+    stack:
+    '''
+
+    @staticmethod
+    def state(system):
+        return (list(system.registers), system.program_counter, system.status, system.overflow_flag,
+                system.sign_flag, system.zero_flag, system.mem.digest())
+
+    def record(self, checkpoint_interval, max_checkpoints=64):
+        system = System()
+        encode(mem_map(tokenize(self.PROGRAM.split('\n'))), system)
+        recorder = Recorder(system, checkpoint_interval, max_checkpoints)
+        states = [self.state(system)]
+        while recorder.step():
+            states.append(self.state(system))
+        states.append(self.state(system))
+        return system, recorder, states
+
+    def test_step_back(self):
+        for interval in (4096, 7):
+            system, recorder, states = self.record(interval)
+            for n in (1, 3, 10, 0, 20):
+                recorder.step_back(n)
+                self.assertEqual(self.state(system), states[recorder.steps])
+            recorder.run(5)
+            self.assertEqual(self.state(system), states[recorder.steps])
+            recorder.step_back(1000)
+            self.assertEqual(recorder.steps, 0)
+            self.assertEqual(self.state(system), states[0])
+
+    def test_bounded_history(self):
+        system, recorder, states = self.record(5, max_checkpoints=3)
+        self.assertEqual(len(recorder.checkpoints), 3)
+        recorder.step_back(1000)
+        self.assertEqual(recorder.steps, recorder.earliest())
+        self.assertEqual(self.state(system), states[recorder.steps])
+
+    def test_run_back_until(self):
+        for interval in (4096, 4):
+            system, recorder, states = self.record(interval)
+            recorder.run_back_until(lambda s: s.registers[0] <= 6)
+            self.assertEqual(system.registers[0], 6)
+            self.assertEqual(self.state(system), states[recorder.steps])
+            self.assertNotEqual(states[recorder.steps + 1][0][0], 6)
+
+
+class TestProfiler(unittest.TestCase):
+
+    def test_counts(self):
+        source = '''irmovq 3, %rcx
+        irmovq 1, %rsi
+
+        loop: subq %rsi, %rcx
+        jne loop
+        halt
+        '''.split('\n')
+        system = System()
+        line_numbers = assembler.assemble(source, system)
+        self.assertEqual(line_numbers, {0: 1, 10: 2, 20: 4, 22: 5, 31: 6})
+
+        profiler = Profiler(system, line_numbers, source)
+        self.assertEqual(profiler.run(), 9)
+        rows = {row['pc']: row for row in profiler.hot_spots()}
+        self.assertEqual(rows[20]['count'], 3)
+        self.assertEqual((rows[22]['taken'], rows[22]['not_taken']), (2, 1))
+        self.assertEqual(rows[22]['source'], 'jne loop')
+        self.assertEqual(profiler.opcode_classes(), {'irmovq': 2, 'opq': 3, 'jxx': 3, 'halt': 1})
+        self.assertEqual(json.loads(profiler.to_json())['steps'], 9)
+
+
+class TestPipelineModel(unittest.TestCase):
+
+    def model(self, source, predictor='taken'):
+        system = System()
+        assembler.assemble(source.split('\n'), system)
+        model = PipelineModel(system, predictor)
+        model.run()
+        return model
+
+    def test_hazards(self):
+        model = self.model('''irmovq 512, %rsp
+        irmovq 256, %rdx
+        mrmovq 0(%rdx), %rax
+        addq %rax, %rax
+        call f
+        halt
+        f: popq %rbx
+        pushq %rbx
+        ret
+        ''')
+        self.assertEqual(model.instructions, 9)
+        # addq uses the value mrmovq just loaded, and pushq the one popq just loaded.
+        self.assertEqual(model.load_use_stalls, 2)
+        self.assertEqual(model.ret_bubbles, 3)
+        self.assertEqual(model.cycles(), 9 + 4 + 2 + 3)
+        rows = {row['pc']: row for row in model.per_pc()}
+        self.assertEqual(rows[30]['stalls'], 1)
+        self.assertEqual(rows[46]['bubbles'], 3)
+
+    def test_predictors(self):
+        source = '''irmovq 3, %rcx
+        irmovq 1, %rsi
+        loop: subq %rsi, %rcx
+        je done
+        jmp loop
+        done: halt
+        '''
+        # je is a forward branch, not taken twice and then taken.
+        expected = {'taken': 2, 'btfnt': 1, '2bit': 2}
+        for predictor, mispredictions in expected.items():
+            model = self.model(source, predictor)
+            self.assertEqual(model.branches, 3)
+            self.assertEqual(model.mispredictions, mispredictions, predictor)
+            self.assertEqual(model.cycles(), model.instructions + 4 + 2 * mispredictions)
+            self.assertEqual(json.loads(model.to_json())['mispredictions'], mispredictions)
+        with self.assertRaises(ValueError):
+            PipelineModel(System(), 'never')
+
+    def test_same_state(self):
+        source = '''irmovq 5, %rcx
+        irmovq 1, %rsi
+        irmovq 512, %rsp
+        loop: pushq %rcx
+        popq %rax
+        addq %rax, %rdx
+        subq %rsi, %rcx
+        jne loop
+        halt
+        '''.split('\n')
+        plain, timed = System(), System()
+        assembler.assemble(source, plain)
+        assembler.assemble(source, timed)
+        plain.run_until()
+        PipelineModel(timed, '2bit').run()
+        self.assertEqual(plain.registers, timed.registers)
+        self.assertEqual(plain.program_counter, timed.program_counter)
+        self.assertEqual(plain.status, timed.status)
+        self.assertEqual(plain.mem.main, timed.mem.main)
+
+
+class TestDataCache(unittest.TestCase):
+
+    def test_replacement(self):
+        # Two sets of two 16 byte lines. Lines 0, 2 and 4 all map to set 0.
+        lru = DataCache(size=64, line_size=16, associativity=2)
+        fifo = DataCache(size=64, line_size=16, associativity=2, replacement='fifo')
+        for cache in (lru, fifo):
+            for address in (0, 32, 0, 64, 0):
+                cache.access(address)
+        # LRU evicts line 2 for line 4 and keeps line 0, FIFO evicts line 0 and misses on it again.
+        self.assertEqual((lru.reads, lru.read_misses), (5, 3))
+        self.assertEqual(fifo.read_misses, 4)
+        # A word straddling two lines touches both, and rates count the lines rather than the word.
+        straddling = DataCache(size=64, line_size=16, associativity=2)
+        self.assertEqual(straddling.access(12), 2)
+        straddling.access(12)
+        summary = straddling.summary()
+        self.assertEqual((summary['line_accesses'], summary['hit_rate'], summary['miss_rate']), (4, 0.5, 0.5))
+
+    def test_write_policies(self):
+        back = DataCache(size=32, line_size=16, associativity=1)
+        through = DataCache(size=32, line_size=16, associativity=1, write_policy='through', miss_penalty=10)
+        for cache in (back, through):
+            cache.access(0, write=True)
+            cache.access(0)
+            cache.access(32)
+        self.assertEqual((back.write_misses, back.read_misses, back.writebacks), (1, 1, 1))
+        # Write through doesn't allocate on a write miss, so the read misses as well.
+        self.assertEqual((through.write_misses, through.read_misses, through.writebacks), (1, 2, 0))
+        self.assertEqual(through.stall_cycles(), (3 + 1) * 10)
+        with self.assertRaises(ValueError):
+            DataCache(size=48)
+
+    def test_attached(self):
+        source = '''irmovq 512, %rsp
+        irmovq 3, %rcx
+        irmovq 1, %rsi
+        loop: pushq %rcx
+        popq %rax
+        subq %rsi, %rcx
+        jne loop
+        halt
+        '''.split('\n')
+        system = System()
+        assembler.assemble(source, system)
+        cache = DataCache(size=256, line_size=32, associativity=2)
+        cache.attach(system)
+        system.run_until()
+        cache.detach()
+        self.assertEqual((cache.reads, cache.writes), (3, 3))
+        # Only the first push misses, and instruction fetches are not counted.
+        self.assertEqual(cache.misses(), 1)
+        self.assertEqual(cache.per_pc(), [(30, 1)])
+        self.assertEqual(system.registers[0], 1)
+        self.assertNotIn('read', vars(system.mem))
+        self.assertEqual(json.loads(cache.to_json())['misses_per_pc'], [{'pc': 30, 'misses': 1}])
+
+    def test_engines(self):
+        # Two loads in the one block, far enough apart to miss separately.
+        source = ['irmovq 0x400, %rdx', 'nop', 'nop', 'mrmovq 0(%rdx), %rax', 'mrmovq 0x100(%rdx), %rbx', 'halt']
+        for name in engines.ENGINES:
+            with self.subTest(engine=name):
+                system = System()
+                assembler.assemble(source, system)
+                cache = DataCache(size=256, line_size=32, associativity=2)
+                cache.attach(system)
+                engine = engines.create(name, system)
+                self.assertEqual(engine.run().status, Status.HLT)
+                engine.close()
+                cache.detach()
+                self.assertEqual(cache.per_pc(), [(0xc, 1), (0x16, 1)])
+
+
+class TestObjectFile(unittest.TestCase):
+
+    SOURCE = '''irmovq 512, %rsp
+    call main
+    halt
+    main: irmovq data, %rdx
+    mrmovq 0(%rdx), %rax
+    ret
+    .pos 1024
+    data: .quad 0x1234
+    '''
+
+    def test_round_trip(self):
+        lines = self.SOURCE.split('\n')
+        expected = System()
+        line_numbers = assembler.assemble(lines, expected)
+        image = objfile.assemble(lines)
+        self.assertEqual(image.symbols, {'main': 20, 'data': 1024})
+        self.assertEqual(image.lines, line_numbers)
+        self.assertEqual([base for base, _ in image.segments], [0, 1024])
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'program.yo')
+            objfile.save(image, path)
+            self.assertTrue(objfile.is_object_file(path))
+            # A threshold of 1 loads every segment through a memory map.
+            for threshold in (objfile.MMAP_THRESHOLD, 1):
+                system, loaded = objfile.load(path, mmap_threshold=threshold)
+                self.assertEqual(system.mem.main, expected.mem.main)
+                self.assertEqual(loaded.symbols, image.symbols)
+                self.assertEqual(loaded.lines, image.lines)
+                self.assertEqual(loaded.segments, [(0, len(image.segments[0][1])), (1024, 2)])
+                system.run_until()
+                self.assertEqual(system.status, Status.HLT)
+                self.assertEqual(system.registers[0], 0x1234)
+
+    def test_not_an_object_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'program.ys')
+            with open(path, 'w') as file:
+                file.write(self.SOURCE)
+            self.assertFalse(objfile.is_object_file(path))
+            with self.assertRaises(ValueError):
+                objfile.load(path)
+
+    def test_memory_size(self):
+        data = objfile.dumps(objfile.assemble(self.SOURCE.split('\n'), 2 ** 64))
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'program.yo')
+            with open(path, 'wb') as file:
+                file.write(data)
+            system, image = objfile.load(path)
+            self.assertEqual((image.memory_size, system.mem.size), (2 ** 64, 2 ** 64))
+        with self.assertRaises(ValueError):
+            objfile.dumps(objfile.assemble(self.SOURCE.split('\n'), 2 ** 64 + 8))
+
+    def test_truncated(self):
+        data = objfile.dumps(objfile.assemble(self.SOURCE.split('\n')))
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'program.yo')
+            # Cut off in the symbol table, and in the last segment's bytes.
+            for length in (objfile.HEADER.size + 2 * objfile.SEGMENT.size + 4, len(data) - 1):
+                with open(path, 'wb') as file:
+                    file.write(data[:length])
+                for threshold in (objfile.MMAP_THRESHOLD, 1):
+                    with self.subTest(length=length, threshold=threshold), self.assertRaises(ValueError) as caught:
+                        objfile.load(path, mmap_threshold=threshold)
+                    self.assertEqual(str(caught.exception), f'{path} is truncated')
+            errors = io.StringIO()
+            with mock.patch('sys.argv', ['Y86_64.py', path, '--dump', 'none']), contextlib.redirect_stderr(errors):
+                self.assertEqual(Y86_64.main(), 1)
+            self.assertEqual(errors.getvalue(), f'{path} is truncated\n')
+
+
+class TestAssemblyCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_hit(self):
+        lines = 'irmovq 3, %rcx\nirmovq 1, %rsi\nloop: subq %rsi, %rcx\njne loop\nhalt\n'.split('\n')
+        cache = AssemblyCache(self.directory.name)
+        expected = System()
+        first, second = System(), System()
+        self.assertEqual(cache.assemble(lines, first), assembler.assemble(lines, expected))
+        # A hit, even from another AssemblyCache on the same directory, never touches the assembler.
+        other = AssemblyCache(self.directory.name)
+        with mock.patch.object(assembler, 'tokenize', side_effect=AssertionError), \
+                mock.patch.object(assembler, 'encode', side_effect=AssertionError):
+            image = other.load(lines, second)
+        self.assertEqual(image.symbols, {'loop': 20})
+        self.assertEqual(second.mem.main, expected.mem.main)
+        self.assertEqual((cache.hits, cache.misses, other.hits, other.misses), (0, 1, 1, 0))
+        self.assertEqual(other.stats()['entries'], 1)
+        # A different assembler version is a different entry.
+        key = cache.key(lines)
+        with mock.patch.object(assembler, 'VERSION', assembler.VERSION + 1):
+            self.assertNotEqual(cache.key(lines), key)
+
+    def test_eviction(self):
+        cache = AssemblyCache(self.directory.name)
+        programs = [[f'irmovq {i + 1}, %rax', 'halt'] for i in range(3)]
+        for i, lines in enumerate(programs):
+            cache.load(lines, System())
+            os.utime(cache.path(cache.key(lines)), (i, i))
+        size = cache.stats()['bytes'] // 3
+        cache.max_bytes = 2 * size
+        self.assertEqual(cache.evict(), 1)
+        self.assertFalse(os.path.exists(cache.path(cache.key(programs[0]))))
+        self.assertTrue(os.path.exists(cache.path(cache.key(programs[2]))))
+
+    def test_file_and_memory_size(self):
+        source = os.path.join(self.directory.name, 'five.ys')
+        with open(source, 'w') as file:
+            file.write('irmovq 5, %rax\nhalt\n')
+        cache = AssemblyCache(os.path.join(self.directory.name, 'cache'))
+        with open(source) as file:
+            cache.load(file, System())
+        system = System()
+        cache.load(['irmovq 5, %rax', 'halt'], system)
+        system.run_until()
+        self.assertEqual((system.registers[0], cache.hits), (5, 1))
+        # The same source for a different size of memory is a different entry.
+        cache.load(['irmovq 5, %rax', 'halt'], System(memory_size=2 ** 20))
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_batch(self):
+        source = os.path.join(self.directory.name, 'halt.ys')
+        with open(source, 'w') as file:
+            file.write('irmovq 7, %rax\nhalt\n')
+        cache_directory = os.path.join(self.directory.name, 'cache')
+        results = [batch.run_job({'source': source}, cache_directory=cache_directory) for _ in range(2)]
+        self.assertEqual([result['assembly_cached'] for result in results], [False, True])
+        self.assertEqual(results[1]['registers']['%rax'], 7)
+
+
+class TestAssembler(unittest.TestCase):
+
+    def test_quad(self):
+        system = System()
+        assembler.assemble(['.quad 0x123', '.quad -2', 'here: .quad here'], system)
+        self.assertEqual(system.mem.read(0), 0x123)
+        self.assertEqual(Memory.to_signed(system.mem.read(8)), -2)
+        self.assertEqual(system.mem.read(16), 16)
+
+    def test_segments(self):
+        assembly = assembler.assemble_segments('''irmovq end, %rax
+        mrmovq 0x10(%rax), %rbx
+        jmp end
+        .pos 0x100
+        end: halt
+        '''.split('\n'))
+        self.assertEqual(assembly.labels, {'end': 0x100})
+        self.assertEqual(assembly.line_numbers, {0: 1, 10: 2, 20: 3, 0x100: 5})
+        self.assertEqual([place for place, _ in assembly.segments], [0, 0x100])
+        self.assertEqual(assembly.segments[0][1].hex(), '30f00001000000000000' '50301000000000000000'
+                                                        '700001000000000000')
+        self.assertEqual(assembler.encode_ins(['rmmovq', '%rcx', '-8(%rsp)']), '4014f8ffffffffffffff')
+
+    def test_diagnostics(self):
+        source = io.StringIO('irmovq 3, %rcx\nfoo bar\njmp nowhere\nirmovq 1, %rzz\n.pos\npushq\nhalt\n')
+        source.name = 'bad.ys'
+        with self.assertRaises(assembler.AssemblyError) as caught:
+            assembler.assemble(source, System())
+        diagnostics = caught.exception.diagnostics
+        self.assertEqual([(d.filename, d.line) for d in diagnostics], [('bad.ys', line) for line in range(2, 7)])
+        self.assertEqual(str(diagnostics[1]), 'bad.ys:3: Undefined label nowhere')
+
+    def test_outside_memory(self):
+        source = ['irmovq 1, %rax', '.pos 5000', 'halt', 'nop', '.pos 0xff8', '.quad 1', '.quad 2', '.pos 0', 'halt']
+        with self.assertRaises(assembler.AssemblyError) as caught:
+            assembler.assemble(source, System(0x1000))
+        self.assertEqual([str(d) for d in caught.exception.diagnostics], [
+            '<input>:2: .pos moves to 0x1388, outside memory',
+            '<input>:7: .quad at 0x1000 runs past the end of memory at 0x1000'])
+        with self.assertRaises(assembler.AssemblyError):
+            objfile.assemble(['.pos 5000', 'halt'], 0x1000)
+        self.assertEqual(assembler.assemble_segments(['.pos 5000', 'halt']).segments, [(5000, bytearray(1))])
+
+    def test_legacy_labels(self):
+        """
+        mem_map and encode fill in .quad labels as assemble does, and report bad lines as AssemblyErrors.
+        """
+        with open(os.path.join(os.path.dirname(__file__), '..', 'benchmarks', 'linkedlist.ys')) as source:
+            lines = source.readlines()
+        legacy, streamed = System(), System()
+        encode(mem_map(tokenize(lines)), legacy)
+        assembler.assemble(lines, streamed)
+        self.assertEqual(legacy.mem.load(0, 0x400), streamed.mem.load(0, 0x400))
+        for source, message in (['.quad nowhere'], 'Undefined label nowhere'), (['foo bar'], 'Unknown instruction foo'):
+            with self.assertRaises(assembler.AssemblyError) as caught:
+                mem_map(tokenize(source))
+            self.assertEqual(str(caught.exception), f'<input>:1: {message}')
+
+    def test_streaming(self):
+        lines = (line for line in ['loop: irmovq loop, %rax', 'jmp loop', '.pos 0x2000', 'halt'])
+        stream = assembler.StreamAssembler(chunk_size=8)
+        chunks = list(stream.chunks(lines))
+        self.assertEqual([(start, len(chunk)) for start, chunk in chunks], [(0, 10), (10, 9), (0x2000, 1)])
+        self.assertEqual(list(stream.resolved()), [(2, 0), (11, 0)])
+        system = System(0x4000)
+        assembly = assembler.assemble_into(iter(['irmovq end, %rax', '.pos 0x2000', 'end: halt']), system.mem)
+        self.assertEqual(assembly.segments, [(0, 10), (0x2000, 1)])
+        self.assertEqual(system.mem.read(2), 0x2000)
+
+
+class TestDump(unittest.TestCase):
+
+    def setUp(self):
+        self.system = System()
+        assembler.assemble(['irmovq 512, %rsp', 'irmovq 5, %rax', 'pushq %rax', 'rmmovq %rdx, 16(%rdx)', 'halt'],
+                           self.system)
+        self.system.mem.clean()
+        self.system.registers[2] = 0
+        self.system.run_until()
+
+    def test_dirty_pages(self):
+        mem = self.system.mem
+        # pushq dirtied the stack page and rmmovq overwrote part of the program with zeroes.
+        self.assertEqual(mem.dirty, {0, 1})
+        self.assertEqual(list(dump.ranges(mem, modified_only=True)), [(16, bytes(8)), (504, bytes([5]) + bytes(7))])
+        self.assertEqual([address for address, _ in dump.ranges(mem)], [0, 24, 504])
+
+    def test_formats(self):
+        mem = self.system.mem
+        text = io.StringIO()
+        dump.dump(mem, text)
+        self.assertEqual(text.getvalue().splitlines()[:2], ['# 0x0', '[48, 244, 0, 2, 0, 0, 0, 0]'])
+        hexdump = io.StringIO()
+        dump.dump(mem, hexdump, 'hexdump', modified_only=True)
+        self.assertTrue(hexdump.getvalue().startswith('0000000000000010  00 00 00 00 00 00 00 00'))
+        binary = io.BytesIO()
+        dump.dump(mem, binary, 'binary', modified_only=True)
+        self.assertEqual(binary.getvalue()[:28], b'Y86M' + (4096).to_bytes(8, 'little') + (16).to_bytes(8, 'little')
+                         + (8).to_bytes(8, 'little'))
+        output = io.StringIO()
+        dump.dump(mem, output, 'json', modified_only=True)
+        self.assertEqual(json.loads(output.getvalue())['ranges'][1], {'address': 504, 'hex': '05' + '00' * 7})
+
+
+class TestTracer(unittest.TestCase):
+
+    SOURCE = '''irmovq 512, %rsp
+    irmovq 3, %rcx
+    irmovq 1, %rsi
+    loop: pushq %rcx
+    popq %rax
+    subq %rsi, %rcx
+    jne loop
+    mrmovq 4096(%rsp), %rax
+    '''.split('\n')
+
+    def system(self):
+        system = System()
+        assembler.assemble(self.SOURCE, system)
+        return system
+
+    def test_ring_buffer(self):
+        tracer = tracing.Tracer(self.system(), capacity=4)
+        self.assertEqual(tracer.run(), 16)
+        records = tracer.records()
+        self.assertEqual([record.step for record in records], [12, 13, 14, 15])
+        fault = records[-1]
+        self.assertEqual((fault.pc, tracing.STATUS[fault.status]), (45, Status.ADR))
+        self.assertFalse(fault.flags & tracing.READ_MEMORY)
+        pop = records[-4]
+        self.assertEqual((tracedump.mnemonic(pop.code), pop.register, pop.register_value), ('popq', 0, 1))
+        self.assertEqual((pop.address, pop.memory_value, pop.stack_pointer), (504, 1, 512))
+        self.assertTrue(pop.flags & tracing.READ_MEMORY)
+
+    def test_stream(self):
+        file = io.BytesIO()
+        tracer = tracing.Tracer(self.system(), capacity=5, file=file)
+        tracer.run()
+        tracer.close()
+        file.seek(0)
+        records = list(tracing.read_records(file, chunk_records=3))
+        self.assertEqual([record.step for record in records], list(range(16)))
+        self.assertTrue(records[3].flags & tracing.WROTE_MEMORY)
+        self.assertEqual((records[3].address, records[3].memory_value), (504, 3))
+        jumps = [record for record in records if tracedump.matches(record, [tracedump.parse_range('20:')], {'jxx'})]
+        self.assertEqual(len(jumps), 3)
+        self.assertEqual(tracedump.format_record(records[3]),
+                         '         3 0x00001e pushq   AOK of=0 sf=0 zf=0 %rsp=0x1f8 write [0x1f8]=0x3')
+
+
+class TestLazyFlags(unittest.TestCase):
+
+    def test_flags(self):
+        system = System()
+        assembler.assemble(['irmovq 0x7fffffffffffffff, %rax', 'irmovq -1, %rbx', 'subq %rbx, %rax', 'halt'], system)
+        system.run_until()
+        self.assertIsNotNone(system._alu)
+        self.assertEqual((system.overflow_flag, system.sign_flag, system.zero_flag), (True, True, False))
+        self.assertIsNone(system._alu)
+        self.assertEqual(system.registers[0], 2 ** 63)
+
+    def test_set_while_pending(self):
+        system = System()
+        assembler.assemble(['xorq %rax, %rax', 'halt'], system)
+        snap = system.snapshot()
+        system.run_until()
+        # Setting one flag keeps the others the ALU operation left.
+        system.sign_flag = True
+        self.assertEqual((system.overflow_flag, system.sign_flag, system.zero_flag), (False, True, True))
+        system.restore(snap)
+        self.assertEqual((system.overflow_flag, system.sign_flag, system.zero_flag), (False, False, False))
+
+
+class TestEngineConformance(unittest.TestCase):
+    """
+    Runs every program in this file through each engine and checks they all leave the same state behind. Programs are
+    found by parsing this file: the encoded_program strings of machine code, and the upper case class attributes holding
+    assembly source.
+    """
+
+    @staticmethod
+    def programs():
+        with open(__file__) as file:
+            tree = ast.parse(file.read())
+        for node in ast.walk(tree):
+            if not isinstance(node, ast.Assign) or not isinstance(node.targets[0], ast.Name):
+                continue
+            if not isinstance(node.value, ast.Constant) or not isinstance(node.value.value, str):
+                continue
+            name = node.targets[0].id
+            if name == 'encoded_program':
+                yield f'line {node.lineno}', node.value.value, None
+            elif name.isupper():
+                yield f'{name} on line {node.lineno}', None, node.value.value.split('\n')
+
+    @staticmethod
+    def load(machine_code, source):
+        system = System()
+        if machine_code is not None:
+            system.mem.store(0, Memory.hex_string_to_bytes(machine_code))
+        else:
+            assembler.assemble(source, system)
+        return system
+
+    def assert_same_state(self, expected, actual):
+        self.assertEqual(expected.registers, actual.registers)
+        self.assertEqual((expected.program_counter, expected.status, expected.fault_address),
+                         (actual.program_counter, actual.status, actual.fault_address))
+        self.assertEqual((expected.overflow_flag, expected.sign_flag, expected.zero_flag),
+                         (actual.overflow_flag, actual.sign_flag, actual.zero_flag))
+        self.assertTrue(expected.mem.main == actual.mem.main)
+
+    def test_run(self):
+        programs = list(self.programs())
+        self.assertGreater(len(programs), 25)
+        for where, machine_code, source in programs:
+            reference = self.load(machine_code, source)
+            expected = engines.create('reference', reference).run(max_steps=1000)
+            for name in engines.ENGINES:
+                with self.subTest(program=where, engine=name):
+                    system = self.load(machine_code, source)
+                    self.assertEqual(engines.create(name, system).run(max_steps=1000), expected)
+                    self.assert_same_state(reference, system)
+
+    def test_step(self):
+        for where, machine_code, source in self.programs():
+            for name in engines.ENGINES:
+                with self.subTest(program=where, engine=name):
+                    reference, system = self.load(machine_code, source), self.load(machine_code, source)
+                    engine = engines.create(name, system)
+                    for _ in range(200):
+                        if reference.status != Status.AOK:
+                            break
+                        reference.step()
+                        engine.step()
+                        self.assert_same_state(reference, system)
+
+    def test_breakpoints(self):
+        for name in engines.ENGINES:
+            system = self.load(None, TestRunUntil.COUNT_DOWN.split('\n'))
+            engine = engines.create(name, system)
+            self.assertEqual(engine.run(breakpoints={22}), (3, Status.AOK, StopReason.BREAKPOINT))
+            result = engine.run(stop_on=lambda s: s.registers[1] == 4)
+            self.assertEqual((result.reason, system.program_counter), (StopReason.CONDITION, 22))
+        with self.assertRaises(ValueError):
+            engines.create('missing', System())
+
+    def test_handoff(self):
+        """
+        A System handed from engine to engine part way through ends up as if one engine had run it, and closed engines
+        leave nothing behind on its memory.
+        """
+        source = ['irmovq 0x800, %rsp', 'irmovq 1, %rsi', 'irmovq 40, %rcx', 'loop: pushq %rcx', 'subq %rsi, %rcx',
+                  'jg loop', 'halt']
+        reference = self.load(None, source)
+        expected = engines.create('reference', reference).run()
+        system = self.load(None, source)
+        observers = len(system.mem.write_observers)
+        steps = 0
+        for turn in range(100):
+            engine = engines.create(sorted(engines.ENGINES)[turn % len(engines.ENGINES)], system)
+            steps += engine.run(max_steps=3).steps
+            engine.close()
+            self.assertEqual(len(system.mem.write_observers), observers)
+            if system.status != Status.AOK:
+                break
+        self.assertEqual((steps, system.status), (expected.steps, expected.status))
+        self.assert_same_state(reference, system)
+        stepper = debugger.Debugger(system)
+        detector = loops.LoopDetector(system, 'fused')
+        stepper.close()
+        detector.close()
+        self.assertEqual(len(system.mem.write_observers), observers)
+
+    def test_missing_register(self):
+        # rrmovq %r?, %rax, pushq %r?, irmovq 5, %r? and mrmovq 0(%r?), %rcx, where %r? is register 0xf
+        for machine_code in ('20f0', 'a0ff', '30ff0500000000000000', '501f0000000000000000'):
+            for name in engines.ENGINES:
+                with self.subTest(machine_code=machine_code, engine=name):
+                    system = self.load(machine_code, None)
+                    self.assertEqual(engines.create(name, system).run(max_steps=5).status, Status.INS)
+                    self.assertEqual(system.program_counter, 0)
+
+
+class TestFusedEngine(unittest.TestCase):
+    LOOP = '''irmovq 5, %rcx
+irmovq 1, %rsi
+loop: irmovq 3, %rdx
+addq %rdx, %rax
+subq %rsi, %rcx
+jne loop
+halt'''
+    # The pushq writes 20 01 00 over the popq and halt after it, leaving rrmovq %rax, %rcx followed by halt.
+    SELF_MODIFYING = '\n'.join(['irmovq 55, %rsp', 'irmovq 0x120, %rax', 'jmp go'] + ['nop'] * 16 +
+                               ['go: pushq %rax', 'popq %rbx', 'halt'])
+
+    def setUp(self):
+        self.system = System()
+        assembler.assemble(self.LOOP.split('\n'), self.system)
+        self.engine = engines.create('fused', self.system)
+
+    def test_fusion(self):
+        self.assertEqual(self.engine.run(), (23, Status.HLT, StopReason.HALT))
+        self.assertEqual(self.system.registers[0], 15)
+        fused = {pc: record[2] for pc, record in self.engine.fused_cache.entries.items()}
+        self.assertEqual(fused, {0: 1, 10: 1, 20: 2, 32: 2, 43: 1})
+
+    def test_breakpoint_inside_pair(self):
+        self.assertEqual(self.engine.run(breakpoints={34}), (5, Status.AOK, StopReason.BREAKPOINT))
+        self.assertEqual(self.system.program_counter, 34)
+        self.assertEqual(self.engine.run(breakpoints={30}), (2, Status.AOK, StopReason.BREAKPOINT))
+
+    def test_budget_inside_pair(self):
+        self.assertEqual(self.engine.run(max_steps=3), (3, Status.AOK, StopReason.BUDGET))
+        self.assertEqual(self.system.program_counter, 30)
+        self.assertEqual(self.engine.run(max_steps=2), (2, Status.AOK, StopReason.BUDGET))
+        self.assertEqual(self.system.program_counter, 34)
+
+    def test_self_modifying(self):
+        system = System()
+        assembler.assemble(self.SELF_MODIFYING.split('\n'), system)
+        self.assertEqual(engines.create('fused', system).run(), (6, Status.HLT, StopReason.HALT))
+        self.assertEqual((system.registers[1], system.registers[3]), (0x120, 0))
+
+
+class TestBenchmark(unittest.TestCase):
+
+    # Register and value each workload leaves its answer in. bubblesort leaves its answer in memory.
+    EXPECTED = {'arraysum': (3, 4953600), 'bubblesort': None, 'fib': (0, 10946), 'linkedlist': (3, 652800),
+                'stack': (3, 950400)}
+
+    def test_workloads(self):
+        paths = benchmark.find_workloads()
+        self.assertEqual([os.path.basename(path) for path in paths], [name + '.ys' for name in sorted(self.EXPECTED)])
+        for path in paths:
+            expected = self.EXPECTED[os.path.splitext(os.path.basename(path))[0]]
+            for name in engines.ENGINES:
+                with self.subTest(workload=path, engine=name):
+                    system = System()
+                    with open(path) as file:
+                        labels = assembler.assemble_into(file, system.mem, path).labels
+                    self.assertEqual(engines.create(name, system).run().status, Status.HLT)
+                    if expected is None:
+                        array = labels['array']
+                        self.assertEqual([system.mem.read(array + 8 * i) for i in range(64)], list(range(1, 65)))
+                    else:
+                        self.assertEqual(system.registers[expected[0]], expected[1])
+
+    def test_run_workload(self):
+        result = benchmark.run_workload(os.path.join(benchmark.WORKLOAD_DIRECTORY, 'fib.ys'), 'table', repeat=1)
+        self.assertEqual((result['workload'], result['status']), ('fib', 'HLT'))
+        self.assertGreater(result['instructions'], 100000)
+        self.assertGreater(result['ips'], 0)
+        self.assertGreater(result['peak_bytes'], 0)
+
+    def test_compare(self):
+        baseline = {'fib': {'ips': 1000.0, 'assemble_seconds': 0.01, 'peak_bytes': 5000},
+                    'gone': {'ips': 1000.0, 'assemble_seconds': 0.01, 'peak_bytes': 5000}}
+        results = {'fib': {'ips': 850.0, 'assemble_seconds': 0.0105, 'peak_bytes': 6000},
+                   'new': {'ips': 1.0, 'assemble_seconds': 1.0, 'peak_bytes': 1}}
+        self.assertEqual(benchmark.compare(results, baseline, 0.1),
+                         [('fib', 'ips', 1000.0, 850.0), ('fib', 'peak_bytes', 5000, 6000)])
+        self.assertEqual(benchmark.compare(results, baseline, 0.25), [])
+
+
+class TestCommandLine(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def main(self, source, *arguments):
+        """
+        Runs Y86_64.main on source, given as a list of lines on stdin.
+
+        :return: A 2-tuple of the exit status and what was printed
+        """
+        output = io.StringIO()
+        argv = ['Y86_64.py', '-', '--dump-file', os.path.join(self.directory.name, 'memory.txt')] + list(arguments)
+        with mock.patch('sys.argv', argv), mock.patch('sys.stdin', io.StringIO('\n'.join(source))), \
+                contextlib.redirect_stdout(output), contextlib.redirect_stderr(io.StringIO()):
+            status = Y86_64.main()
+        return status, output.getvalue()
+
+    def test_json(self):
+        status, output = self.main(['irmovq 3, %rax', 'addq %rax, %rax', 'halt'], '--format', 'json')
+        result = json.loads(output)
+        self.assertEqual(status, 0)
+        self.assertEqual((result['status'], result['steps'], result['registers']['%rax']), ('HLT', 3, 6))
+        self.assertTrue(os.path.exists(os.path.join(self.directory.name, 'memory.txt')))
+
+    def test_exit_codes(self):
+        self.assertEqual(self.main(['loop: jmp loop'], '--max-steps', '50', '-q', '--dump', 'none'), (5, ''))
+        self.assertEqual(self.main(['irmovq 8192, %rsp', 'popq %rax'], '-q', '--dump', 'none'), (3, ''))
+        self.assertEqual(self.main(['.quad 0xff'], '-q', '--dump', 'none'), (4, ''))
+        self.assertEqual(self.main(['irmovq 5000'], '-q', '--dump', 'none'), (1, ''))
+        self.assertFalse(os.path.exists(os.path.join(self.directory.name, 'memory.txt')))
+
+    def test_no_budget(self):
+        source = ['irmovq 2000, %rcx', 'irmovq 1, %rsi', 'loop: subq %rsi, %rcx', 'jne loop', 'halt']
+        status, output = self.main(source, '--max-steps', '0', '--format', 'json', '--dump', 'none')
+        self.assertEqual((status, json.loads(output)['steps']), (0, 4003))
+
+    def test_detect_loops(self):
+        status, output = self.main(['loop: jmp loop'], '--detect-loops', '--format', 'json', '--dump', 'none')
+        self.assertEqual((status, json.loads(output)['loop']), (6, {'length': 1, 'low_pc': 0, 'high_pc': 0}))
+        source = ['irmovq 3, %rax', 'halt']
+        self.assertEqual(self.main(source, '--detect-loops', '-q', '--dump', 'none'), (0, ''))
+        source = ['irmovq 1, %rsi', 'loop: xorq %rsi, %rbx'] + ['nop'] * 5 + ['jmp loop']
+        self.assertEqual(self.main(source, '--detect-loops', '-q', '--dump', 'none'), (6, ''))
+        # There is no default step limit, so a program running longer than MAX_STEPS is left to halt.
+        source = ['irmovq 600, %rcx', 'irmovq 1, %rsi', 'loop: subq %rsi, %rcx', 'jne loop', 'halt']
+        self.assertEqual(self.main(source, '--detect-loops', '-q', '--dump', 'none'), (0, ''))
+
+    def test_conflicting_options(self):
+        # Each of these used to have one option silently ignored.
+        for arguments in (['--trace', 'trace.bin', '--detect-loops'], ['--trace-last', '5'],
+                          ['--trace', 'trace.bin', '--trace-last', '0'], ['--profile', '--engine', 'fused'],
+                          ['--pipeline', 'taken', '--profile-json', 'profile.json']):
+            with self.subTest(arguments=arguments), self.assertRaises(SystemExit) as caught:
+                self.main(['halt'], *arguments)
+            self.assertEqual(caught.exception.code, 2)
+        self.assertEqual(self.main(['halt'], '--detect-loops', '--engine', 'fused', '-q', '--dump', 'none'), (0, ''))
+
+    def test_profile_json_and_object(self):
+        profile, image = (os.path.join(self.directory.name, name) for name in ('profile.json', 'program.o'))
+        source = ['irmovq 3, %rax  # three', 'halt']
+        status, _ = self.main(source, '--profile-json', profile, '--object', image, '-q', '--dump', 'none')
+        self.assertEqual(status, 0)
+        with open(profile) as file:
+            self.assertEqual(json.load(file)['hot_spots'][0]['source'], 'irmovq 3, %rax  # three')
+        # An object file is loaded from its path, leaving stdin alone.
+        argv = ['Y86_64.py', image, '--format', 'json', '--dump', 'none']
+        stdin = mock.Mock()
+        with mock.patch('sys.argv', argv), mock.patch('sys.stdin', stdin), \
+                contextlib.redirect_stdout(io.StringIO()) as output:
+            self.assertEqual(Y86_64.main(), 0)
+        self.assertEqual(json.loads(output.getvalue())['registers']['%rax'], 3)
+        self.assertEqual(stdin.mock_calls, [])
+
+
+class TestDebugger(unittest.TestCase):
+
+    SOURCE = """irmovq stack, %rsp
+    irmovq total, %rdi
+    irmovq 3, %rcx
+    irmovq 1, %rsi
+    loop: pushq %rcx
+    rmmovq %rcx, 0(%rdi)
+    call count
+    subq %rsi, %rcx
+    jne loop
+    halt
+    count: irmovq 8, %rax
+    addq %rax, %rdi
+    ret
+    .pos 0x200
+    total:
+    .pos 0x400
+    stack:
+    """
+
+    def load(self, engine):
+        system = System()
+        assembly = assembler.assemble_into(self.SOURCE.split('\n'), system.mem)
+        return debugger.Debugger(system, assembly.labels, assembly.line_numbers, engine)
+
+    def test_breakpoint(self):
+        for name in engines.ENGINES:
+            program = self.load(name)
+            program.add_breakpoint('count')
+            self.assertEqual(program.run().reason, StopReason.BREAKPOINT)
+            self.assertEqual(program.system.registers[1], 3)
+            self.assertEqual(program.run().reason, StopReason.BREAKPOINT)
+            self.assertEqual(program.system.registers[1], 2)
+            program.remove_breakpoint('count')
+            self.assertEqual(program.run().reason, StopReason.HALT)
+            self.assertEqual(program.steps, 4 + 3 * 8 + 1)
+
+    def test_memory_watch(self):
+        for name in engines.ENGINES:
+            program = self.load(name)
+            program.watch('total', 16)
+            # Watches on memory stop just after the writing instruction, with no per instruction check.
+            with mock.patch.object(program, 'registers_changed') as registers_changed:
+                result = program.run()
+            registers_changed.assert_not_called()
+            self.assertEqual((result.steps, result.reason), (6, StopReason.CONDITION))
+            self.assertEqual(program.hits, [debugger.Hit((0x200, 16), bytes(16), bytes([3]) + bytes(15), 0x2a)])
+            self.assertEqual(program.system.program_counter, 0x34)
+            # A call writes to the stack, which is watched too, and stops at the function it calls.
+            program.watch('0x3f0')
+            result = program.run()
+            self.assertEqual((result.reason, program.system.program_counter), (StopReason.CONDITION, 0x49))
+            self.assertEqual(program.hits[0].pc, 0x34)
+            program.unwatch('0x3f0')
+            program.unwatch('total')
+            self.assertEqual(program.run().reason, StopReason.HALT)
+
+    def test_register_watch(self):
+        program = self.load('table')
+        program.watch('%rdi')
+        result = program.run()
+        self.assertEqual(result.reason, StopReason.CONDITION)
+        self.assertEqual(program.hits, [debugger.Hit('%rdi', 0, 0x200, None)])
+        self.assertEqual(program.system.program_counter, 0x14)
+
+    def test_disassemble(self):
+        program = self.load('reference')
+        program.add_breakpoint('loop')
+        program.run()
+        lines = program.disassemble()
+        self.assertEqual(len(lines), debugger.CONTEXT_BEFORE + 1 + debugger.CONTEXT_AFTER)
+        self.assertEqual(lines[debugger.CONTEXT_BEFORE], '=>* 0x0028  a01f                  loop: pushq %rcx')
+        self.assertEqual(program.disassemble('count', 1), ['    0x0049  30f00800000000000000  count: irmovq 8, %rax'])
+
+    def test_shell(self):
+        program = self.load('reference')
+        output = io.StringIO()
+        commands = io.StringIO('b count\nc\np %rcx\n\nwatch bogus\nc\nc\nc\nc\nstep\nquit\n')
+        debugger.DebuggerShell(program, stdin=commands, stdout=output).cmdloop()
+        text = output.getvalue()
+        self.assertIn('breakpoint at 0x49', text)
+        self.assertIn('%rcx = 0x3 (3)', text)
+        self.assertIn('=>  0x0053  6007                  addq %rax, %rdi', text)
+        self.assertIn('bogus is neither a label nor an address', text)
+        self.assertIn('halted after 29 instructions', text)
+        self.assertIn('the program has stopped with status HLT', text)
+
+
+class TestLoopDetector(unittest.TestCase):
+    # Counts %rbx down forever, storing it on the stack through a call each time round.
+    STUCK = """irmovq stack, %rsp
+irmovq 1, %rsi
+loop: subq %rsi, %rbx
+call save
+jmp loop
+save: pushq %rbx
+popq %rax
+ret
+.pos 0x200
+stack:"""
+    # Loops 4096 times, which the detector mustn't mistake for a loop that never ends.
+    SLOW = """irmovq 4096, %rcx
+irmovq 1, %rsi
+loop: subq %rsi, %rcx
+rrmovq %rcx, %rax
+jne loop
+halt"""
+
+    def load(self, source, engine='reference', interval=loops.DEFAULT_INTERVAL):
+        system = System()
+        assembler.assemble(source.split('\n'), system)
+        return loops.LoopDetector(system, engine, interval)
+
+    def test_terminating(self):
+        for name in engines.ENGINES:
+            detector = self.load(self.SLOW, name, interval=7)
+            self.assertEqual(detector.run(), (12291, Status.HLT, StopReason.HALT))
+            self.assertIsNone(detector.loop)
+            self.assertEqual(self.load(self.SLOW, name).run(max_steps=500), (500, Status.AOK, StopReason.BUDGET))
+
+    def test_changing_memory(self):
+        # %rbx only comes back to its starting value after 2^64 times round, so the program is never caught.
+        detector = self.load(self.STUCK)
+        self.assertEqual(detector.run(max_steps=20000).reason, StopReason.BUDGET)
+
+    def test_loop(self):
+        source = self.STUCK.replace('subq %rsi, %rbx', 'xorq %rsi, %rbx')
+        for name in engines.ENGINES:
+            detector = self.load(source, name, interval=5)
+            result = detector.run(max_steps=10000)
+            self.assertEqual((result.status, result.reason), (Status.AOK, StopReason.LOOP))
+            # Two times round the loop of six instructions restore %rbx, and the stack written by call and pushq.
+            self.assertEqual(detector.loop, loops.Loop(12, 0x14, 0x2c))
+            # The system is left where the loop was found, and comes back there after going round it once more.
+            state = detector.state()
+            detector.engine.run(max_steps=detector.loop.length)
+            self.assertEqual(detector.state(), state)
+
+    def test_loop_length_not_dividing_interval(self):
+        # Seven instructions a time round, with %rbx coming back every second time, so fourteen in all.
+        source = 'irmovq 1, %rsi\nloop: xorq %rsi, %rbx\n' + 'nop\n' * 5 + 'jmp loop'
+        for name in engines.ENGINES:
+            detector = self.load(source, name)
+            result = detector.run(max_steps=1000)
+            self.assertEqual((result.steps, result.reason), (114, StopReason.LOOP))
+            self.assertEqual(detector.loop, loops.Loop(14, 0xa, 0x11))